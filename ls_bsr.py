@@ -18,6 +18,7 @@ import errno
 import types
 from ls_bsr.util import *
 import glob
+import re
 import tempfile
 
 def test_file(option, opt_str, value, parser):
@@ -62,8 +63,19 @@ def test_blast(option, opt_str, value, parser):
         setattr(parser.values, option.dest, value)
     elif "diamond" == value:
         setattr(parser.values, option.dest, value)
+    elif "blastp-orf" == value:
+        setattr(parser.values, option.dest, value)
+    else:
+        print("Blast option not supported. Select from tblastn, blastn, blastn-short, blat, blastp, diamond, blastp-orf")
+        sys.exit()
+
+def test_training(option, opt_str, value, parser):
+    if "F" == value or "T" == value:
+        setattr(parser.values, option.dest, value)
+    elif os.path.isfile(value):
+        setattr(parser.values, option.dest, os.path.abspath(value))
     else:
-        print("Blast option not supported. Select from tblastn, blastn, blastn-short, blat, blastp, diamond")
+        print("select from T, F, or a genome to train Prodigal on")
         sys.exit()
 
 def test_dir(option, opt_str, value, parser):
@@ -93,7 +105,8 @@ def test_fplog(option, opt_str, value, parser):
 
 def main(directory,id,filter,processors,genes,cluster_method,blast,length,
          max_plog,min_hlog,f_plog,keep,filter_peps,filter_scaffolds,prefix,
-         intergenics,min_len,dup_toggle):
+         intergenics,min_len,dup_toggle,split_size,mem_budget,mem_profile,prodigal_training,
+         compare_training,fast_matrix,selective_search,update,db_cache,tool_timeout,tool_retries,sparse_matrix,hit_matrices,hit_store):
     start_dir = os.getcwd()
     ap=os.path.abspath("%s" % start_dir)
     dir_path=os.path.abspath("%s" % directory)
@@ -111,9 +124,47 @@ def main(directory,id,filter,processors,genes,cluster_method,blast,length,
     elif intergenics == "T" and blast=="diamond":
         logPrint("Incompatible choices: if incorporating intergenics, choose a nucleotide alignment method")
         sys.exit()
+    elif intergenics == "T" and blast=="blastp-orf":
+        logPrint("Incompatible choices: if incorporating intergenics, choose a nucleotide alignment method")
+        sys.exit()
+    """A de novo update extends a previous run, so its consensus must be nucleotides"""
+    old_genomes = []
+    if "null" not in update:
+        update = os.path.abspath(update)
+        old_consensus = re.sub(r"_bsr_matrix\.txt$","",update)+"_consensus.fasta"
+        if "null" in genes and blast not in ["tblastn", "blastn", "blastn-short", "blat"]:
+            logPrint("Updating a previous de novo run is only supported with tblastn, blastn, blastn-short, or blat")
+            sys.exit()
+        if fast_matrix == "T":
+            logPrint("Incompatible choices: a fast matrix can't be used to update a previous run")
+            sys.exit()
+        if hit_matrices == "T":
+            logPrint("Incompatible choices: hit matrices can't be added to a previous run")
+            sys.exit()
+        if hit_store == "T":
+            logPrint("Incompatible choices: old genomes aren't searched for every gene, so their hits can't be stored")
+            sys.exit()
+        old_dups = re.sub(r"_bsr_matrix\.txt$","",update)+"_dup_matrix.txt"
+        if dup_toggle == "T" and not os.path.exists(old_dups):
+            logPrint("duplicate matrix of the previous run (%s) not found, it's needed with -z" % old_dups)
+            sys.exit()
+        if "null" in genes and not os.path.exists(old_consensus):
+            logPrint("consensus of the previous run (%s) not found" % old_consensus)
+            sys.exit()
+        if selective_search == "T":
+            logPrint("selective search isn't used when updating, old genomes are only searched for new centroids")
+            selective_search = "F"
+        old_genomes = read_matrix_genomes(update)
+    selective_search = selective_search_choice(selective_search, dup_toggle, f_plog)
+    if compare_training == "T" and prodigal_training == "F":
+        logPrint("Incompatible choices: --compare_training compares against a shared training file, choose --prodigal_training")
+        sys.exit()
+    if fast_matrix == "T" and (hit_matrices == "T" or hit_store == "T"):
+        logPrint("Incompatible choices: hit matrices and the hit store need alignments, which a fast matrix skips")
+        sys.exit()
     logPrint("Testing paths of dependencies")
-    if blast=="blastn" or blast=="tblastn" or blast=="blastp":
-        ab = subprocess.call(['which', '%s' % blast])
+    if blast=="blastn" or blast=="tblastn" or blast=="blastp" or blast=="blastp-orf":
+        ab = subprocess.call(['which', '%s' % blast.replace("-orf","")])
         if ab == 0:
             print("citation: Altschul SF, Madden TL, Schaffer AA, Zhang J, Zhang Z, Miller W, and Lipman DJ. 1997. Gapped BLAST and PSI-BLAST: a new generation of protein database search programs. Nucleic Acids Res 25:3389-3402")
         else:
@@ -153,13 +204,54 @@ def main(directory,id,filter,processors,genes,cluster_method,blast,length,
         else:
             os.makedirs("%s/%s" % (ap,prefix))
             fastadir = "%s/%s" % (ap,prefix)
+    if "null" not in mem_profile:
+        load_memory_profile(mem_profile)
+    if "null" not in db_cache:
+        if not os.path.exists(db_cache):
+            os.makedirs(db_cache)
+        BLAST_DB_CACHE[0] = os.path.abspath(db_cache)
+    TOOL_LIMITS["timeout"] = tool_timeout
+    TOOL_LIMITS["retries"] = tool_retries
+    if "F" != sparse_matrix:
+        try:
+            float(sparse_matrix)
+        except ValueError:
+            print("--sparse_matrix must be a BSR value or F")
+            sys.exit()
+    logPrint("checking input files")
+    preflight_files = []
+    for pattern in ['*.fasta', '*.fasta.gz', '*.gbk', '*.gbk.gz', '*.pep']:
+        preflight_files.extend(glob.glob(os.path.join(dir_path, pattern)))
+    if "null" not in genes:
+        preflight_files.append(os.path.abspath(genes))
+    input_stats, empty_files = preflight_inputs(preflight_files, processors, "%s/%s_preflight_report.txt" % (ap,os.path.basename(fastadir)), fastadir)
+    if len(empty_files)>0:
+        print("empty or unreadable input files found, remove them and run again")
+        os.system("rm -rf %s" % fastadir)
+        sys.exit()
+    genome_files = glob.glob(os.path.join(dir_path, '*.fasta'))+glob.glob(os.path.join(dir_path, '*.fasta.gz'))
+    genome_stats = dict([(get_seq_name(f).replace(".gz",""), input_stats[get_seq_name(f).replace(".gz","")]) for f in genome_files])
+    duplicate_genomes = find_duplicate_genomes(genome_stats, "%s/%s_duplicate_genomes.txt" % (ap,os.path.basename(fastadir)))
+    """a new genome can't reuse the hits of an old one, those only cover the new centroids"""
+    duplicate_genomes = dict([(x,y) for x,y in duplicate_genomes.items()
+                              if x.replace(".fasta","") in old_genomes or y.replace(".fasta","") not in old_genomes])
     samples = []
-    for infile in glob.glob(os.path.join(dir_path, '*.fasta')):
-        name=get_seq_name(infile)
+    for infile in genome_files:
+        name=get_seq_name(infile).replace(".gz","")
         samples.append(name)
+        if name in duplicate_genomes:
+            """identical genomes are only aligned once"""
+            if os.path.exists("%s/%s.new" % (fastadir,name)):
+                os.remove("%s/%s.new" % (fastadir,name))
+            continue
+        if infile.endswith(".gz"):
+            """already decompressed into the temp directory by the preflight check"""
+            continue
         os.link(infile,"%s/%s.new" % (fastadir,name))
+    """genomes with a GFF3 annotation (genome.gff) don't need Prodigal"""
+    annotations = find_genome_annotations(dir_path)
     genbank_files = []
-    for infile in glob.glob(os.path.join(dir_path, '*.gbk')):
+    for infile in glob.glob(os.path.join(dir_path, '*.gbk'))+glob.glob(os.path.join(dir_path, '*.gbk.gz')):
         name=get_seq_name(infile)
         genbank_files.append("1")
     #New code to test if there are peptide files as the reference
@@ -171,6 +263,28 @@ def main(directory,id,filter,processors,genes,cluster_method,blast,length,
     if len(samples) == 0 and len(genbank_files) == 0 and len(pep_refs) == 0:
         print("no usable genome files found, exiting...")
         sys.exit()
+    if len(old_genomes)>0:
+        available = [x.replace(".fasta","") for x in samples]+[re.sub(r"\.gbk(\.gz)?$","",get_seq_name(x))
+                                                              for x in glob.glob(os.path.join(dir_path, '*.gbk'))+glob.glob(os.path.join(dir_path, '*.gbk.gz'))]
+        missing = [x for x in old_genomes if x not in available]
+        if len(missing)>0:
+            print("genomes in the previous matrix are missing from the directory: %s" % ",".join(missing))
+            os.system("rm -rf %s" % fastadir)
+            sys.exit()
+        logPrint("%s genomes are new, %s are in the previous matrix" % (len(available)-len(old_genomes), len(old_genomes)))
+        if "null" not in genes:
+            """new genes are only screened, so the genomes must be the same"""
+            if len(available)>len(old_genomes):
+                print("genomes not in the previous matrix found: %s, use a full run to add genomes" %
+                      ",".join([x for x in available if x not in old_genomes]))
+                os.system("rm -rf %s" % fastadir)
+                sys.exit()
+        else:
+            """genes are only predicted for the new genomes"""
+            os.makedirs("%s/previous" % fastadir)
+            for name in samples:
+                if name.replace(".fasta","") in old_genomes and os.path.exists("%s/%s.new" % (fastadir,name)):
+                    os.rename("%s/%s.new" % (fastadir,name), "%s/previous/%s.new" % (fastadir,name))
     """This is the section on de novo clustering"""
     if "null" in genes:
         if "null" in cluster_method:
@@ -178,12 +292,13 @@ def main(directory,id,filter,processors,genes,cluster_method,blast,length,
             sys.exit()
         else:
             pass
-        rc = subprocess.call(['which', 'prodigal'])
-        if rc == 0:
-            print("citation: Hyatt D, Chen GL, Locascio PF, Land ML, Larimer FW, and Hauser LJ. 2010. Prodigal: prokaryotic gene recognition and translation initiation site identification. BMC Bioinformatics 11:119")
-        else:
-            print("prodigal is not in your path, but needs to be!")
-            sys.exit()
+        if len([x for x in samples if x not in annotations])>0:
+            rc = subprocess.call(['which', 'prodigal'])
+            if rc == 0:
+                print("citation: Hyatt D, Chen GL, Locascio PF, Land ML, Larimer FW, and Hauser LJ. 2010. Prodigal: prokaryotic gene recognition and translation initiation site identification. BMC Bioinformatics 11:119")
+            else:
+                print("prodigal is not in your path, but needs to be!")
+                sys.exit()
         if "mmseqs" in cluster_method or "mmseqs-lin" in cluster_method:
             rc = subprocess.call(['which','mmseqs'])
             if rc == 0:
@@ -212,18 +327,22 @@ def main(directory,id,filter,processors,genes,cluster_method,blast,length,
                 else:
                     print("vsearch is not in your path, but needs to be!")
                     sys.exit()
-        if len(samples) == 0:
+        if len([x for x in samples if x.replace(".fasta","") not in old_genomes]) == 0:
             pass
         else:
             logPrint("predicting genes with Prodigal")
             """Only predict genes if there are FASTA files"""
-            predict_genes(fastadir, processors, intergenics)
+            predict_genes(fastadir, processors, intergenics, split_size, mem_budget, annotations, prodigal_training, compare_training)
             logPrint("Prodigal done")
         """This function produces locus tags"""
         if len(genbank_files)>0:
             logPrint("Converting genbank files")
             os.chdir("%s" % fastadir)
-            genbank_hits = process_genbank_files(dir_path)
+            protein_search = blast=="blastp" or blast=="diamond" or blast=="blastp-orf"
+            genbank_hits = process_genbank_files(dir_path, processors, True, protein_search, not protein_search)
+            for name in old_genomes:
+                if os.path.exists("%s.locus_tags.fasta" % name):
+                    os.remove("%s.locus_tags.fasta" % name)
         else:
             genbank_hits = []
         if genbank_files == None or len(genbank_files) == 0:
@@ -257,53 +376,68 @@ def main(directory,id,filter,processors,genes,cluster_method,blast,length,
                 os.system("cat *locus_tags.fasta all_gene_seqs.out.tmp > all_gene_seqs.out")
             else:
                 os.system("cat *locus_tags.fasta > all_gene_seqs.out")
-            if blast=="blastp" or blast=="diamond":
-                """Need to convert the locus tags into peptides here"""
-                translate_genes("all_gene_seqs.out","all_genes.pep",0)
-                for infile in glob.glob(os.path.join(fastadir, "*locus_tags.fasta")):
-                    base = os.path.basename(infile)
-                    name = base.replace(".locus_tags.fasta","")
-                    translate_genes(base,"%s.fasta.new_genes.pep" % name,0)
-            else:
-                for hit in genbank_hits:
-                    reduced_hit = hit.replace(".gbk","")
-                    """This is to ensure that genes are aligned back against the genome"""
-                    SeqIO.convert("%s/%s" % (dir_path, hit), "genbank", "%s.fasta.new" % reduced_hit, "fasta")
+            if blast=="blastp" or blast=="diamond" or blast=="blastp-orf":
+                """Need to convert the locus tags into peptides here. The peptides
+                for each GenBank file were already written when it was parsed"""
+                translate_genes("all_gene_seqs.out","all_genes.pep",0,processors)
         if "NULL" in cluster_method:
             print("Clustering chosen, but no method selected...exiting")
             sys.exit()
+        if (blast == "blastp" or blast == "diamond") and "vsearch" not in cluster_method:
+            os.system("cat *new_genes.pep > all_gene_seqs.pep")
+            cluster_input = "all_gene_seqs.pep"
+        else:
+            cluster_input = "all_gene_seqs.out"
+        """identical sequences are only clustered once"""
+        collapse_identical_seqs(cluster_input, "unique_%s" % cluster_input, "collapsed_ids.txt")
+        cluster_input = "unique_%s" % cluster_input
+        novel = 1
+        if len(old_genomes)>0:
+            """only the genes that don't match the previous consensus are clustered"""
+            logPrint("aligning the genes of the new genomes against the previous consensus")
+            for name in os.listdir("%s/previous" % fastadir):
+                os.rename("%s/previous/%s" % (fastadir,name), "%s/%s" % (fastadir,name))
+            os.system("cp %s previous_consensus.fasta" % old_consensus)
+            if blast == "blat":
+                blat_against_self(cluster_input, "previous_consensus.fasta", "previous_consensus_hits.out", processors)
+            else:
+                subprocess.check_call("makeblastdb -in previous_consensus.fasta -dbtype nucl > /dev/null 2>&1", shell=True)
+                if blast == "blastn-short":
+                    blast_against_self_blastn("blastn", "blastn-short", cluster_input, "previous_consensus.fasta", "previous_consensus_hits.out", filter, processors)
+                else:
+                    blast_against_self_blastn("blastn", "megablast", cluster_input, "previous_consensus.fasta", "previous_consensus_hits.out", filter, processors)
+            split_novel_genes(cluster_input, "previous_consensus_hits.out", id, min_len, "novel_genes.out")
+            cluster_input = "novel_genes.out"
+            novel = os.path.getsize(cluster_input)
+        if novel == 0:
+            open("consensus.fasta", "w").close()
         elif "mmseqs" == cluster_method:
             logPrint("clustering with mmseqs at an ID of %s, using %s processors" % (id,processors))
+            run_mmseqs(id, processors, cluster_input, mem_budget)
             if blast == "blastp" or blast == "diamond":
-                os.system("cat *new_genes.pep > all_gene_seqs.pep")
-                run_mmseqs(id, processors, "all_gene_seqs.pep")
                 os.system("mv mmseqs_rep_seq.fasta consensus.pep")
             else:
-                run_mmseqs(id, processors, "all_gene_seqs.out")
                 os.system("mv mmseqs_rep_seq.fasta consensus.fasta")
             logPrint("mmseqs clustering finished")
         elif "mmseqs-lin" == cluster_method:
             logPrint("clustering with mmseqs-linear at an ID of %s, using %s processors" % (id,processors))
+            run_mmseqs_lin(id, processors, cluster_input, mem_budget)
             if blast == "blastp" or blast == "diamond":
-                os.system("cat *new_genes.pep > all_gene_seqs.pep")
-                run_mmseqs_lin(id, processors, "all_gene_seqs.pep")
                 os.system("mv mmseqs_rep_seq.fasta consensus.pep")
             else:
-                run_mmseqs_lin(id, processors, "all_gene_seqs.out")
                 os.system("mv mmseqs_rep_seq.fasta consensus.fasta")
             logPrint("mmseqs-lin clustering finished")
         elif "vsearch" in cluster_method:
             logPrint("clustering with VSEARCH at an ID of %s, using %s processors" % (id,processors))
-            run_vsearch(id, processors, "all_gene_seqs.out")
+            run_vsearch(id, processors, cluster_input)
             os.system("mv vsearch.out consensus.fasta")
             logPrint("VSEARCH clustering finished")
         elif "cd-hit" in cluster_method:
             logPrint("clustering with cd-hit at an ID of %s, length percentage of %s, using %s processors" % (id,min_len,processors))
             if blast == "blastp" or blast == "diamond":
-                os.system("cat *new_genes.pep > all_gene_seqs.pep")
-                subprocess.check_call("cd-hit -i all_gene_seqs.pep -o consensus.pep -M 0 -T %s -c %s -s %s > cdhit.cluster 2>&1" % (processors,id,min_len), shell=True)
+                run_cdhit("cd-hit", id, processors, cluster_input, "consensus.pep", min_len, mem_budget)
             else:
-                subprocess.check_call("cd-hit-est -i all_gene_seqs.out -o consensus.fasta -M 0 -T %s -c %s -s %s > cdhit.cluster 2>&1" % (processors,id,min_len), shell=True)
+                run_cdhit("cd-hit-est", id, processors, cluster_input, "consensus.fasta", min_len, mem_budget)
         """need to check for dups here"""
         if os.path.exists("consensus.fasta"):
             dup_ids = test_duplicate_header_ids("consensus.fasta")
@@ -324,11 +458,50 @@ def main(directory,id,filter,processors,genes,cluster_method,blast,length,
                 os.system("mv tmp.txt consensus.pep")
         else:
             pass
+        """which genomes have a member in each cluster, only needed
+        to skip the alignment or part of the search"""
+        if fast_matrix == "T" or selective_search == "T":
+            if "cd-hit" in cluster_method:
+                if os.path.exists("consensus.pep.clstr"):
+                    membership_file = "consensus.pep.clstr"
+                else:
+                    membership_file = "consensus.fasta.clstr"
+            elif "vsearch" in cluster_method:
+                membership_file = "results.uc"
+            else:
+                membership_file = "mmseqs_cluster.tsv"
+            genome_hashes = genome_gene_hashes(fastadir, cluster_input.endswith(".pep"), processors)
+            if novel == 0:
+                membership = cluster_membership_table({}, cluster_input, genome_hashes, "cluster_membership.txt")
+            else:
+                membership = cluster_membership_table(parse_cluster_membership(membership_file, cluster_method),
+                                                      cluster_input, genome_hashes, "cluster_membership.txt")
+            os.system("cp cluster_membership.txt %s/%s_cluster_membership.txt" % (ap,os.path.basename(fastadir)))
+        if fast_matrix == "T":
+            genome_duplicates = dict([(re.sub(r"\.fasta$","",x), re.sub(r"\.fasta$","",y)) for x,y in duplicate_genomes.items()])
+            genome_names = sorted(set([g for x in genome_hashes.values() for g in x]+list(genome_duplicates.keys())))
+            membership_matrices(membership, genome_names, id, "%s/%s" % (ap,os.path.basename(fastadir)), genome_duplicates)
+            logPrint("presence/absence and approximate BSR matrices built from clustering, alignment skipped")
+            os.chdir("%s" % ap)
+            if "T" != keep:
+                os.system("rm -rf %s" % fastadir)
+            return
+        if len(old_genomes)>0:
+            """the previous consensus keeps its IDs, the new centroids follow it"""
+            novel_centroids = append_novel_centroids("previous_consensus.fasta", "consensus.fasta", "novel_centroids.fasta")
+            logPrint("%s new centroids added to the %s in the previous consensus" % (len(novel_centroids), len(get_cluster_ids("previous_consensus.fasta"))))
         if "tblastn" == blast:
             subprocess.check_call("makeblastdb -in consensus.fasta -dbtype nucl > /dev/null 2>&1", shell=True)
-            translate_genes("consensus.fasta","consensus.pep",0)
+            translate_genes("consensus.fasta","consensus.pep",0,processors)
             clusters = get_cluster_ids("consensus.pep")
             blast_against_self_tblastn("tblastn", "consensus.fasta", "consensus.pep", "tmp_blast.out", processors, filter)
+        elif "blastp-orf" == blast:
+            """the consensus peptides are both the self-score query and the database
+            that the ORFs of each genome are searched against"""
+            translate_genes("consensus.fasta","consensus.pep",0,processors)
+            subprocess.check_call("makeblastdb -in consensus.pep -dbtype prot > /dev/null 2>&1", shell=True)
+            clusters = get_cluster_ids("consensus.pep")
+            blast_against_self_tblastn("blastp", "consensus.pep", "consensus.pep", "tmp_blast.out", processors, filter)
         elif "blastn" == blast:
             subprocess.check_call("makeblastdb -in consensus.fasta -dbtype nucl > /dev/null 2>&1", shell=True)
             blast_against_self_blastn("blastn", "blastn", "consensus.fasta", "consensus.fasta", "tmp_blast.out", filter, processors)
@@ -352,40 +525,62 @@ def main(directory,id,filter,processors,genes,cluster_method,blast,length,
         ref_scores=parse_self_blast("self_blast.out")
         os.system("cp tmp_blast.out ref.scores")
         subprocess.check_call("rm tmp_blast.out self_blast.out", shell=True)
+        selective = None
+        if selective_search == "T":
+            """members must be the same sequence type as the search queries"""
+            if (blast == "blastp" and cluster_input.endswith(".pep")) or \
+               (blast in ["tblastn", "blastn", "blastn-short", "blat"] and not cluster_input.endswith(".pep")):
+                if blast == "tblastn" or blast == "blastp":
+                    selective = write_selective_queries(membership, "consensus.pep", cluster_input, fastadir)
+                else:
+                    selective = write_selective_queries(membership, "consensus.fasta", cluster_input, fastadir)
+            else:
+                logPrint("selective search is not available for %s with %s clustering, searching every genome for every gene" % (blast, cluster_method))
+        queries = selective
+        if len(old_genomes)>0:
+            """old genomes are only searched for the new centroids"""
+            if blast == "tblastn":
+                translate_genes("novel_centroids.fasta","novel_centroids.pep",0,processors)
+                queries = dict([(x, ("novel_centroids.pep",)) for x in old_genomes])
+            else:
+                queries = dict([(x, ("novel_centroids.fasta",)) for x in old_genomes])
         if "tblastn" == blast:
             logPrint("starting tblastn")
-            blast_against_each_genome_tblastn_dev(processors, "consensus.pep", filter)
+            blast_against_each_genome_tblastn_dev(processors, "consensus.pep", filter, split_size, mem_budget, queries)
         elif "blastn" == blast:
             logPrint("starting blastn")
-            blast_against_each_genome_blastn_dev(processors, "blastn", filter, "consensus.fasta")
+            blast_against_each_genome_blastn_dev(processors, "blastn", filter, "consensus.fasta", split_size, mem_budget, queries)
         elif "blastn-short" == blast:
             logPrint("starting blastn-short")
-            blast_against_each_genome_blastn_dev(processors, "blastn-short", filter, "consensus.fasta")
+            blast_against_each_genome_blastn_dev(processors, "blastn-short", filter, "consensus.fasta", split_size, mem_budget, queries)
         elif "blat" == blast:
             logPrint("starting blat")
-            blat_against_each_genome_dev("consensus.fasta",processors)
+            blat_against_each_genome_dev("consensus.fasta",processors,split_size,mem_budget,queries)
         elif "blastp" == blast:
             logPrint("starting blastp")
-            blastp_against_each_annotation("consensus.pep",processors,filter)
+            blastp_against_each_annotation("consensus.pep",processors,filter,split_size,mem_budget,queries)
         elif "diamond" == blast:
             logPrint("starting diamond")
-            diamond_against_each_annotation("consensus.pep",processors)
+            diamond_against_each_annotation("consensus.pep",processors,split_size,mem_budget)
+        elif "blastp-orf" == blast:
+            logPrint("starting blastp of ORFs against consensus")
+            blastp_orfs_against_consensus("consensus.pep",processors,filter,split_size,mem_budget)
         else:
             pass
+        if selective is not None:
+            logPrint("aligning genes against their cluster members")
+            search_cluster_members(blast, selective, filter, processors, fastadir)
     else:
         #########This section focuses on providing your own genes with -g############
         logPrint("Using pre-compiled set of predicted genes")
-        files = glob.glob(os.path.join(dir_path,"*.fasta"))
-        genbank_files = glob.glob(os.path.join(dir_path,"*.gbk"))
+        files = glob.glob(os.path.join(dir_path,"*.fasta"))+glob.glob(os.path.join(dir_path,"*.fasta.gz"))
+        genbank_files = glob.glob(os.path.join(dir_path,"*.gbk"))+glob.glob(os.path.join(dir_path,"*.gbk.gz"))
         pep_files = glob.glob(os.path.join(dir_path,".pep"))
         if len(genbank_files)>0:
-            for hit in genbank_files:
-                base = os.path.basename(hit)
-                reduced_hit = base.replace(".gbk","")
-                """This is to ensure that genes are aligned back against the genome"""
-                os.chdir(fastadir)
-                SeqIO.convert("%s/%s" % (dir_path, base), "genbank", "%s.fasta.new" % reduced_hit, "fasta")
-                os.chdir(start_dir)
+            """This is to ensure that genes are aligned back against the genome"""
+            os.chdir(fastadir)
+            process_genbank_files(dir_path, processors, False, False, True)
+            os.chdir(start_dir)
         if len(pep_refs)>0:
             for hit in pep_files:
                 base = os.path.basename(hit)
@@ -396,15 +591,27 @@ def main(directory,id,filter,processors,genes,cluster_method,blast,length,
             sys.exit()
         gene_path = os.path.abspath("%s" % genes)
         """new method: aa,nt,unknown"""
-        data_type = find_data_type(gene_path)
-        dup_ids = test_duplicate_header_ids(gene_path)
-        if dup_ids == "True":
-            pass
-        elif dup_ids == "False":
+        gene_stats = input_stats[os.path.basename(gene_path)]
+        data_type = gene_stats["type"]
+        if len(gene_stats["duplicates"])>0:
             print("duplicate headers identified, exiting..")
             sys.exit()
+        if len(old_genomes)>0:
+            """genes that are already rows of the previous matrix aren't screened again"""
+            old_genes = set(read_matrix_centroids(update))
+            new_genes = write_fasta("%s/new_%s" % (fastadir,os.path.basename(gene_path)),
+                                    [(name, seq) for name, seq in read_fasta(gene_path) if name not in old_genes])
+            logPrint("%s genes are new, %s are in the previous matrix" % (new_genes, gene_stats["records"]-new_genes))
+            if new_genes == 0:
+                print("all genes are already in the previous matrix, nothing to do")
+                os.system("rm -rf %s" % fastadir)
+                sys.exit()
+            gene_path = "%s/new_%s" % (fastadir,os.path.basename(gene_path))
         clusters = get_cluster_ids(gene_path)
         os.chdir("%s" % fastadir)
+        """identical genes are only aligned once, their hits are copied back after the search"""
+        collapsed_genes = collapse_identical_seqs(gene_path, "%s/unique_%s" % (fastadir,os.path.basename(gene_path)), "collapsed_ids.txt")
+        gene_path = "%s/unique_%s" % (fastadir,os.path.basename(gene_path))
         if gene_path.endswith(".pep"):
             if data_type == "aa":
                 pass
@@ -412,7 +619,7 @@ def main(directory,id,filter,processors,genes,cluster_method,blast,length,
                 print("File is supposed to contain proteins, but doesn't look correct..exiting")
                 sys.exit()
             os.system("cp %s %s/genes.pep" % (gene_path,fastadir))
-            if blast=="tblastn" or blast=="blastp":
+            if blast=="tblastn" or blast=="blastp" or blast=="blastp-orf":
                 logPrint("using %s on peptides" % blast)
                 try:
                     subprocess.check_call("makeblastdb -in genes.pep -dbtype prot > /dev/null 2>&1", shell=True)
@@ -433,7 +640,7 @@ def main(directory,id,filter,processors,genes,cluster_method,blast,length,
             #Aligning back against each genome
             if blast == "tblastn":
                 logPrint("starting TBLASTN")
-                blast_against_each_genome_tblastn_dev(processors,gene_path,filter)
+                blast_against_each_genome_tblastn_dev(processors,gene_path,filter,split_size,mem_budget)
             elif blast == "blastp":
                 """I will need to first do gene prediction for each genome"""
                 #First, check to see if the genomes are nt or pep
@@ -446,30 +653,34 @@ def main(directory,id,filter,processors,genes,cluster_method,blast,length,
                         name=get_seq_name(infile)
                         os.link(infile,"%s/%s.new" % (fastadir,name))
                     logPrint("Predicting genes with Prodigal")
-                    predict_genes(fastadir, processors, intergenics)
+                    predict_genes(fastadir, processors, intergenics, split_size, mem_budget, annotations, prodigal_training, compare_training)
                 logPrint("BlastP starting")
                 #This script might need to be modified to fit with peptide "genomes"
-                blastp_against_each_annotation(gene_path,processors,filter)
+                blastp_against_each_annotation(gene_path,processors,filter,split_size,mem_budget)
             elif blast == "diamond":
                 for infile in glob.glob(os.path.join(dir_path, '*.fasta')):
                     name=get_seq_name(infile)
                 logPrint("Predicting genes with Prodigal")
-                predict_genes(fastadir, processors, intergenics)
+                predict_genes(fastadir, processors, intergenics, split_size, mem_budget, annotations, prodigal_training, compare_training)
                 logPrint("Diamond starting")
-                diamond_against_each_annotation(gene_path,processors)
+                diamond_against_each_annotation(gene_path,processors,split_size,mem_budget)
+            elif blast == "blastp-orf":
+                logPrint("Predicting genes with Prodigal")
+                predict_genes(fastadir, processors, intergenics, split_size, mem_budget, annotations, prodigal_training, compare_training)
+                logPrint("BlastP of ORFs starting")
+                blastp_orfs_against_consensus("genes.pep",processors,filter,split_size,mem_budget)
         elif gene_path.endswith(".fasta"):
             if data_type == "nt":
                 pass
             else:
                 print("File is supposed to contain nucleotides, but doesn't look correct..exiting ")
                 sys.exit()
-            os.system("cp %s %s" % (gene_path,fastadir))
             if blast == "diamond" or blast == "blastp":
                 print("protein alignment not compatible with nucleotide input..exiting")
                 sys.exit()
             if "tblastn" == blast:
                 logPrint("using tblastn")
-                translate_genes(gene_path,"genes.pep",0)
+                translate_genes(gene_path,"genes.pep",0,processors)
                 try:
                     subprocess.check_call("makeblastdb -in %s -dbtype nucl > /dev/null 2>&1" % gene_path, shell=True)
                 except:
@@ -477,7 +688,21 @@ def main(directory,id,filter,processors,genes,cluster_method,blast,length,
                     sys.exit()
                 blast_against_self_tblastn("tblastn", gene_path, "genes.pep", "tmp_blast.out", processors, filter)
                 logPrint("starting BLAST")
-                blast_against_each_genome_tblastn_dev(processors, "genes.pep", filter)
+                blast_against_each_genome_tblastn_dev(processors, "genes.pep", filter, split_size, mem_budget)
+                os.system("cp genes.pep %s" % start_dir)
+            elif "blastp-orf" == blast:
+                logPrint("using blastp of ORFs against genes")
+                translate_genes(gene_path,"genes.pep",0,processors)
+                try:
+                    subprocess.check_call("makeblastdb -in genes.pep -dbtype prot > /dev/null 2>&1", shell=True)
+                except:
+                    logPrint("problem encountered with BLAST database")
+                    sys.exit()
+                blast_against_self_tblastn("blastp", "genes.pep", "genes.pep", "tmp_blast.out", processors, filter)
+                logPrint("Predicting genes with Prodigal")
+                predict_genes(fastadir, processors, intergenics, split_size, mem_budget, annotations, prodigal_training, compare_training)
+                logPrint("starting BLAST")
+                blastp_orfs_against_consensus("genes.pep",processors,filter,split_size,mem_budget)
                 os.system("cp genes.pep %s" % start_dir)
             elif "blastn" == blast:
                 logPrint("using blastn")
@@ -493,7 +718,7 @@ def main(directory,id,filter,processors,genes,cluster_method,blast,length,
                     sys.exit()
                 logPrint("starting BLAST")
                 try:
-                    blast_against_each_genome_blastn_dev(processors,"blastn",filter,gene_path)
+                    blast_against_each_genome_blastn_dev(processors,"blastn",filter,gene_path,split_size,mem_budget)
                 except:
                     print("problem with blastn, exiting")
                     sys.exit()
@@ -511,7 +736,7 @@ def main(directory,id,filter,processors,genes,cluster_method,blast,length,
                     sys.exit()
                 logPrint("starting BLAST")
                 try:
-                    blast_against_each_genome_blastn_dev(processors,"blastn-short",filter,gene_path)
+                    blast_against_each_genome_blastn_dev(processors,"blastn-short",filter,gene_path,split_size,mem_budget)
                 except:
                     print("problem with blastn-short, exiting")
                     sys.exit()
@@ -519,12 +744,16 @@ def main(directory,id,filter,processors,genes,cluster_method,blast,length,
                 logPrint("using blat")
                 blat_against_self(gene_path, gene_path, "tmp_blast.out", processors)
                 logPrint("starting BLAT")
-                blat_against_each_genome_dev(gene_path,processors)
+                blat_against_each_genome_dev(gene_path,processors,split_size,mem_budget)
             else:
                 pass
         else:
             print("input file format not supported")
             sys.exit()
+        """the self-scores and each genome's hits"""
+        fan_out_hits("tmp_blast.out", collapsed_genes)
+        for infile in glob.glob(os.path.join(fastadir, "*.new_blast.out")):
+            fan_out_hits(infile, collapsed_genes)
         subprocess.check_call("sort -u -k 1,1 tmp_blast.out > self_blast.out", shell=True)
         os.system("cp self_blast.out ref.scores")
         ref_scores=parse_self_blast("self_blast.out")
@@ -536,38 +765,66 @@ def main(directory,id,filter,processors,genes,cluster_method,blast,length,
         logPrint("Diamond complete")
     else:
         logPrint("BLAST done")
+    copy_duplicate_hits(duplicate_genomes, fastadir)
     if dup_toggle == "T":
         logPrint("Finding duplicates")
         find_dups_dev(ref_scores, length, max_plog, min_hlog, clusters, processors)
         logPrint("Finding duplicates complete")
     else:
         logPrint("Duplicate searching turned off")
-    parse_blast_report_dev("false",4)
     curr_dir=os.getcwd()
+    if hit_store == "T":
+        """every hit is kept, so the matrices can be rebuilt with other duplicate settings"""
+        share_gene_index(clusters, ref_scores)
+        parse_blast_report_dev("false",4,True,hit_matrices == "T")
+        if "NULL" in prefix:
+            store = "%s/%s_hit_store.bin" % (start_dir,"".join(rename))
+        else:
+            store = "%s/%s_hit_store.bin" % (start_dir,prefix)
+        num_hits = write_hit_store(glob.glob(os.path.join(curr_dir, "*_blast.out.hits")), store)
+        logPrint("%s hits kept in %s" % (num_hits, store))
+    else:
+        parse_blast_report_dev("false",4,False,hit_matrices == "T")
     table_files = glob.glob(os.path.join(curr_dir, "*.filtered.unique"))
-    files_and_temp_names = [(str(idx), os.path.join(curr_dir, f))
-                            for idx, f in enumerate(table_files)]
-    names=[]
-    table_list = []
-    nr_sorted=sorted(clusters)
-    centroid_list = []
-    centroid_list.append(" ")
-    for x in nr_sorted:
-        centroid_list.append(x)
-    table_list.append(centroid_list)
     logPrint("starting matrix building")
-    new_names,new_table = new_loop_dev(files_and_temp_names, processors, clusters)
-    new_table_list = table_list+new_table
-    open("ref.list", "a").write("\n")
-    for x in nr_sorted:
-        open("ref.list", "a").write("%s\n" % x)
+    metric_files = {}
+    if hit_matrices == "T":
+        """identity, aligned length and number of hits of the best hits, in the layout of the BSR matrix"""
+        if "NULL" in prefix:
+            matrix_prefix = "%s/%s" % (start_dir,"".join(rename))
+        else:
+            matrix_prefix = "%s/%s" % (start_dir,prefix)
+        metric_files = {"identity":"%s_identity_matrix.txt" % matrix_prefix,
+                        "length":"%s_aligned_length_matrix.txt" % matrix_prefix,
+                        "hits":"%s_hit_count_matrix.txt" % matrix_prefix}
+    if int(mem_budget)>0:
+        """the matrix is written out in blocks of rows that use up to a quarter of the budget"""
+        new_names = build_bsr_matrix(table_files, processors, clusters, ref_scores, "%s/bsr_matrix_values.txt" % start_dir,
+                                     min(256, max(float(mem_budget)/4, 1)), metric_files)
+    else:
+        new_names = build_bsr_matrix(table_files, processors, clusters, ref_scores, "%s/bsr_matrix_values.txt" % start_dir,
+                                     metric_files=metric_files)
     names_out = open("names.txt", "w")
-    names_redux = [val for subl in new_names for val in subl]
-    for x in names_redux: names_out.write("".join(x)+"\n")
+    for x in new_names: names_out.write(x+"\n")
     names_out.close()
-    create_bsr_matrix_dev(new_table_list)
-    divide_values("bsr_matrix",ref_scores)
-    subprocess.check_call("paste ref.list BSR_matrix_values.txt > %s/bsr_matrix_values.txt" % start_dir, shell=True)
+    if len(old_genomes)>0:
+        """values of the previous matrix are kept as they were"""
+        num_genomes, num_centroids = merge_update_matrix(update, "%s/bsr_matrix_values.txt" % start_dir, "%s/bsr_matrix_values.txt" % start_dir,
+                                                         "null" not in genes)
+        logPrint("updated matrix has %s centroids and %s genomes" % (num_centroids, num_genomes))
+        if dup_toggle == "T":
+            """copy numbers of the previous run are kept the same way, and the duplicates found again from all of them"""
+            merge_update_matrix(old_dups, "dup_matrix.txt", "dup_matrix.txt", "null" not in genes, "ID", "0")
+            write_duplicate_ids("dup_matrix.txt", "duplicate_ids.txt")
+    if os.path.exists(MEMORY_LOG):
+        if "NULL" in prefix:
+            os.system("cp %s %s/%s_memory_usage.txt" % (MEMORY_LOG,ap,"".join(rename)))
+        else:
+            os.system("cp %s %s/%s_memory_usage.txt" % (MEMORY_LOG,ap,prefix))
+    if os.path.exists("%s/collapsed_ids.txt" % fastadir):
+        os.system("cp %s/collapsed_ids.txt %s/%s_collapsed_ids.txt" % (fastadir,ap,os.path.basename(fastadir)))
+    if os.path.exists("%s/prodigal_training_report.txt" % fastadir):
+        os.system("cp %s/prodigal_training_report.txt %s/%s_prodigal_training_report.txt" % (fastadir,ap,os.path.basename(fastadir)))
     try:
         if dup_toggle == "T":
             subprocess.check_call("cp dup_matrix.txt names.txt consensus.pep duplicate_ids.txt consensus.fasta %s" % ap, shell=True, stderr=open(os.devnull, 'w'))
@@ -593,6 +850,9 @@ def main(directory,id,filter,processors,genes,cluster_method,blast,length,
             pass
         os.system("mv names.txt %s_names.txt" % "".join(rename))
         os.system("mv bsr_matrix_values.txt %s_bsr_matrix.txt" % "".join(rename))
+        if "F" != sparse_matrix:
+            kept = write_sparse_matrix("%s_bsr_matrix.txt" % "".join(rename), "%s_bsr_matrix.csr" % "".join(rename), float(sparse_matrix))
+            logPrint("%s values kept in the sparse matrix" % kept)
         if os.path.isfile("consensus.fasta"):
             os.system("mv consensus.fasta %s_consensus.fasta" % "".join(rename))
         if os.path.isfile("consensus.pep"):
@@ -605,6 +865,9 @@ def main(directory,id,filter,processors,genes,cluster_method,blast,length,
             pass
         os.system("mv names.txt %s_names.txt" % prefix)
         os.system("mv bsr_matrix_values.txt %s_bsr_matrix.txt" % prefix)
+        if "F" != sparse_matrix:
+            kept = write_sparse_matrix("%s_bsr_matrix.txt" % prefix, "%s_bsr_matrix.csr" % prefix, float(sparse_matrix))
+            logPrint("%s values kept in the sparse matrix" % kept)
         if os.path.isfile("consensus.fasta"):
             os.system("mv consensus.fasta %s_consensus.fasta" % prefix)
         if os.path.isfile("consensus.pep"):
@@ -630,9 +893,24 @@ def main(directory,id,filter,processors,genes,cluster_method,blast,length,
     outfile.write("-x %s \\\n" % prefix)
     outfile.write("-y %s \\\n" % intergenics)
     outfile.write("-ml %s \\\n" % min_len)
-    outfile.write("-z %s\n" % dup_toggle)
+    outfile.write("-z %s \\\n" % dup_toggle)
+    outfile.write("--split_size %s \\\n" % split_size)
+    outfile.write("--mem_budget %s \\\n" % mem_budget)
+    outfile.write("--mem_profile %s \\\n" % mem_profile)
+    outfile.write("--prodigal_training %s \\\n" % prodigal_training)
+    outfile.write("--compare_training %s \\\n" % compare_training)
+    outfile.write("--fast_matrix %s \\\n" % fast_matrix)
+    outfile.write("--selective_search %s \\\n" % selective_search)
+    outfile.write("--update %s \\\n" % update)
+    outfile.write("--db_cache %s \\\n" % db_cache)
+    outfile.write("--tool_timeout %s \\\n" % tool_timeout)
+    outfile.write("--tool_retries %s \\\n" % tool_retries)
+    outfile.write("--sparse_matrix %s \\\n" % sparse_matrix)
+    outfile.write("--hit_matrices %s \\\n" % hit_matrices)
+    outfile.write("--hit_store %s\n" % hit_store)
     outfile.write("temp data stored here if kept: %s" % fastadir)
     outfile.close()
+    close_worker_pool()
     logPrint("all Done")
     if "T" == keep:
         pass
@@ -661,7 +939,7 @@ if __name__ == "__main__":
                       help="Clustering method to use: choose from mmseqs, mmseqs-lin, vsearch, cd-hit",
                       type="string", default="null")
     parser.add_option("-b", "--blast", dest="blast", action="callback", callback=test_blast,
-                      help="use tblastn, blastn, blastp, blastn-short, diamond, or blat (nucleotide search only), default is tblastn",
+                      help="use tblastn, blastn, blastp, blastn-short, diamond, blastp-orf, or blat (nucleotide search only), default is tblastn",
                       default="tblastn", type="string")
     parser.add_option("-l", "--length", dest="length", action="store",
                       help="minimum BSR value to be called a duplicate, defaults to 0.7",
@@ -696,6 +974,48 @@ if __name__ == "__main__":
     parser.add_option("-z", "--dup_toggle", dest="dup_toggle", action="callback",
                       help="Perform duplicate searching? T or F; Defaults to F",
                       default="F", type="string", callback=test_filter)
+    parser.add_option("--split_size", dest="split_size", action="store",
+                      help="genomes larger than this size (bytes) are split into contig batches, defaults to 0 (off)",
+                      default="0", type="int")
+    parser.add_option("--mem_budget", dest="mem_budget", action="store",
+                      help="memory budget (MB) for parallel Prodigal, alignment and clustering jobs, 0 for unlimited, defaults to 0",
+                      default="0", type="int")
+    parser.add_option("--mem_profile", dest="mem_profile", action="callback", callback=test_file,
+                      help="memory_usage.txt file from a previous run, used to estimate memory use of each job",
+                      type="string", default="null")
+    parser.add_option("--prodigal_training", dest="prodigal_training", action="callback", callback=test_training,
+                      help="train Prodigal once and use it for every genome: T to train on a subset of the genomes, or a genome to train on. Defaults to F (train on each genome)",
+                      type="string", default="F")
+    parser.add_option("--compare_training", dest="compare_training", action="callback", callback=test_filter,
+                      help="with --prodigal_training, also run Prodigal trained on each genome for the first 3 genomes and compare? T or F; Defaults to F",
+                      type="string", default="F")
+    parser.add_option("--fast_matrix", dest="fast_matrix", action="callback", callback=test_filter,
+                      help="build presence/absence and approximate BSR matrices from clustering alone, skipping alignment? T or F; Defaults to F",
+                      type="string", default="F")
+    parser.add_option("--selective_search", dest="selective_search", action="callback", callback=test_filter,
+                      help="only search genomes for the genes that clustering found no member for, aligning the rest against their members? T or F; Defaults to F",
+                      type="string", default="F")
+    parser.add_option("--update", dest="update", action="callback", callback=test_file,
+                      help="BSR matrix from a previous run. De novo: add the genomes in the directory that it doesn't have. With -g: add the genes that it doesn't have",
+                      type="string", default="null")
+    parser.add_option("--db_cache", dest="db_cache", action="store",
+                      help="directory to keep the BLAST database of each genome in, for reuse by later runs",
+                      type="string", default="null")
+    parser.add_option("--tool_timeout", dest="tool_timeout", action="store",
+                      help="seconds before a Prodigal, alignment or database job is killed, 0 for no limit, defaults to 0",
+                      default="0", type="int")
+    parser.add_option("--tool_retries", dest="tool_retries", action="store",
+                      help="number of times a failed Prodigal, alignment or database job is run again, defaults to 0",
+                      default="0", type="int")
+    parser.add_option("--sparse_matrix", dest="sparse_matrix", action="store",
+                      help="also write the matrix in sparse form, leaving out values below this BSR (0 keeps every value above 0), F to turn off. Defaults to F",
+                      type="string", default="F")
+    parser.add_option("--hit_matrices", dest="hit_matrices", action="callback", callback=test_filter,
+                      help="also write the identity, aligned length and number of hits of the best hit of each gene as matrices? T or F; Defaults to F",
+                      type="string", default="F")
+    parser.add_option("--hit_store", dest="hit_store", action="callback", callback=test_filter,
+                      help="keep every hit in a compressed store, to rebuild the matrices with rebuild_BSR_matrix.py? T or F; Defaults to F",
+                      type="string", default="F")
     options, args = parser.parse_args()
 
     mandatories = ["directory"]
@@ -707,4 +1027,8 @@ if __name__ == "__main__":
 
     main(options.directory,options.id,options.filter,options.processors,options.genes,options.cluster_method,options.blast,
          options.length,options.max_plog,options.min_hlog,options.f_plog,options.keep,options.filter_peps,
-         options.filter_scaffolds,options.prefix,options.intergenics,options.min_len,options.dup_toggle)
+         options.filter_scaffolds,options.prefix,options.intergenics,options.min_len,options.dup_toggle,
+         options.split_size,options.mem_budget,options.mem_profile,options.prodigal_training,
+         options.compare_training,options.fast_matrix,options.selective_search,options.update,options.db_cache,
+         options.tool_timeout,options.tool_retries,options.sparse_matrix,options.hit_matrices,
+         options.hit_store)
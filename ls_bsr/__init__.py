@@ -9,4 +9,4 @@ __email__ = "jsahl@tgen.org"
 __status__ = "Development"
 __version__ = "1.0.3"
 
-__all__ = ['util']
+__all__ = ['util', 'fasta']
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+"""Lightweight FASTA reading and writing. Records are handled as
+(id, sequence) pairs instead of SeqRecord objects"""
+
+import os
+import mmap
+import gzip
+
+def is_compressed(path):
+    """gzip and bgzip files start with the gzip magic bytes, whatever
+    their name (genomes are linked into the run as .fasta.new)"""
+    with open(path, "rb") as infile:
+        return infile.read(2) == b"\x1f\x8b"
+
+def open_input(path, mode="r"):
+    """open a file that may be gzip or bgzip compressed"""
+    if is_compressed(path):
+        if "b" in mode:
+            return gzip.open(path, mode)
+        return gzip.open(path, mode+"t")
+    return open(path, mode)
+
+def read_fasta(in_fasta, start=0, end=None, copy_to=None):
+    """yield (id, sequence bytes) for every record that starts between the
+    start and end byte offsets of a FASTA file. The file is memory mapped,
+    so nothing is read that isn't part of a record. Compressed files are
+    read as a stream, one record at a time, and always from the start.
+    With copy_to, a compressed file is also written out there, decompressed,
+    as it is read"""
+    if is_compressed(in_fasta):
+        with gzip.open(in_fasta, "rb") as infile:
+            if copy_to is None:
+                for record in _read_fasta_stream(infile):
+                    yield record
+                return
+            with open(copy_to, "wb", 1048576) as output_handle:
+                for record in _read_fasta_stream(_copy_lines(infile, output_handle)):
+                    yield record
+        return
+    with open(in_fasta, "rb") as infile:
+        try:
+            data = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            """empty files can't be mapped"""
+            return
+        try:
+            for record in _read_fasta_data(data, start, end):
+                yield record
+        finally:
+            data.close()
+
+def _copy_lines(infile, output_handle):
+    for line in infile:
+        output_handle.write(line)
+        yield line
+
+def _read_fasta_stream(infile):
+    name = None
+    seq = []
+    for line in infile:
+        if line.startswith(b">"):
+            if name is not None:
+                yield name, b"".join(seq)
+            fields = line[1:].split(None, 1)
+            if len(fields) == 0:
+                name = ""
+            else:
+                name = fields[0].decode()
+            seq = []
+        elif name is not None:
+            seq.append(b"".join(line.split()))
+    if name is not None:
+        yield name, b"".join(seq)
+
+def _read_fasta_data(data, start, end):
+    if end is None:
+        end = len(data)
+    pos = start
+    if data[pos:pos+1] != b">":
+        """anything before the first header is not a record"""
+        pos = data.find(b"\n>", pos, end)
+        if pos == -1:
+            return
+        pos += 1
+    while pos < end:
+        next_pos = data.find(b"\n>", pos, end)
+        if next_pos == -1:
+            next_pos = end
+        header, _, seq = data[pos+1:next_pos].partition(b"\n")
+        fields = header.split(None, 1)
+        if len(fields) == 0:
+            name = ""
+        else:
+            name = fields[0].decode()
+        yield name, b"".join(seq.split())
+        pos = next_pos+1
+
+def write_fasta(out_fasta, records):
+    """write (id, sequence) records through a large buffer, one line per
+    sequence. Sequences can be bytes or strings. Returns the number written"""
+    count = 0
+    with open(out_fasta, "wb", 1048576) as outfile:
+        for name, seq in records:
+            if not isinstance(seq, bytes):
+                seq = seq.encode()
+            outfile.write(b">"+name.encode()+b"\n"+seq+b"\n")
+            count += 1
+    return count
+
+def fasta_chunk_offsets(in_fasta, chunks):
+    """split a FASTA file into byte ranges that each start on a header"""
+    size = os.path.getsize(in_fasta)
+    offsets = [0]
+    with open(in_fasta, "rb") as infile:
+        for i in range(1, int(chunks)):
+            """start one byte early, so a header right on the boundary is kept"""
+            infile.seek(max(size*i//int(chunks)-1, 0))
+            infile.readline()
+            while True:
+                pos = infile.tell()
+                line = infile.readline()
+                if not line:
+                    pos = size
+                    break
+                if line.startswith(b">"):
+                    break
+            if pos > offsets[-1] and pos < size:
+                offsets.append(pos)
+    offsets.append(size)
+    return list(zip(offsets[:-1], offsets[1:]))
@@ -11,89 +11,381 @@ from subprocess import Popen
 import shlex
 from subprocess import call
 import random
+import re
+import shutil
+import hashlib
 import collections
 try:
     from Bio.SeqRecord import SeqRecord
+    from Bio.Seq import Seq
+    from Bio.Data import CodonTable
     import Bio
     from Bio import SeqIO
     from Bio import Phylo
 except:
     print("BioPython is not in your PATH, but needs to be")
     sys.exit()
+from ls_bsr.fasta import read_fasta, write_fasta, fasta_chunk_offsets, open_input, is_compressed
 import errno
 import threading
+import atexit
+import asyncio
+import signal
+import tempfile
+import zlib
+import gzip
 import types
 from collections import deque,OrderedDict
-import collections
+from array import array
 
 def mp_shell(func, params, numProc):
-    from multiprocessing import Pool
-    p = Pool(numProc)
-    out = p.map(func, params)
-    p.terminate()
+    """run func over params in parallel, on the worker pool of the run"""
+    p = get_worker_pool(numProc)
+    cwd = os.getcwd()
+    return p.map(_perform_pool_job, [(cwd, func, x) for x in params])
+
+"""The pool is started on first use and kept for every parallel stage of
+the run, instead of forking a new one (from a parent that may hold large
+dicts by then) for each stage. Read-only state that the workers need,
+such as the gene index and self-scores, is loaded when they start"""
+_worker_pool = {}
+_worker_state = {}
+
+def _init_worker(state):
+    _worker_state.clear()
+    _worker_state.update(state)
+
+def _perform_pool_job(data):
+    """workers keep the directory they were started in, so each job
+    runs in the directory it was submitted from"""
+    cwd, func, params = data
+    os.chdir(cwd)
+    return func(params)
+
+def get_worker_pool(numProc):
+    """the worker pool of the run, started with the shared state"""
+    if _worker_pool.get("pid") != os.getpid() or _worker_pool.get("size") != numProc:
+        close_worker_pool()
+        from multiprocessing import Pool
+        _worker_pool["pool"] = Pool(numProc, _init_worker, (dict(_worker_state),))
+        _worker_pool["size"] = numProc
+        _worker_pool["pid"] = os.getpid()
+    return _worker_pool["pool"]
+
+def close_worker_pool():
+    if _worker_pool.get("pid") == os.getpid():
+        _worker_pool["pool"].terminate()
+        _worker_pool["pool"].join()
+    _worker_pool.clear()
+
+atexit.register(close_worker_pool)
+
+def share_worker_state(**state):
+    """replace the read-only state of the workers. Workers only load it when
+    they start, so the pool is restarted the next time it's used"""
+    _worker_state.clear()
+    _worker_state.update(state)
+    close_worker_pool()
+
+def share_gene_index(clusters, ref_scores):
+    """share the row of each cluster (in sorted order) and its self-score
+    (0 if there isn't one) with the workers, unless they already have them"""
+    if _worker_state.get("clusters") is clusters and _worker_state.get("ref_scores") is ref_scores:
+        return
+    rows = sorted(clusters)
+    refs = []
+    for cluster in rows:
+        try:
+            refs.append(float(ref_scores.get(cluster)))
+        except (TypeError, ValueError):
+            refs.append(0.0)
+    share_worker_state(clusters=clusters, ref_scores=ref_scores, rows=rows,
+                       index=dict([(cluster, i) for i, cluster in enumerate(rows)]), refs=refs)
+
+"""Starting point for the peak memory (MB) of each job type, as
+(fixed MB, MB per MB of input). These are replaced by what is measured"""
+MEMORY_MODELS = {"_prodigal_workflow_def":(50, 10),
+                 "_prodigal_workflow_inter":(50, 10),
+                 "_perform_workflow_blat_genome":(100, 10),
+                 "_perform_workflow_tblastn":(100, 5),
+                 "_perform_workflow_blastn":(100, 5),
+                 "_perform_workflow_blastp":(100, 5),
+                 "_perform_workflow_blastp_orf":(100, 5),
+                 "_perform_workflow_diamond":(1000, 20),
+                 "mmseqs":(1000, 20),
+                 "mmseqs-lin":(500, 10),
+                 "vsearch":(100, 10),
+                 "cd-hit":(100, 10),
+                 "cd-hit-est":(100, 10)}
+MEMORY_RATIOS = {}
+MEMORY_LOG = "memory_usage.txt"
+_job_peak_rss = [0]
+INPUT_STATS = {}
+BLAST_DB_CACHE = [None]
+
+def run_measured(cmd, shell=False, check=False):
+    """run an external command, discarding its output, and keep track of
+    its peak RSS (including the children it waits on) for the current job"""
+    devnull = open(os.devnull, "w")
+    p = Popen(cmd, shell=shell, stdout=devnull, stderr=devnull)
+    pid, status, usage = os.wait4(p.pid, 0)
+    devnull.close()
+    if os.WIFSIGNALED(status):
+        p.returncode = -os.WTERMSIG(status)
+    else:
+        p.returncode = os.WEXITSTATUS(status)
+    if sys.platform == "darwin":
+        """reported in bytes on OS X, KB everywhere else"""
+        peak = usage.ru_maxrss/1024
+    else:
+        peak = usage.ru_maxrss
+    _job_peak_rss[0] = max(_job_peak_rss[0], int(peak))
+    if check and p.returncode != 0:
+        raise subprocess.CalledProcessError(p.returncode, cmd)
+    return p.returncode
+
+def get_job_sizes(files_and_temp_names, query=None):
+    """input size (bytes) of each job, used to estimate its peak memory"""
+    sizes = []
+    for data in files_and_temp_names:
+        stats = INPUT_STATS.get(re.sub(r"\.new$", "", os.path.basename(data[1])))
+        if stats is not None:
+            """sequence length from the preflight check, without headers or line breaks"""
+            size = stats["length"]
+        else:
+            size = os.path.getsize(data[1])
+        if query is not None and os.path.exists(query):
+            size += os.path.getsize(query)
+        sizes.append(size)
+    return sizes
+
+def estimate_job_memory(tool, input_size):
+    """estimated peak memory (MB) of a job, from the size of its input (bytes)"""
+    base, ratio = MEMORY_MODELS.get(tool, (100, 10))
+    ratio = MEMORY_RATIOS.get(tool, ratio)
+    return base + ratio * (float(input_size)/1048576)
+
+def record_job_memory(tool, job, input_size, estimate, peak_kb):
+    """log the measured peak of a job and update the estimate for the
+    next jobs of the same type"""
+    peak = float(peak_kb)/1024
+    input_mb = float(input_size)/1048576
+    base, ratio = MEMORY_MODELS.get(tool, (100, 10))
+    if input_mb > 0:
+        observed = max((peak-base)/input_mb, 0)
+        if tool in MEMORY_RATIOS:
+            MEMORY_RATIOS[tool] = max(MEMORY_RATIOS[tool], observed)
+        else:
+            MEMORY_RATIOS[tool] = observed
+    with open(MEMORY_LOG, "a") as outfile:
+        outfile.write("%s\t%s\t%.2f\t%.1f\t%.1f\n" % (tool, get_seq_name(str(job)), input_mb, estimate, peak))
+
+def load_memory_profile(infile):
+    """seed the memory estimates with the peaks measured in a previous run"""
+    with open(infile) as my_log:
+        for line in my_log:
+            fields = line.split()
+            try:
+                tool = fields[0]
+                input_mb = float(fields[2])
+                peak = float(fields[4])
+            except (IndexError, ValueError):
+                raise TypeError("malformed memory log line: %s" % line)
+            base, ratio = MEMORY_MODELS.get(tool, (100, 10))
+            if input_mb > 0:
+                observed = max((peak-base)/input_mb, 0)
+                MEMORY_RATIOS[tool] = max(MEMORY_RATIOS.get(tool, 0), observed)
+    return MEMORY_RATIOS
+
+"""Limits for each command run by run_tool_jobs: seconds before it is
+killed (0 for no limit) and how many times a failed command is run again"""
+TOOL_LIMITS = {"timeout":0, "retries":0}
+
+def _checked(cmd, shell=False):
+    """a tool job step that raises if the command fails"""
+    returncode = yield (cmd, shell)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd)
+    return returncode
+
+def _kill_tool(p):
+    try:
+        os.killpg(p.pid, signal.SIGKILL)
+    except OSError:
+        pass
+    pid, status, usage = os.wait4(p.pid, 0)
+    p.returncode = -signal.SIGKILL
+
+async def _run_tool_command(cmd, shell, peak):
+    """start a command and poll for its exit with wait4, so that its peak
+    RSS is known. stderr is kept and logged if the command fails. Commands
+    that run past the timeout are killed, along with their children"""
+    timeout = float(TOOL_LIMITS["timeout"])
+    retries = int(TOOL_LIMITS["retries"])
+    for attempt in range(retries+1):
+        with tempfile.TemporaryFile() as errors:
+            try:
+                p = Popen(cmd, shell=shell, stdout=subprocess.DEVNULL, stderr=errors, start_new_session=True)
+            except OSError as error:
+                logPrint("cannot run %s: %s" % (cmd if shell else " ".join(cmd), error))
+                return 127
+            start = time.time()
+            delay = 0.01
+            timed_out = False
+            try:
+                while True:
+                    pid, status, usage = os.wait4(p.pid, os.WNOHANG)
+                    if pid != 0:
+                        break
+                    if timeout > 0 and time.time()-start > timeout:
+                        timed_out = True
+                        _kill_tool(p)
+                        break
+                    await asyncio.sleep(delay)
+                    delay = min(delay*2, 0.5)
+            except BaseException:
+                """cancelled: nothing is left running"""
+                _kill_tool(p)
+                raise
+            if timed_out:
+                returncode = p.returncode
+            else:
+                if os.WIFSIGNALED(status):
+                    p.returncode = -os.WTERMSIG(status)
+                else:
+                    p.returncode = os.WEXITSTATUS(status)
+                returncode = p.returncode
+                if sys.platform == "darwin":
+                    peak[0] = max(peak[0], int(usage.ru_maxrss/1024))
+                else:
+                    peak[0] = max(peak[0], int(usage.ru_maxrss))
+            if returncode == 0:
+                return 0
+            errors.seek(0)
+            message = errors.read()[-1000:].decode(errors="replace").strip()
+        name = cmd if shell else " ".join(cmd)
+        if timed_out:
+            logPrint("%s killed after %ss" % (name, timeout))
+        else:
+            logPrint("%s failed with exit code %s: %s" % (name, returncode, message))
+        if attempt < retries:
+            logPrint("running it again (%s of %s)" % (attempt+1, retries))
+    return returncode
+
+async def _drive_tool_job(job, peak):
+    loop = asyncio.get_running_loop()
+    try:
+        step = next(job)
+        while True:
+            if callable(step):
+                """Python steps run on a thread, so commands keep being watched"""
+                result = await loop.run_in_executor(None, step)
+            else:
+                result = await _run_tool_command(step[0], step[1], peak)
+            step = job.send(result)
+    except StopIteration as stop:
+        return stop.value
+
+async def _tool_jobs(func, params, numProc, mem_budget, job_sizes):
+    tool = func.__name__
+    if int(mem_budget) > 0:
+        mem_budget = float(mem_budget)
+    else:
+        mem_budget = float("inf")
+    out = [None]*len(params)
+    running = {}
+    slots = asyncio.Condition()
+    def fits(estimate):
+        if len(running) >= numProc:
+            return False
+        return not running or sum(running.values())+estimate <= mem_budget
+    async def run(idx):
+        estimate = 0
+        if job_sizes is not None:
+            estimate = estimate_job_memory(tool, job_sizes[idx])
+        async with slots:
+            await slots.wait_for(lambda: fits(estimate))
+            if estimate > mem_budget:
+                logPrint("%s is estimated to need %.0fMB, more than the %sMB budget, running it alone" % (get_seq_name(str(params[idx][1])), estimate, mem_budget))
+            running[idx] = estimate
+        peak = [0]
+        try:
+            out[idx] = await _drive_tool_job(func(params[idx]), peak)
+        finally:
+            async with slots:
+                del running[idx]
+                slots.notify_all()
+        if job_sizes is not None:
+            record_job_memory(tool, params[idx][1], job_sizes[idx], estimate, peak[0])
+    await asyncio.gather(*[run(idx) for idx in range(len(params))])
     return out
 
+def run_tool_jobs(func, params, numProc, mem_budget=0, job_sizes=None):
+    """run the tool job func for each of params, with up to numProc commands
+    at a time, all from this process. A tool job is a generator that yields
+    (command, shell) and is sent back the exit code, or yields a function
+    to call and is sent back its result. With the input
+    size of each job, peak memory is measured and logged, and with a memory
+    budget (MB) a job only starts when its estimated peak fits. Returns the
+    result of each job. Anything still running is killed if a job fails"""
+    if len(params) == 0:
+        return []
+    return asyncio.run(_tool_jobs(func, params, numProc, mem_budget, job_sizes))
+
 def get_cluster_ids(in_fasta):
-    clusters = []
-    with open(in_fasta) as infile:
-        for record in SeqIO.parse(infile, "fasta"):
-            clusters.append(record.id)
-    nr = list(OrderedDict.fromkeys(clusters))
-    if len(clusters) == len(nr):
+    clusters = [name for name, seq in read_fasta(in_fasta)]
+    if len(clusters) == len(set(clusters)):
         return clusters
     else:
         print("Problem with gene list.  Are there duplicate headers in your file?")
         sys.exit()
 
+def bsr_values(scores, ref):
+    """bit scores divided by the self-score, 0 without one"""
+    if ref > 0:
+        return [score/ref for score in scores]
+    return [0.0]*len(scores)
+
 def divide_values(file, ref_scores):
-    """divide each BSR value in a row by that row's maximum value"""
+    """divide each bit score in a row by that row's self-score, as
+    build_bsr_matrix does, and write them to BSR_matrix_values.txt"""
     errors = []
     outdata = []
     with open(file) as infile:
-        firstLine = infile.readline()
-        FL_F=firstLine.split()
+        FL_F = infile.readline().split()
         outfile = open("BSR_matrix_values.txt", "w")
-        outfile.write('\t'.join([str(item) for item in FL_F])+"\n")
+        outfile.write("\t".join(FL_F)+"\n")
         for line in infile:
-            fields=line.split()
-            all_fields=list(fields)
+            fields = line.split()
             try:
-                fields=list(map(float, all_fields[1:]))
-            except:
+                scores = list(map(float, fields[1:]))
+            except ValueError:
                 raise TypeError("abnormal number of fields observed")
-            values= []
-            for x in fields:
-                try:
-                    values.append(float(x)/float(ref_scores.get(all_fields[0])))
-                except:
-                    """if a mismatch error in names encountered, change values to 0"""
-                    errors.append(all_fields[0])
-                    values.append(float("0"))
-            sort_values=['%.4f' % elem for elem in values]
-            outfile.write('\t'.join([str(item) for item in sort_values])+"\n")
+            try:
+                ref = float(ref_scores.get(fields[0]))
+            except TypeError:
+                ref = 0
+            if ref <= 0:
+                """if a mismatch error in names encountered, change values to 0"""
+                errors.append(fields[0])
+            values = bsr_values(scores, ref)
+            outfile.write("\t".join(["%.4f" % x for x in values])+"\n")
             outdata.append(values)
         outfile.close()
     if len(errors)>0:
-        nr=[x for i, x in enumerate(errors) if x not in errors[i+1:]]
-        logPrint("The following genes had no hits in datasets or are too short, values changed to 0, check names and output:%s" % "\n".join(nr))
+        logPrint("The following genes had no hits in datasets or are too short, values changed to 0, check names and output:%s" % "\n".join(errors))
     return outdata
 
 def rename_fasta_header(fasta_in, fasta_out):
     """this is used for renaming the output,
     in the off chance that there are duplicate
     names for separate peptides"""
-    rec=1
-    handle = open(fasta_out, "w")
     outdata = []
-    with open(fasta_in) as infile:
-        for record in SeqIO.parse(infile, "fasta"):
-            try:
-                outdata.append(">"+"centroid"+"_"+record.id)
-                handle.write(">centroid_"+str(autoIncrement())+"\n")
-                handle.write(str(record.seq)+"\n")
-            except:
-                raise TypeError("problem with input sequence encountered")
-    handle.close()
+    def renamed():
+        for name, seq in read_fasta(fasta_in):
+            outdata.append(">"+"centroid"+"_"+name)
+            yield "centroid_"+str(autoIncrement()), seq
+    write_fasta(fasta_out, renamed())
     return outdata
 
 def get_seq_name(in_fasta):
@@ -104,56 +396,75 @@ def filter_seqs(input_pep,output_pep):
     """filter out short sequences from a multifasta.
     Will hopefully speed up the process without losing
     important information"""
-    long_sequences = []
-    outfile = open(output_pep, "w")
     outdata = []
-    with open(input_pep) as infile:
-        for record in SeqIO.parse(infile, "fasta"):
-            if len(record.seq) >= int(50):
-                long_sequences.append(record)
-                outdata.append(len(record.seq))
-    SeqIO.write(long_sequences, outfile, "fasta")
-    outfile.close()
+    def long_sequences():
+        for name, seq in read_fasta(input_pep):
+            if len(seq) >= int(50):
+                outdata.append(len(seq))
+                yield name, seq
+    write_fasta(output_pep, long_sequences())
     return outdata
 
-def parse_blast_report_dev(test,processors):
-    """parse out only the unqiue names and bit score from the blast report"""
+def parse_blast_report_dev(test,processors,hit_store=False,hit_metrics=False):
+    """parse out only the unqiue names and bit score from the blast report.
+    With hit_metrics, the identity and length of the best hit and the number
+    of hits are kept too. With hit_store, the hits of each genome are also
+    kept for the hit store, against the gene index shared with the workers"""
     curr_dir=os.getcwd()
     files_and_temp_names = []
     for infile in glob.glob(os.path.join(curr_dir, "*_blast.out")):
-        files_and_temp_names.append([infile, test])
+        files_and_temp_names.append([infile, test, hit_store, hit_metrics])
     outdata = mp_shell(_perform_workflow_pbr, files_and_temp_names, processors)
     if "true" in test:
         # mp_shell will return a list of lists. This will flatten it into a single list
         return outdata
 
 def _perform_workflow_pbr(data):
+    """keep the best hit of each gene: its bit score, and with hit_metrics,
+    its percent identity and aligned length and the number of hits the gene has"""
     infile = data[0]
     test = data[1]
+    hit_store = data[2]
+    hit_metrics = data[3]
     outdata = []
     order = []
     names = get_seq_name(infile)
     outfile = open("%s.filtered.unique" % names, "w")
     uniques = {}
+    hits = {}
+    if hit_store:
+        index = _worker_state["index"]
+        stored = (array("I"), array("d"), array("f"), array("I"))
     with open(data[0]) as infile:
         for line in infile:
             try:
                 fields = line.split()
+                if hit_store and fields[0] in index:
+                    for values, value in zip(stored, (index[fields[0]], float(fields[11]), float(fields[2]), int(fields[3]))):
+                        values.append(value)
                 # Keep track of the largest value of fields[0]
                 if fields[0] not in uniques:
-                    uniques[fields[0]] = fields[11].strip("\n")
+                    uniques[fields[0]] = (fields[11], fields[2], fields[3])
+                    hits[fields[0]] = 1
                     order.append(fields[0])
                 else:
-                    if float(fields[11]) > float(uniques[fields[0]]):
-                        uniques[fields[0]] = fields[11].strip("\n")
+                    hits[fields[0]] += 1
+                    if float(fields[11]) > float(uniques[fields[0]][0]):
+                        uniques[fields[0]] = (fields[11], fields[2], fields[3])
             except IndexError:
                 raise TypeError("Malformed blast line found in %s" % infile)
     for item in order:
         if "true" in test:
             outdata.append(item)
-            outdata.append(uniques[item])
-        outfile.write(item + "\t" + uniques[item] + "\n")
+            outdata.append(uniques[item][0])
+        if hit_metrics:
+            outfile.write("\t".join((item,)+uniques[item]+(str(hits[item]),))+"\n")
+        else:
+            outfile.write(item + "\t" + uniques[item][0] + "\n")
     outfile.close()
+    if hit_store:
+        with open("%s.hits" % data[0], "wb") as hits_out:
+            hits_out.write(_hit_record(names.replace(".fasta.new_blast.out",""), stored))
     if "true" in test:
         return outdata
 
@@ -207,39 +518,93 @@ def parse_self_blast(infile):
                 raise TypeError("blast file is malformed")
     return my_dict
 
-def translate_genes(genes,outfile,min_len):
-    """translate nucleotide into peptide with BioPython"""
-    output = []
-    output_handle = open(outfile, "w")
+CODON_TABLE = {}
+
+def _codon_table():
+    """bacterial (11) codon table, with stops translated as '*'"""
+    if len(CODON_TABLE) == 0:
+        table = CodonTable.unambiguous_dna_by_id[11]
+        CODON_TABLE.update(table.forward_table)
+        for codon in table.stop_codons:
+            CODON_TABLE[codon] = "*"
+    return CODON_TABLE
+
+def _translate_codon(codon):
+    """ambiguous codons are resolved with BioPython and cached"""
+    try:
+        aa = str(Seq(codon).translate(table=11))
+    except:
+        raise TypeError("odd characters observed in codon %s" % codon)
+    CODON_TABLE[codon] = aa
+    return aa
+
+def translate_seq(seq):
+    """translate a nucleotide sequence with table 11 up to the first stop
+    codon. Bases that don't make up a full codon at the end are trimmed"""
+    table = _codon_table()
+    seq = seq.upper()
+    bases = iter(seq[:len(seq) - len(seq) % 3])
+    try:
+        """codons are cut by zipping the same iterator three times"""
+        return "".join(map(table.get, map("".join, zip(bases, bases, bases)))).split("*", 1)[0]
+    except TypeError:
+        """only look up odd codons that come before the first stop"""
+        peptide = []
+        for i in range(0, len(seq) - len(seq) % 3, 3):
+            aa = table.get(seq[i:i+3])
+            if aa is None:
+                aa = _translate_codon(seq[i:i+3])
+            if aa == "*":
+                break
+            peptide.append(aa)
+        return "".join(peptide)
+
+def _perform_workflow_translate(data):
+    tn, genes, start, end, outfile, min_len = data
+    first = None
     too_short = []
-    with open(genes) as infile:
-        for record in SeqIO.parse(infile, "fasta"):
-            try:
-                min_pep_len=int(min_len)
-                """Should I trim these sequences back to be multiples of 3?"""
-                if (len(record.seq)/3.0).is_integer():
-                    pep_seq=record.seq.translate(to_stop=True, table=11)
-                elif ((len(record.seq)-1)/3.0).is_integer():
-                    pep_seq=record.seq[:-1].translate(to_stop=True, table=11)
-                elif ((len(record.seq)-2)/3.0).is_integer():
-                    pep_seq=record.seq[:-2].translate(to_stop=True, table=11)
-                elif ((len(record.seq)-3)/3.0).is_integer():
-                    pep_seq=record.seq[:-3].translate(to_stop=True, table=11)
-                else:
-                    print("Sequence of odd length found and couldn't be trimmed")
-                if len(pep_seq)>=min_pep_len:
-                    output_handle.write(">"+record.id+"\n")
-                    output_handle.write("".join(pep_seq)+"\n")
-                    output.append(pep_seq)
-                else:
-                    too_short.append(record.id)
-            except:
-                raise TypeError("odd characters observed in sequence %s" % record.id)
+    output_handle = open(outfile, "w")
+    for name, seq in read_fasta(genes, start, end):
+        try:
+            pep_seq = translate_seq(seq.decode())
+        except TypeError:
+            raise TypeError("odd characters observed in sequence %s" % name)
+        if len(pep_seq)>=int(min_len):
+            output_handle.write(">"+name+"\n"+pep_seq+"\n")
+            if first is None:
+                first = pep_seq
+        else:
+            too_short.append(name)
     output_handle.close()
-    for record in output:
-        return str(record)
+    return first, too_short
+
+def translate_genes(genes,outfile,min_len,processors=1):
+    """translate nucleotide into peptide. Large files are translated
+    in chunks by parallel workers and written out in the original order.
+    Returns the first peptide that was written"""
+    if int(processors) > 1 and os.path.getsize(genes) > 1048576:
+        chunks = fasta_chunk_offsets(genes, int(processors)*4)
+    else:
+        chunks = [(0, os.path.getsize(genes))]
+    files_and_temp_names = []
+    for idx, (start, end) in enumerate(chunks):
+        files_and_temp_names.append([str(idx), genes, start, end, "%s.chunk_%s" % (outfile, idx), min_len])
+    if len(files_and_temp_names) > 1:
+        outdata = mp_shell(_perform_workflow_translate, files_and_temp_names, processors)
+    else:
+        outdata = [_perform_workflow_translate(files_and_temp_names[0])]
+    output_handle = open(outfile, "w")
+    for data in files_and_temp_names:
+        with open(data[4]) as chunk:
+            shutil.copyfileobj(chunk, output_handle)
+        os.remove(data[4])
+    output_handle.close()
+    too_short = [name for first, names in outdata for name in names]
     if len(too_short)>0:
         logPrint("The following sequences were too short and will not be processed: %s" % "\n".join(too_short))
+    for first, names in outdata:
+        if first is not None:
+            return first
 rec=1
 
 def autoIncrement():
@@ -433,32 +798,141 @@ def filter_matrix(to_keep, in_matrix, prefix):
     outfile.close()
     return outdata
 
-def get_core_gene_stats(matrix, threshold, lower, missing):
-    outfile = open("core_gene_ids.txt", "w")
-    singletons = open("unique_gene_ids.txt", "w")
-    positives = []
-    singles = []
+"""Values of a sparse matrix are kept as integers in units of 0.0001 BSR,
+the precision of the text matrix"""
+SPARSE_MAGIC = "#LS-BSR sparse matrix"
+SPARSE_SCALE = 10000
+
+def _little_endian(values):
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+def write_sparse_matrix(matrix, outfile, floor=0):
+    """write a BSR matrix in sparse (CSR) form, keeping only the values
+    above 0 and at or above floor. After a header with the floor, the
+    genomes and the genes, the file holds where the values of each gene
+    start (uint64), the column of each value (uint32) and the values
+    (uint16, in units of 0.0001), little-endian. Returns the number of
+    values kept"""
+    genes = []
+    starts = array("Q", [0])
     with open(matrix) as in_matrix:
-        firstLine = in_matrix.readline()
+        genomes = in_matrix.readline().split()
+        with open(outfile+".columns", "wb") as columns_out:
+            with open(outfile+".values", "wb") as values_out:
+                for line in in_matrix:
+                    fields = line.split()
+                    if len(fields) == 0:
+                        continue
+                    if len(fields) != len(genomes)+1:
+                        raise TypeError("abnormal number of fields")
+                    columns = array("I")
+                    values = array("H")
+                    for column, x in enumerate(fields[1:]):
+                        value = float(x)
+                        if value > 0 and value >= float(floor):
+                            columns.append(column)
+                            values.append(min(int(round(value*SPARSE_SCALE)), 65535))
+                    _little_endian(columns).tofile(columns_out)
+                    _little_endian(values).tofile(values_out)
+                    genes.append(fields[0])
+                    starts.append(starts[-1]+len(columns))
+    with open(outfile, "wb") as output:
+        output.write(("%s\t%s\n" % (SPARSE_MAGIC, floor)).encode())
+        output.write(("\t".join(genomes)+"\n").encode())
+        output.write(("\t".join(genes)+"\n").encode())
+        _little_endian(starts).tofile(output)
+        for part in [outfile+".columns", outfile+".values"]:
+            with open(part, "rb") as infile:
+                shutil.copyfileobj(infile, output, 1048576)
+            os.remove(part)
+    return starts[-1]
+
+def _header_names(line):
+    line = line.decode().rstrip("\n")
+    if len(line) == 0:
+        return []
+    return line.split("\t")
+
+def _sparse_rows(matrix, genes, offset):
+    with open(matrix, "rb") as starts_in:
+        starts_in.seek(offset)
+        starts = _little_endian(array("Q"))
+        starts.fromfile(starts_in, len(genes)+1)
+        starts = _little_endian(starts)
+    with open(matrix, "rb") as columns_in:
+        with open(matrix, "rb") as values_in:
+            columns_in.seek(offset+8*(len(genes)+1))
+            values_in.seek(offset+8*(len(genes)+1)+4*starts[-1])
+            for i, gene in enumerate(genes):
+                count = starts[i+1]-starts[i]
+                columns = array("I")
+                columns.fromfile(columns_in, count)
+                values = array("H")
+                values.fromfile(values_in, count)
+                yield gene, _little_endian(columns), [float(value)/SPARSE_SCALE for value in _little_endian(values)]
+
+def _text_rows(matrix, num_genomes):
+    all_columns = range(num_genomes)
+    with open(matrix) as in_matrix:
+        next(in_matrix)
         for line in in_matrix:
             fields = line.split()
-            totals = len(fields[1:])
-            presents = []
-            uniques = []
+            if len(fields) == 0:
+                continue
+            if len(fields) != num_genomes+1:
+                raise TypeError("abnormal number of fields")
             try:
-                for x in fields[1:]:
-                    if float(x)>=float(threshold):
-                        presents.append(fields[0])
-                    if float(x)>=float(lower):
-                        uniques.append(fields[0])
-                if int(len(presents)+missing)/int(totals)>=1:
-                    positives.append(fields[0])
-                if int(len(uniques))==1:
-                    singles.append(fields[0])
-            except:
+                values = list(map(float, fields[1:]))
+            except ValueError:
                 raise TypeError("problem in input file found")
-                outfile.close()
-                singletons.close()
+            yield fields[0], all_columns, values
+
+def read_bsr_matrix(matrix):
+    """the genomes of a BSR matrix, text or sparse (see write_sparse_matrix),
+    and its rows as (gene, columns, values). Rows of a text matrix have
+    every column. Rows of a sparse matrix only have the values that were
+    kept, so reading it takes time in proportion to them. Also returns
+    the floor of a sparse matrix (None for a text matrix)"""
+    with open(matrix, "rb") as infile:
+        first = infile.readline()
+        if not first.startswith(SPARSE_MAGIC.encode()):
+            genomes = first.decode().split()
+            return genomes, None, _text_rows(matrix, len(genomes))
+        floor = float(first.decode().split("\t")[1])
+        genomes = _header_names(infile.readline())
+        genes = _header_names(infile.readline())
+        offset = infile.tell()
+    return genomes, floor, _sparse_rows(matrix, genes, offset)
+
+def check_sparse_threshold(floor, threshold):
+    """values left out of a sparse matrix are only known to be below its
+    floor, so it can't be compared against anything lower"""
+    if floor is not None and (float(threshold) <= 0 or float(threshold) < floor):
+        raise ValueError("threshold %s is below the floor (%s) of the sparse matrix" % (threshold, floor))
+
+def get_core_gene_stats(matrix, threshold, lower, missing):
+    genomes, floor, rows = read_bsr_matrix(matrix)
+    check_sparse_threshold(floor, threshold)
+    check_sparse_threshold(floor, lower)
+    outfile = open("core_gene_ids.txt", "w")
+    singletons = open("unique_gene_ids.txt", "w")
+    positives = []
+    singles = []
+    totals = len(genomes)
+    for gene, columns, values in rows:
+        try:
+            presents = len([x for x in values if x>=float(threshold)])
+            uniques = len([x for x in values if x>=float(lower)])
+            if int(presents+missing)/int(totals)>=1:
+                positives.append(gene)
+            if int(uniques)==1:
+                singles.append(gene)
+        except:
+            outfile.close()
+            singletons.close()
+            raise TypeError("problem in input file found")
     print("# of conserved genes (>=0.8 BSR in all genomes) = %s" % len(positives))
     print("# of unique genes (>=0.8 BSR in only 1 genome, <0.4 in others) = %s" % len(singles))
     ratio = int(len(singles))/int(totals)
@@ -471,27 +945,11 @@ def get_core_gene_stats(matrix, threshold, lower, missing):
 
 def get_frequencies(matrix,threshold):
     import collections
-    out_data = []
-    all = []
+    genomes, floor, rows = read_bsr_matrix(matrix)
+    check_sparse_threshold(floor, threshold)
     outfile = open("frequency_data.txt", "w")
-    with open(matrix) as in_matrix:
-        firstLine = in_matrix.readline()
-        for line in in_matrix:
-            """Presents contain those CDSs that are conserved"""
-            presents = []
-            tempo = []
-            fields = line.split()
-            try:
-                for x in fields[1:]:
-                    if float(x)>=float(threshold):
-                        presents.append(fields[0])
-            except:
-                raise TypeError("problem found with input file")
-            tempo.append(len(presents))
-            all.append(tempo)
-    """This now flattens the list of lists: There should never be zeros"""
-    all_flat = [item for sublist in all for item in sublist]
-    my_dict=collections.Counter(all_flat)
+    """the number of genomes each gene is conserved in"""
+    my_dict=collections.Counter([len([x for x in values if x>=float(threshold)]) for gene, columns, values in rows])
     outfile.write("Frequency distribution:\n")
     for k,v in my_dict.items():
         outfile.write(str(k)+"\t"+str(v)+"\n")
@@ -545,17 +1003,11 @@ def filter_variome(matrix, threshold, step):
 def filter_scaffolds_fun(in_fasta):
     """If an N is present in any scaffold, the entire contig will
     be entire filtered, probably too harsh"""
-    with open(in_fasta) as infile:
-        outrecords = []
-        for record in SeqIO.parse(infile, "fasta"):
-            if "N" not in record.seq:
-                outrecords.append(record)
-        output_handle = open("tmp.out", "w")
-        if int(len(outrecords))==0:
-            print("no usable fasta records were found or all contain scaffolds")
-            sys.exit()
-        SeqIO.write(outrecords, output_handle, "fasta")
-        output_handle.close()
+    outrecords = [(name, seq) for name, seq in read_fasta(in_fasta) if b"N" not in seq]
+    if int(len(outrecords))==0:
+        print("no usable fasta records were found or all contain scaffolds")
+        sys.exit()
+    write_fasta("tmp.out", outrecords)
 
 #def uclust_sort(usearch):
 #    """sort with Usearch. Updated to V6"""
@@ -577,18 +1029,14 @@ def process_pangenome(matrix,upper,lower,iterations,type,prefix):
         acc_outfile = open("%s_accumulation_replicates.txt" % prefix, "w")
         uni_outfile = open("%s_uniques_replicates.txt" % prefix, "w")
         core_outfile = open("%s_core_replicates.txt" % prefix, "w")
-    indexes = []
-    with open(matrix) as my_matrix:
-        firstLine = my_matrix.readline()
-        first_fields = firstLine.split()
-        genomes = len(first_fields)
-        for x in first_fields:
-            indexes.append(first_fields.index(x)+1)
+    genomes, floor, rows = read_bsr_matrix(matrix)
+    check_sparse_threshold(floor, upper)
+    indexes = list(range(len(genomes)))
     acc_dict = {}
     core_dict = {}
     uni_dict = {}
     #For each subsampling level
-    for i in list(range(1,genomes+1)):
+    for i in list(range(1,len(genomes)+1)):
         print(i)
         #For each iteration
         for iteration in list(range(1,iterations+1)):
@@ -596,33 +1044,23 @@ def process_pangenome(matrix,upper,lower,iterations,type,prefix):
             positives_core = []
             positives_unis = []
             """This selects the random set of genomes"""
-            outseqs=random.sample(set(indexes), int(i))
-            """Changing the tabs for all of these genomes"""
-            with open(matrix) as f:
-                next(f)
-                for line in f:
-                    newline = line.strip("\n")
-                    fields = newline.split()
-                    positive_lines_acc=[]
-                    positive_lines_core=[]
-                    positive_lines_unis=[]
-                    for outseq in outseqs:
-                        if type == "acc" or type == "all":
-                            if float(fields[outseq])>=float(upper):
-                                positive_lines_acc.append("1")
-                        if type == "core" or type == "all":
-                            if float(fields[outseq])>=float(upper):
-                                positive_lines_core.append("1")
-                        if type == "uni" or type == "all":
-                            """this was changed from lower to upper"""
-                            if float(fields[outseq])>=float(lower) and float(fields[outseq])>=float(upper):
-                                positive_lines_unis.append("1")
-                    if len(positive_lines_acc)>=1:
-                        positives_acc.append("1")
-                    if len(positive_lines_core)==len(outseqs):
-                        positives_core.append("1")
-                    if int(len(positive_lines_unis))==1:
-                        positives_unis.append("1")
+            outseqs=set(random.sample(indexes, int(i)))
+            rows = read_bsr_matrix(matrix)[2]
+            for gene, columns, values in rows:
+                positive_lines = 0
+                positive_lines_unis = 0
+                for column, value in zip(columns, values):
+                    if column in outseqs and value>=float(upper):
+                        positive_lines += 1
+                        """this was changed from lower to upper"""
+                        if value>=float(lower):
+                            positive_lines_unis += 1
+                if (type == "acc" or type == "all") and positive_lines>=1:
+                    positives_acc.append("1")
+                if (type == "core" or type == "all") and positive_lines==len(outseqs):
+                    positives_core.append("1")
+                if (type == "uni" or type == "all") and positive_lines_unis==1:
+                    positives_unis.append("1")
             try:
                 acc_dict[i].append(len(positives_acc))
             except KeyError:
@@ -735,56 +1173,77 @@ def parse_tree(tree):
 def blat_against_self(query,reference,output,processors):
     subprocess.check_call("blat -out=blast8 -minIdentity=75 %s %s %s > /dev/null 2>&1" % (reference,query,output), shell=True)
 
-def create_bsr_matrix_dev(master_list):
-    new_matrix = open("bsr_matrix", "w")
-    test = map(list,zip(*master_list))
-    for x in test:
-        y = map(str,x)
-        new_matrix.write("\t".join(y)+"\n")
-    new_matrix.close()
+def run_clustering(tool, cmd, infile, mem_budget=0, shell=False):
+    """run a clustering tool over all of the genes. Its peak memory is
+    estimated from the size of the input, then measured and logged.
+    Raises if the tool fails"""
+    size = os.path.getsize(infile)
+    estimate = estimate_job_memory(tool, size)
+    if int(mem_budget) > 0 and estimate > float(mem_budget):
+        logPrint("%s is estimated to need %.0fMB, more than the %sMB budget" % (tool, estimate, mem_budget))
+    _job_peak_rss[0] = 0
+    run_measured(cmd, shell=shell, check=True)
+    record_job_memory(tool, infile, size, estimate, _job_peak_rss[0])
 
 def run_vsearch(id, processors, infile):
-    devnull = open("/dev/null", "w")
     cmd = ["vsearch",
            "-cluster_fast", infile,
            "-id", str(id),
            "-uc", "results.uc",
            "-threads", "%s" % processors,
            "-centroids", "vsearch.out"]
-    subprocess.call(cmd,stdout=devnull,stderr=devnull)
-    devnull.close()
+    run_clustering("vsearch", cmd, infile)
 
-def run_mmseqs(id, processors, infile):
-    devnull = open("/dev/null", "w")
+def run_mmseqs(id, processors, infile, mem_budget=0):
     cmd = ["mmseqs",
            "easy-cluster", infile,
            "mmseqs",
            "mm_tmp",
            "--min-seq-id", str(id),
            "--threads", "%s" % processors]
-    subprocess.call(cmd,stdout=devnull,stderr=devnull)
-    devnull.close()
+    if int(mem_budget) > 0:
+        cmd.extend(["--split-memory-limit", "%sM" % mem_budget])
+    run_clustering("mmseqs", cmd, infile, mem_budget)
 
-def run_mmseqs_lin(id, processors, infile):
-    devnull = open("/dev/null", "w")
+def run_mmseqs_lin(id, processors, infile, mem_budget=0):
     cmd = ["mmseqs",
            "easy-linclust", infile,
            "mmseqs",
            "mm_tmp",
            "--min-seq-id", str(id),
            "--threads", "%s" % processors]
-    subprocess.call(cmd,stdout=devnull,stderr=devnull)
-    devnull.close()
-
-def process_genbank_files(directory):
-    genbank_hits = []
-    for infile in glob.glob(os.path.join(directory, "*.gbk")):
-        name = get_seq_name(infile)
-        reduced = name.replace(".gbk","")
-        genbank_hits.append(name)
-        output_handle = open("%s.locus_tags.fasta" % reduced, "w")
-        count = 0
-        for record in SeqIO.parse(infile, "genbank"):
+    if int(mem_budget) > 0:
+        cmd.extend(["--split-memory-limit", "%sM" % mem_budget])
+    run_clustering("mmseqs-lin", cmd, infile, mem_budget)
+
+def run_cdhit(program, id, processors, infile, outfile, min_len, mem_budget=0):
+    """cd-hit is limited to the memory budget (MB), 0 is unlimited"""
+    run_clustering(program, "%s -i %s -o %s -M %s -T %s -c %s -s %s -d 0 > cdhit.cluster 2>&1" % (program,infile,outfile,int(mem_budget),processors,id,min_len),
+                   infile, mem_budget, True)
+
+def _perform_workflow_genbank(data):
+    """parse one GenBank file and write every output from the same parse.
+    A record without a sequence (no ORIGIN) is left out of the genome,
+    and only the translations of its CDS are used"""
+    tn, infile, outdir, locus_tags, peptides, genomes = data
+    name = get_seq_name(infile).replace(".gz","")
+    reduced = name.replace(".gbk","")
+    if locus_tags:
+        output_handle = open("%s/%s.locus_tags.fasta" % (outdir, reduced), "w")
+    if peptides:
+        pep_handle = open("%s/%s.fasta.new_genes.pep" % (outdir, reduced), "w")
+    contigs = []
+    count = 0
+    with open_input(infile) as handle:
+        for record in SeqIO.parse(handle, "genbank"):
+            try:
+                record_seq = str(record.seq)
+            except ValueError:
+                record_seq = None
+            if genomes and record_seq is not None:
+                contigs.append((record.id, record_seq))
+            if not locus_tags and not peptides:
+                continue
             for feature in record.features:
                 if feature.type == "CDS":
                     count = count + 1
@@ -794,41 +1253,360 @@ def process_genbank_files(directory):
                         product = []
                         for afeature in feature_product:
                             product.append(afeature.replace(" ","_"))
-                        feature_seq = feature.extract(record.seq)
-                        output_handle.write(">" + "".join(feature_name) + "|" + "".join(product) + "\n" + str(feature_seq) + "\n")
+                        if record_seq is not None:
+                            feature_seq = str(feature.extract(record.seq))
                     except:
                         print("problem extracting locus tag: %s" % "".join(feature_name))
+                        continue
+                    header = "".join(feature_name) + "|" + "".join(product)
+                    if record_seq is None:
+                        if peptides and "translation" in feature.qualifiers:
+                            pep_handle.write(">" + header + "\n" + "".join(feature.qualifiers["translation"]) + "\n")
+                        continue
+                    if locus_tags:
+                        output_handle.write(">" + header + "\n" + feature_seq + "\n")
+                    if peptides:
+                        try:
+                            pep_seq = translate_seq(feature_seq)
+                        except TypeError:
+                            raise TypeError("odd characters observed in sequence %s" % header)
+                        pep_handle.write(">" + header + "\n" + pep_seq + "\n")
+    if locus_tags:
         output_handle.close()
-    return genbank_hits
+    if peptides:
+        pep_handle.close()
+    if genomes and len(contigs)>0:
+        write_fasta("%s/%s.fasta.new" % (outdir, reduced), contigs)
+    return name
+
+def process_genbank_files(directory, processors=1, locus_tags=True, peptides=False, genomes=False):
+    """parse each GenBank file once, in parallel. From that parse, write the
+    locus tags (nucleotide), their peptides, and the genome as FASTA in the
+    current directory. Returns the names of the GenBank files"""
+    infiles = glob.glob(os.path.join(directory, "*.gbk"))+glob.glob(os.path.join(directory, "*.gbk.gz"))
+    files_and_temp_names = [[str(idx), f, os.getcwd(), locus_tags, peptides, genomes]
+                            for idx, f in enumerate(infiles)]
+    if len(files_and_temp_names) == 0:
+        return []
+    return mp_shell(_perform_workflow_genbank, files_and_temp_names, processors)
 
 def test_duplicate_header_ids(fasta_file):
-    IDs = []
+    IDs = collections.Counter()
     with open(fasta_file) as infile:
         for line in infile:
             if line.startswith(">"):
                 fields = line.split()
                 clean = fields[0].replace(">","")
-                IDs.append(clean)
+                IDs[clean] += 1
             else:
                 pass
-    nr=[x for i, x in enumerate(IDs) if x not in IDs[i+1:]]
-    my_dict = {}
-    for id in IDs:
-        try:
-            my_dict[id].append("1")
-        except KeyError:
-            my_dict[id] = ["1"]
-    dups = []
-    for k,v in my_dict.items():
-        if len(v)>1: dups.append(k)
+    dups = [k for k,v in IDs.items() if v>1]
     if len(dups)>0:
         print("Duplicate header IDs:")
         print("\n".join(dups))
-    if len(IDs) == len(nr):
+    if len(dups) == 0:
         return "True"
     else:
         return "False"
 
+def _perform_workflow_preflight(data):
+    """stream one input file and collect its stats. A compressed genome
+    is decompressed into the temp directory in the same pass, and every
+    later step reads that copy, so it is decompressed once per run"""
+    tn, f, outdir = data
+    name = re.sub(r"\.gz$", "", os.path.basename(f))
+    stats = {"file":name, "size":os.path.getsize(f), "type":"nt",
+             "records":0, "length":0, "n_count":0, "duplicates":[], "digest":None,
+             "no_sequence":[]}
+    names = []
+    if name.endswith(".gbk"):
+        stats["type"] = "gbk"
+        in_seq = False
+        lengths = []
+        with open_input(f) as infile:
+            for line in infile:
+                if line.startswith("LOCUS"):
+                    fields = line.split()
+                    if len(fields)>1:
+                        names.append(fields[1])
+                    else:
+                        names.append("")
+                    lengths.append(0)
+                elif line.startswith("ORIGIN"):
+                    in_seq = True
+                elif line.startswith("//"):
+                    in_seq = False
+                elif in_seq and len(lengths)>0:
+                    seq = "".join(line.split()[1:])
+                    lengths[-1] += len(seq)
+                    stats["length"] += len(seq)
+                    stats["n_count"] += seq.count("N")+seq.count("n")
+        """records without an ORIGIN are skipped, not counted as empty"""
+        stats["no_sequence"] = [x for x, length in zip(names, lengths) if length == 0]
+    else:
+        digests = []
+        copy_to = None
+        if outdir is not None and name.endswith(".fasta") and is_compressed(f):
+            copy_to = "%s/%s.new" % (outdir, name)
+        for header, seq in read_fasta(f, copy_to=copy_to):
+            names.append(header)
+            digests.append(hashlib.sha1(seq.upper()).hexdigest())
+            stats["length"] += len(seq)
+            stats["n_count"] += seq.count(b"N")+seq.count(b"n")
+            if stats["type"] == "nt":
+                """None of these characters are IUPACs"""
+                if b"F" in seq or b"L" in seq or b"I" in seq or b"P" in seq or b"Q" in seq or b"E" in seq:
+                    stats["type"] = "aa"
+        """the same contigs under any headers, in any order, give the same digest"""
+        stats["digest"] = hashlib.sha1("".join(sorted(digests)).encode()).hexdigest()
+    stats["records"] = len(names)
+    counts = collections.Counter(names)
+    stats["duplicates"] = sorted([k for k,v in counts.items() if v>1])
+    return stats
+
+def collapse_identical_seqs(in_fasta, out_fasta, membership):
+    """write one copy of each sequence, under the first ID it was seen
+    with. The IDs collapsed into each representative are written to the
+    membership file and returned as {representative:[IDs]}. Different
+    sequences that share an ID (e.g. genes on contigs with the same name
+    in two genomes) are given a numbered ID, so every ID is unique"""
+    seen = {}
+    members = OrderedDict()
+    def unique_seqs():
+        for name, seq in read_fasta(in_fasta):
+            key = hashlib.sha1(seq.upper()).digest()
+            if key in seen:
+                members[seen[key]].append(name)
+                continue
+            count = 1
+            unique_name = name
+            while unique_name in members:
+                count += 1
+                unique_name = "%s_%s" % (name, count)
+            seen[key] = unique_name
+            members[unique_name] = []
+            yield unique_name, seq
+    write_fasta(out_fasta, unique_seqs())
+    collapsed = OrderedDict()
+    outfile = open(membership, "a")
+    for name, names in members.items():
+        if len(names)>0:
+            collapsed[name] = names
+            outfile.write("%s\t%s\n" % (name, ",".join(names)))
+    outfile.close()
+    logPrint("%s of %s sequences in %s are identical to another sequence and were collapsed" %
+             (sum([len(x) for x in collapsed.values()]), sum([len(x)+1 for x in members.values()]), get_seq_name(in_fasta)))
+    return collapsed
+
+def parse_cluster_membership(cluster_file, method):
+    """parse the cluster membership written by vsearch (results.uc), mmseqs
+    (mmseqs_cluster.tsv) or cd-hit (.clstr) into {centroid:[(member, identity)]}.
+    Each centroid is a member of its own cluster. mmseqs doesn't report
+    the identity of members, so it is None"""
+    clusters = OrderedDict()
+    with open(cluster_file) as infile:
+        if "vsearch" in method:
+            for line in infile:
+                fields = line.rstrip("\n").split("\t")
+                if fields[0] == "S":
+                    clusters.setdefault(fields[8], []).append((fields[8], 100.0))
+                elif fields[0] == "H":
+                    clusters.setdefault(fields[9], []).append((fields[8], float(fields[3])))
+        elif "mmseqs" in method:
+            for line in infile:
+                fields = line.split()
+                if len(fields) == 2:
+                    if fields[0] == fields[1]:
+                        clusters.setdefault(fields[0], []).append((fields[1], 100.0))
+                    else:
+                        clusters.setdefault(fields[0], []).append((fields[1], None))
+        elif "cd-hit" in method:
+            members = []
+            centroid = None
+            for line in infile:
+                if line.startswith(">"):
+                    if centroid is not None:
+                        clusters[centroid] = members
+                    members = []
+                    centroid = None
+                    continue
+                name = line.split(">",1)[1].split("...")[0]
+                if line.rstrip().endswith("*"):
+                    centroid = name
+                    members.append((name, 100.0))
+                else:
+                    members.append((name, float(line.rstrip().rstrip("%").split("/")[-1].split()[-1])))
+            if centroid is not None:
+                clusters[centroid] = members
+    return clusters
+
+def gene_file_genome(infile):
+    """name of the genome that a gene file belongs to, as used in names.txt"""
+    return re.sub(r"(\.fasta\.new_genes\.(seqs|pep)|\.locus_tags\.fasta|\.intergenics\.seqs)$", "", get_seq_name(infile))
+
+def _perform_workflow_gene_hashes(data):
+    tn, f = data
+    return gene_file_genome(f), set([hashlib.sha1(seq.upper()).digest() for name, seq in read_fasta(f)])
+
+def genome_gene_hashes(fastadir, peptides, processors):
+    """{sequence hash:[genomes]} from the gene files of each genome, so that
+    cluster members can be traced back to the genomes they came from"""
+    if peptides:
+        patterns = ["*_genes.pep"]
+    else:
+        patterns = ["*_genes.seqs", "*.locus_tags.fasta", "*.intergenics.seqs"]
+    infiles = []
+    for pattern in patterns:
+        infiles.extend(glob.glob(os.path.join(fastadir, pattern)))
+    files_and_temp_names = [(str(idx), f) for idx, f in enumerate(sorted(infiles))]
+    if len(files_and_temp_names) == 0:
+        return {}
+    genome_hashes = {}
+    for genome, hashes in mp_shell(_perform_workflow_gene_hashes, files_and_temp_names, processors):
+        for key in hashes:
+            genomes = genome_hashes.setdefault(key, [])
+            if genome not in genomes:
+                genomes.append(genome)
+    return genome_hashes
+
+def cluster_membership_table(clusters, cluster_input, genome_hashes, outfile):
+    """genes x genomes membership: for each centroid, the closest member
+    from each genome, as {centroid:{genome:(member, identity)}}. Members
+    stand for every genome that has the same sequence. The table is also
+    written to outfile, one line per centroid and genome"""
+    id_hash = dict([(name, hashlib.sha1(seq.upper()).digest()) for name, seq in read_fasta(cluster_input)])
+    table = OrderedDict()
+    output_handle = open(outfile, "w")
+    output_handle.write("centroid\tgenome\tmember\tidentity\n")
+    for centroid, members in clusters.items():
+        row = {}
+        for member, identity in members:
+            for genome in genome_hashes.get(id_hash.get(member), []):
+                if genome not in row or (identity or 0) > (row[genome][1] or 0):
+                    row[genome] = (member, identity)
+        table[centroid] = row
+        for genome in sorted(row):
+            member, identity = row[genome]
+            if identity is None:
+                output_handle.write("%s\t%s\t%s\tNA\n" % (centroid, genome, member))
+            else:
+                output_handle.write("%s\t%s\t%s\t%.2f\n" % (centroid, genome, member, identity))
+    output_handle.close()
+    return table
+
+def membership_matrices(table, genomes, id, prefix, duplicates=None):
+    """presence/absence and approximate BSR matrices from cluster membership
+    alone, without aligning. The approximate BSR is the identity of the
+    genome's closest member/100, the clustering threshold if the identity
+    isn't known (mmseqs), and 0 if the genome has no member. Duplicate
+    genomes ({duplicate:representative}) get the column of their representative"""
+    if duplicates is None:
+        duplicates = {}
+    presence = open("%s_presence_matrix.txt" % prefix, "w")
+    approx = open("%s_approx_bsr_matrix.txt" % prefix, "w")
+    presence.write("\t"+"\t".join(genomes)+"\n")
+    approx.write("\t"+"\t".join(genomes)+"\n")
+    for centroid in sorted(table):
+        row = table[centroid]
+        presence_values = []
+        approx_values = []
+        for genome in genomes:
+            genome = duplicates.get(genome, genome)
+            if genome in row:
+                identity = row[genome][1]
+                if identity is None:
+                    identity = float(id)*100
+                presence_values.append("1")
+                approx_values.append("%.4f" % (identity/100))
+            else:
+                presence_values.append("0")
+                approx_values.append("%.4f" % 0)
+        presence.write(centroid+"\t"+"\t".join(presence_values)+"\n")
+        approx.write(centroid+"\t"+"\t".join(approx_values)+"\n")
+    presence.close()
+    approx.close()
+
+def fan_out_hits(infile, collapsed):
+    """copy the hits of each representative sequence to the IDs that
+    were collapsed into it"""
+    if len(collapsed) == 0:
+        return
+    with open(infile) as my_blast:
+        lines = my_blast.readlines()
+    outfile = open(infile, "w")
+    for line in lines:
+        outfile.write(line)
+        query, _, rest = line.partition("\t")
+        if query in collapsed:
+            for name in collapsed[query]:
+                outfile.write("%s\t%s" % (name, rest))
+    outfile.close()
+
+def find_duplicate_genomes(input_stats, report):
+    """find .fasta genomes with the same sequence content, using the digests
+    from the preflight check. Only the first genome of each set is processed,
+    the others are reported and returned as {duplicate:representative}"""
+    by_digest = OrderedDict()
+    for name in sorted(input_stats):
+        stats = input_stats[name]
+        if name.endswith(".fasta") and stats["digest"] is not None and stats["length"]>0:
+            by_digest.setdefault(stats["digest"], []).append(name)
+    duplicates = OrderedDict()
+    saved = 0
+    outfile = open(report, "w")
+    outfile.write("duplicate\trepresentative\n")
+    for digest, names in by_digest.items():
+        for name in names[1:]:
+            duplicates[name] = names[0]
+            saved += input_stats[name]["length"]
+            outfile.write("%s\t%s\n" % (name, names[0]))
+    outfile.close()
+    if len(duplicates)>0:
+        logPrint("%s genomes are identical to another genome and will not be processed again (%s nucleotides saved)" % (len(duplicates), saved))
+    return duplicates
+
+def copy_duplicate_hits(duplicates, fastadir):
+    """give each duplicate genome the alignment results of its representative"""
+    for name, representative in duplicates.items():
+        if not os.path.exists("%s/%s.new_blast.out" % (fastadir, representative)):
+            continue
+        shutil.copyfile("%s/%s.new_blast.out" % (fastadir, representative),
+                        "%s/%s.new_blast.out" % (fastadir, name))
+
+def preflight_inputs(infiles, processors, report, outdir=None):
+    """check every genome and gene file in parallel before any compute
+    is spent. The size of each input is kept for the job scheduler.
+    Compressed FASTA genomes are written once to outdir as .fasta.new.
+    Returns the stats of each file and the list of empty files"""
+    files_and_temp_names = [[str(idx), os.path.abspath(f), outdir] for idx, f in enumerate(infiles)]
+    if len(files_and_temp_names) == 0:
+        return {}, []
+    results = mp_shell(_perform_workflow_preflight, files_and_temp_names, processors)
+    outdata = {}
+    empty = []
+    outfile = open(report, "w")
+    outfile.write("file\ttype\tsize\trecords\tlength\tN_percent\tduplicate_headers\n")
+    for stats in results:
+        outdata[stats["file"]] = stats
+        INPUT_STATS[stats["file"]] = stats
+        if stats["length"]>0:
+            n_percent = float(stats["n_count"])/stats["length"]*100
+        else:
+            n_percent = 0
+        outfile.write("%s\t%s\t%s\t%s\t%s\t%.2f\t%s\n" % (stats["file"],stats["type"],stats["size"],
+                      stats["records"],stats["length"],n_percent,",".join(stats["duplicates"])))
+        if len(stats["no_sequence"])>0:
+            logPrint("%s has records without a sequence (no ORIGIN), which are skipped, only the translations of their CDS are used for protein searches: %s" %
+                     (stats["file"],",".join(stats["no_sequence"])))
+        if stats["records"] == 0 or (stats["length"] == 0 and len(stats["no_sequence"]) == 0):
+            empty.append(stats["file"])
+        if len(stats["duplicates"])>0:
+            logPrint("%s has duplicate headers: %s" % (stats["file"],",".join(stats["duplicates"])))
+    outfile.close()
+    if len(empty)>0:
+        logPrint("The following files are empty or could not be parsed: %s" % "\n".join(empty))
+    return outdata, empty
+
 #def split_files(fasta_file):
 #    """This next section removes line wraps, so I can
 #    split the file without interrupting a gene"""
@@ -841,24 +1619,6 @@ def test_duplicate_header_ids(fasta_file):
 #    """I can always make the number of lines an alterable field"""
 #    subprocess.check_call("split -l 200000 nowrap.fasta", shell=True)
 
-def generate_dup_matrix():
-    curr_dir=os.getcwd()
-    dup_names = []
-    outfile = open("dup_values", "w")
-    for infile in glob.glob(os.path.join(curr_dir, '*.counts.txt')):
-        genome_fields = []
-        with open(infile) as myfile:
-            for line in myfile:
-                newline = line.strip()
-                fields = newline.split()
-                for field in fields:
-                    genome_fields.append(field)
-        dup_names.append(genome_fields)
-    test=map(list, zip(*dup_names))
-    for alist in test:
-        outfile.write("\t".join(alist)+"\n")
-    outfile.close()
-
 #def _usearch_workflow(infile):
 #    devnull = open("/dev/null", "w")
 #    cmd = ["usearch",
@@ -878,31 +1638,550 @@ def generate_dup_matrix():
 #        files_and_temp_names.append([file,id])
 #    mp_shell(_usearch_workflow, files_and_temp_names, processors)
 
+def _prodigal_mode(mode, training):
+    """use a shared training file if there is one, otherwise
+    Prodigal trains on each genome (or runs in meta mode)"""
+    if training is None:
+        return "-p %s" % mode
+    return "-t %s" % training
+
 def _prodigal_workflow_def(data):
-    tn, f = data
-    subprocess.check_call("prodigal -i %s -d %s_genes.seqs -m -c -a %s_genes.pep > /dev/null 2>&1" % (f, f, f), shell=True)
+    tn, f, mode, training = data
+    start = time.time()
+    yield from _checked("prodigal -i %s -d %s_genes.seqs -m -c %s -a %s_genes.pep" % (f, f, _prodigal_mode(mode, training), f), True)
+    return time.time()-start
 
 def _prodigal_workflow_inter(data):
-    tn,f = data
+    tn, f, mode, training = data
     name = f.replace(".fasta.new","")
-    subprocess.check_call("prodigal -i %s -d %s_genes.seqs -a %s_genes.pep -f gff -m -c -o %s.prodigal > /dev/null 2>&1" % (f, f, f, name), shell=True)
-    inverse_coding_regions("%s.prodigal" % name, name)
-    parse_ranges_file(f,"%s.ranges" % name,name,test="false")
+    start = time.time()
+    yield from _checked("prodigal -i %s -d %s_genes.seqs -a %s_genes.pep -f gff -m -c %s -o %s.prodigal" % (f, f, f, _prodigal_mode(mode, training), name), True)
+    elapsed = time.time()-start
+    """the step runs on a thread, so its output can't depend on the working directory"""
+    intergenics = os.path.join(os.path.dirname(os.path.abspath(f)), "%s.intergenics.seqs" % get_seq_name(name))
+    yield lambda: write_intergenic_regions(read_fasta(f), parse_gff_ranges("%s.prodigal" % name), intergenics)
+    return elapsed
+
+def train_prodigal(files, training, outfile):
+    """train Prodigal once, for every genome. training is either a genome
+    to train on, or "T" to train on a subset of the genomes: those closest
+    to the median size, up to 5 genomes or 20Mb, concatenated"""
+    if training == "T":
+        sizes = sorted(zip(get_job_sizes([[str(idx), f] for idx, f in enumerate(files)]), files))
+        median = sizes[len(sizes)//2][0]
+        subset = []
+        total = 0
+        for size, f in sorted(sizes, key=lambda x: abs(x[0]-median)):
+            if len(subset) == 5 or (len(subset)>0 and total+size > 20000000):
+                break
+            subset.append(f)
+            total += size
+        training = "%s.subset" % outfile
+        with open(training, "w") as output_handle:
+            for f in subset:
+                with open(f) as infile:
+                    shutil.copyfileobj(infile, output_handle)
+        logPrint("training Prodigal on %s" % ",".join([get_seq_name(f) for f in subset]))
+    else:
+        logPrint("training Prodigal on %s" % get_seq_name(training))
+        if is_compressed(training):
+            """a training genome given outside of the run is decompressed once, here"""
+            with open_input(training) as infile:
+                with open("%s.genome" % outfile, "w") as output_handle:
+                    shutil.copyfileobj(infile, output_handle, 1048576)
+            training = "%s.genome" % outfile
+    run_measured("prodigal -i %s -t %s -c > /dev/null 2>&1" % (training, outfile), shell=True, check=True)
+    return outfile
+
+def count_fasta_records(in_fasta):
+    count = 0
+    with open(in_fasta) as infile:
+        for line in infile:
+            if line.startswith(">"):
+                count += 1
+    return count
+
+def report_prodigal_training(files, elapsed, report, sample=3):
+    """write the prediction time (as measured by the run) and gene count of
+    every genome to report. Prodigal is run again with training on each
+    genome for the first sample genomes, to compare"""
+    outfile = open(report, "w")
+    outfile.write("genome\tshared_seconds\tshared_genes\tself_seconds\tself_genes\n")
+    shared_total = []
+    self_total = []
+    for idx, f in enumerate(files):
+        genes = count_fasta_records("%s_genes.pep" % f)
+        if idx < sample:
+            start = time.time()
+            run_measured("prodigal -i %s -a %s.self_genes.pep -m -c -p single > /dev/null 2>&1" % (f, f), shell=True)
+            self_seconds = time.time()-start
+            self_genes = count_fasta_records("%s.self_genes.pep" % f)
+            os.remove("%s.self_genes.pep" % f)
+            shared_total.append(elapsed[idx])
+            self_total.append(self_seconds)
+            outfile.write("%s\t%.2f\t%s\t%.2f\t%s\n" % (get_seq_name(f),elapsed[idx],genes,self_seconds,self_genes))
+        else:
+            outfile.write("%s\t%.2f\t%s\tNA\tNA\n" % (get_seq_name(f),elapsed[idx],genes))
+    outfile.close()
+    if len(self_total)>0:
+        logPrint("Prodigal with a shared training file: %.2fs per genome, trained on each genome: %.2fs per genome" %
+                 (sum(shared_total)/len(shared_total), sum(self_total)/len(self_total)))
+
+COMPLEMENT = bytes.maketrans(b"ACGTRYKMBVDHNacgtrykmbvdhn", b"TGCAYRMKVBHDNtgcayrmkvbhdn")
+
+def reverse_complement(seq):
+    return seq.translate(COMPLEMENT)[::-1]
+
+def find_genome_annotations(directory):
+    """GFF3 files that sit next to a genome with the same name
+    (genome.fasta + genome.gff), as {genome.fasta:gff}"""
+    annotations = {}
+    for infile in glob.glob(os.path.join(directory, "*.fasta"))+glob.glob(os.path.join(directory, "*.fasta.gz")):
+        name = get_seq_name(infile).replace(".gz","")
+        for ext in [".gff", ".gff3", ".gff.gz", ".gff3.gz"]:
+            gff = os.path.join(directory, name.replace(".fasta","")+ext)
+            if os.path.exists(gff):
+                annotations[name] = gff
+                break
+    return annotations
+
+def parse_gff_cds(gff):
+    """CDS features of a GFF3 file as {id:[(contig,start,end,strand)]},
+    in file order. Segments of a CDS share an ID and are kept together"""
+    genes = OrderedDict()
+    with open_input(gff) as infile:
+        for line in infile:
+            if line.startswith("##FASTA"):
+                break
+            if line.startswith("#"):
+                continue
+            fields = line.rstrip("\n").split("\t")
+            if len(fields)<9 or fields[2] != "CDS":
+                continue
+            attributes = dict([x.split("=",1) for x in fields[8].split(";") if "=" in x])
+            gene_id = attributes.get("ID", attributes.get("locus_tag", "%s_%s_%s" % (fields[0],fields[3],fields[4])))
+            try:
+                genes.setdefault(gene_id, []).append((fields[0], int(fields[3]), int(fields[4]), fields[6]))
+            except ValueError:
+                print("Error - unrecognized format in .gff file: %s" % line.strip())
+    return genes
+
+def coding_gaps(ranges):
+    """regions between (start, stop) coding ranges on a contig, 1-based. Regions
+    after the last range are not included, as with inverse_coding_regions.
+    Unlike inverse_coding_regions, which only compares each start with the
+    stop of the range before it, a gap must also be past the end of every
+    earlier range: a gene nested in a longer one doesn't open a gap inside it"""
+    gaps = []
+    last_stop = 0
+    for start, stop in sorted(ranges):
+        if last_stop+1 < start:
+            gaps.append((last_stop+1, start-1))
+        last_stop = max(last_stop, stop)
+    return gaps
+
+def parse_gff_ranges(gff):
+    """coding ranges of a GFF file (e.g. from Prodigal) as {contig:[(start,stop)]}"""
+    ranges = {}
+    with open_input(gff) as infile:
+        for line in infile:
+            if line.startswith("##FASTA"):
+                break
+            if line.startswith("#"):
+                continue
+            fields = line.split("\t")
+            try:
+                ranges.setdefault(fields[0], []).append((int(fields[3]), int(fields[4])))
+            except (IndexError, ValueError):
+                print("Error - unrecognized format in .gff file: %s" % line.strip())
+    return ranges
+
+def write_intergenic_regions(genome, ranges, outfile):
+    """write the regions longer than 50 nucleotides between the coding
+    ranges ({contig:[(start,stop)]}) of a genome, given as (contig,sequence)
+    records. Each contig is sliced as it is read"""
+    output_handle = open(outfile, "w")
+    for contig, seq in genome:
+        if contig not in ranges:
+            continue
+        for start, stop in coding_gaps(ranges[contig]):
+            if stop-start+1>50:
+                output_handle.write(">%s_%s_%s\n%s\n" % (contig, start-1, stop, seq[start-1:stop].decode()))
+    output_handle.close()
+
+def _perform_workflow_gff(data):
+    """extract the CDS of an annotated genome, in place of Prodigal"""
+    tn, f, gff, intergenics = data
+    genome = dict(read_fasta(f))
+    ranges = OrderedDict()
+    seqs_handle = open("%s_genes.seqs" % f, "w")
+    pep_handle = open("%s_genes.pep" % f, "w")
+    for gene_id, segments in parse_gff_cds(gff).items():
+        parts = []
+        for contig, start, stop, strand in sorted(segments, key=lambda x: x[1]):
+            ranges.setdefault(contig, []).append((start, stop))
+            if contig in genome:
+                parts.append(genome[contig][start-1:stop])
+        if len(parts) == 0:
+            print("%s is not on a contig in %s" % (gene_id, get_seq_name(f)))
+            continue
+        seq = b"".join(parts)
+        if segments[0][3] == "-":
+            seq = reverse_complement(seq)
+        seq = seq.decode()
+        seqs_handle.write(">%s\n%s\n" % (gene_id, seq))
+        try:
+            pep_handle.write(">%s\n%s\n" % (gene_id, translate_seq(seq)))
+        except TypeError:
+            print("odd characters observed in sequence %s" % gene_id)
+    seqs_handle.close()
+    pep_handle.close()
+    if intergenics == "T":
+        name = get_seq_name(f).replace(".fasta.new","")
+        write_intergenic_regions(genome.items(), ranges, "%s.intergenics.seqs" % name)
+
+def split_large_genome(genome, split_size):
+    """split a genome larger than split_size (bytes) into batches of
+    whole contigs, so that a single large assembly or metagenome can
+    be processed in parallel. Returns the files to process"""
+    if int(split_size) <= 0 or get_job_sizes([["0", genome]])[0] <= int(split_size):
+        return [genome]
+    batches = []
+    batch_size = 0
+    outfile = None
+    with open(genome) as infile:
+        for line in infile:
+            if line.startswith(">") and (outfile is None or batch_size >= int(split_size)):
+                if outfile is not None:
+                    outfile.close()
+                batch = "%s.batch_%s" % (genome, len(batches)+1)
+                batches.append(batch)
+                outfile = open(batch, "w")
+                batch_size = 0
+            if outfile is not None:
+                outfile.write(line)
+                batch_size += len(line)
+    if outfile is not None:
+        outfile.close()
+    if len(batches) == 1:
+        """a single contig larger than the threshold can't be split"""
+        os.remove(batches[0])
+        return [genome]
+    return batches
+
+def expand_large_genomes(files, split_size):
+    """replace each genome larger than split_size with its contig batches"""
+    expanded = []
+    for f in files:
+        batches = split_large_genome(f, split_size)
+        if len(batches)>1:
+            logPrint("%s split into %s contig batches" % (get_seq_name(f), len(batches)))
+        expanded.extend(batches)
+    return expanded
+
+def merge_genome_batches(suffix):
+    """concatenate per-batch outputs (genome.batch_N + suffix) back into
+    a single output per genome (genome + suffix)"""
+    curr_dir=os.getcwd()
+    merged = {}
+    for infile in glob.glob(os.path.join(curr_dir, "*.batch_*%s" % suffix)):
+        match = re.match(r"(.*)\.batch_(\d+)%s$" % re.escape(suffix), infile)
+        if match:
+            try:
+                merged[match.group(1)+suffix].append((int(match.group(2)), infile))
+            except KeyError:
+                merged[match.group(1)+suffix] = [(int(match.group(2)), infile)]
+    for outname, batches in merged.items():
+        with open(outname, "w") as outfile:
+            for idx, infile in sorted(batches):
+                with open(infile) as batch:
+                    shutil.copyfileobj(batch, outfile)
+                os.remove(infile)
+    return sorted(merged)
+
+def skip_failed_genomes(failed, suffix):
+    """leave out every genome with a failed (or timed out) search, rather
+    than keeping its partial output. failed holds the genome or batch of
+    each failed job, and None for the others"""
+    genomes = set([re.sub(r"\.batch_\d+$", "", f) for f in failed if f is not None])
+    for genome in sorted(genomes):
+        for outfile in [genome+suffix]+glob.glob("%s.batch_*%s" % (genome, suffix)):
+            if os.path.exists(outfile):
+                os.remove(outfile)
+        logPrint("%s was left out, its search failed" % get_seq_name(genome))
+    return sorted(genomes)
+
+def remove_genome_batches():
+    """remove batch genomes and their databases once outputs are merged"""
+    curr_dir=os.getcwd()
+    for infile in glob.glob(os.path.join(curr_dir, "*.batch_*")):
+        os.remove(infile)
 
-def predict_genes(fastadir, processors, intergenics):
+def predict_genes(fastadir, processors, intergenics, split_size=0, mem_budget=0, annotations=None, training="F", compare_training="F"):
     """simple gene prediction using Prodigal in order
-    to find coding regions from a genome sequence"""
+    to find coding regions from a genome sequence. Genomes
+    with a GFF3 file ({genome.fasta:gff}) are not predicted,
+    their CDS are taken from the annotation. With training
+    ("T" or a genome), Prodigal is trained once for all genomes,
+    and with compare_training, a few genomes are also predicted
+    with their own training to compare"""
     os.chdir("%s" % fastadir)
+    if annotations is None:
+        annotations = {}
     files = []
+    annotated = []
     for file in os.listdir(fastadir):
         if file.endswith(".fasta.new"):
-            files.append(file)
-    files_and_temp_names = [(str(idx), os.path.join(fastadir, f))
-                            for idx, f in enumerate(files)]
+            if file.replace(".new","") in annotations:
+                annotated.append((str(len(annotated)), os.path.join(fastadir, file),
+                                  annotations[file.replace(".new","")], intergenics))
+            else:
+                files.append(os.path.join(fastadir, file))
+    if len(annotated)>0:
+        logPrint("taking genes from GFF3 files for %s genomes" % len(annotated))
+        mp_shell(_perform_workflow_gff, annotated, processors)
+    if len(files) == 0:
+        return
+    if training != "F":
+        training_file = train_prodigal(files, training, os.path.join(fastadir, "prodigal_training.trn"))
+    else:
+        training_file = None
+    files_and_temp_names = []
+    for idx, f in enumerate(expand_large_genomes(files, split_size)):
+        """batches of a split genome are treated as a metagenome,
+        unless there is a shared training file"""
+        if ".batch_" in f:
+            files_and_temp_names.append((str(idx), f, "meta", training_file))
+        else:
+            files_and_temp_names.append((str(idx), f, "single", training_file))
     if intergenics == "F":
-        mp_shell(_prodigal_workflow_def, files_and_temp_names, processors)
+        elapsed = run_tool_jobs(_prodigal_workflow_def, files_and_temp_names, processors, mem_budget, get_job_sizes(files_and_temp_names))
+    else:
+        elapsed = run_tool_jobs(_prodigal_workflow_inter, files_and_temp_names, processors, mem_budget, get_job_sizes(files_and_temp_names))
+    for suffix in ["_genes.seqs", "_genes.pep", ".intergenics.seqs"]:
+        merge_genome_batches(suffix)
+    remove_genome_batches()
+    if training_file is not None:
+        """batches are left out of the comparison, their outputs have been merged"""
+        unsplit = [(data[1], seconds) for data, seconds in zip(files_and_temp_names, elapsed) if ".batch_" not in data[1]]
+        if compare_training == "T":
+            sample = 3
+        else:
+            sample = 0
+        report_prodigal_training([x[0] for x in unsplit], [x[1] for x in unsplit],
+                                 os.path.join(fastadir, "prodigal_training_report.txt"), sample)
+
+def _file_digest(f):
+    digest = hashlib.sha1()
+    with open(f, "rb") as infile:
+        for block in iter(lambda: infile.read(1048576), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _genome_database_job(f, dbtype):
+    if BLAST_DB_CACHE[0] is None:
+        yield from _checked(["makeblastdb", "-in", f, "-dbtype", dbtype])
+        return f
+    digest = yield lambda: _file_digest(f)
+    db = os.path.join(BLAST_DB_CACHE[0], "%s_%s" % (get_seq_name(f), digest))
+    if not os.path.exists("%s.done" % db):
+        yield from _checked(["makeblastdb", "-in", f, "-dbtype", dbtype, "-out", db])
+        """only complete databases are marked for reuse"""
+        open("%s.done" % db, "w").close()
+    return db
+
+def _genome_query(f, default, queries):
+    """the query file for a genome (or one of its batches) in a selective
+    search, None if nothing is left to search it for"""
+    if queries is None:
+        return default
+    key = re.sub(r"\.fasta\.new.*$", "", get_seq_name(f))
+    if key not in queries:
+        return default
+    if os.path.getsize(queries[key][0]) == 0:
+        return None
+    return queries[key][0]
+
+def selective_search_choice(selective_search, dup_toggle, f_plog):
+    """duplicate detection (-z, or -t to filter paralogs) counts every hit
+    of a gene in a genome, but a selective search only aligns most genes
+    against their cluster member, so paralogs would be undercounted. In
+    that case every genome is searched for every gene instead"""
+    if selective_search == "T" and (dup_toggle == "T" or "T" in f_plog):
+        logPrint("selective search isn't used with duplicate detection, which needs every hit, searching every genome for every gene")
+        return "F"
+    return selective_search
+
+def write_selective_queries(membership, consensus, cluster_input, fastadir):
+    """split the consensus for each genome into the genes it has no cluster
+    member for, which are searched against the whole genome, and the genes
+    it has a member for, which are only aligned against those members.
+    Returns {genome:(queries, member queries, members)}"""
+    genes = list(read_fasta(consensus))
+    needed = set([member for row in membership.values() for member, identity in row.values()])
+    member_seqs = dict([(name, seq) for name, seq in read_fasta(cluster_input) if name in needed])
+    genomes = set()
+    for pattern in ["*.fasta.new", "*.fasta.new_genes.pep"]:
+        for f in glob.glob(os.path.join(fastadir, pattern)):
+            genomes.add(re.sub(r"\.fasta\.new.*$", "", get_seq_name(f)))
+    selective = {}
+    skipped = 0
+    for genome in sorted(genomes):
+        paths = ("%s/%s.selective_queries" % (fastadir, genome),
+                 "%s/%s.selective_member_queries" % (fastadir, genome),
+                 "%s/%s.selective_members" % (fastadir, genome))
+        covered = [(name, seq) for name, seq in genes if genome in membership.get(name, {})]
+        write_fasta(paths[0], [(name, seq) for name, seq in genes if genome not in membership.get(name, {})])
+        write_fasta(paths[1], covered)
+        members = OrderedDict()
+        for name, seq in covered:
+            member = membership[name][genome][0]
+            members[member] = member_seqs[member]
+        write_fasta(paths[2], members.items())
+        skipped += len(covered)
+        selective[genome] = paths
+    total = len(genes)*len(genomes)
+    if total>0:
+        logPrint("%s of %s gene x genome pairs resolved by clustering, %.1f%% of the genome searches skipped" %
+                 (skipped, total, float(skipped)/total*100))
+    return selective
+
+def _perform_workflow_members(data):
+    """align the genes that a genome has a cluster member for against those members only"""
+    tn, outfile, blast, my_seg, member_queries, members = data
+    if blast == "tblastn" or blast == "blastp":
+        cmd = [blast, "-query", member_queries, "-subject", members, "-seg", my_seg,
+               "-comp_based_stats", "F", "-evalue", "0.1", "-outfmt", "6", "-out", outfile]
+    elif blast == "blat":
+        cmd = ["blat", "-out=blast8", "-minIdentity=75", members, member_queries, outfile]
+    else:
+        cmd = ["blastn", "-task", blast, "-query", member_queries, "-subject", members, "-dust", my_seg,
+               "-evalue", "0.1", "-outfmt", "6", "-out", outfile]
+    yield (cmd, False)
+
+def search_cluster_members(blast, selective, filter, processors, fastadir):
+    """align each gene against the cluster member of every genome that has
+    one, and add the hits to that genome's search results"""
+    if blast == "blastn" or blast == "blastn-short":
+        if "F" in filter:
+            my_seg = "yes"
+        else:
+            my_seg = "no"
+    elif "T" in filter:
+        my_seg = "yes"
     else:
-        mp_shell(_prodigal_workflow_inter, files_and_temp_names, processors)
+        my_seg = "no"
+    files_and_temp_names = []
+    for genome, paths in sorted(selective.items()):
+        if os.path.getsize(paths[1]) > 0:
+            files_and_temp_names.append([str(len(files_and_temp_names)), "%s/%s.member_hits" % (fastadir, genome),
+                                         blast, my_seg, paths[1], paths[2]])
+    if len(files_and_temp_names) > 0:
+        run_tool_jobs(_perform_workflow_members, files_and_temp_names, processors)
+    for data in files_and_temp_names:
+        genome = get_seq_name(data[1]).replace(".member_hits","")
+        with open("%s/%s.fasta.new_blast.out" % (fastadir, genome), "a") as outfile:
+            if os.path.exists(data[1]):
+                with open(data[1]) as infile:
+                    shutil.copyfileobj(infile, outfile)
+                os.remove(data[1])
+
+def read_matrix_genomes(matrix):
+    """the genome (column) names of a BSR matrix"""
+    with open(matrix) as infile:
+        return infile.readline().split()
+
+def read_matrix_centroids(matrix):
+    """the centroid (row) names of a BSR matrix"""
+    centroids = []
+    with open(matrix) as infile:
+        infile.readline()
+        for line in infile:
+            fields = line.split()
+            if len(fields)>0:
+                centroids.append(fields[0])
+    return centroids
+
+def split_novel_genes(genes, hits, id, min_len, outfile):
+    """genes with a hit to the existing consensus at the clustering identity,
+    covering min_len of the gene, would have joined an existing cluster.
+    The rest are written to outfile. Returns {matched gene:centroid}"""
+    lengths = dict([(name, len(seq)) for name, seq in read_fasta(genes)])
+    matched = {}
+    with open(hits) as infile:
+        for line in infile:
+            fields = line.split()
+            if len(fields)<4 or fields[0] in matched or fields[0] not in lengths:
+                continue
+            if float(fields[2])>=float(id)*100 and int(fields[3])>=float(min_len)*lengths[fields[0]]:
+                matched[fields[0]] = fields[1]
+    novel = write_fasta(outfile, [(name, seq) for name, seq in read_fasta(genes) if name not in matched])
+    logPrint("%s of %s genes matched the existing consensus, %s are novel" % (len(matched), len(lengths), novel))
+    return matched
+
+def append_novel_centroids(old_consensus, consensus, novel_out):
+    """add the centroids of the novel genes after the existing consensus.
+    Centroid IDs already used by the existing consensus are numbered, so
+    existing IDs never change. The novel centroids are also written to
+    novel_out. Returns their IDs"""
+    old_ids = set(get_cluster_ids(old_consensus))
+    novel = []
+    for name, seq in read_fasta(consensus):
+        count = 1
+        unique_name = name
+        while unique_name in old_ids:
+            count += 1
+            unique_name = "%s_%s" % (name, count)
+        old_ids.add(unique_name)
+        novel.append((unique_name, seq))
+    write_fasta(novel_out, novel)
+    write_fasta(consensus, list(read_fasta(old_consensus))+novel)
+    return [name for name, seq in novel]
+
+def merge_update_matrix(old_matrix, new_matrix, outfile, sort_rows=False, corner="", missing="0.0000"):
+    """keep every value of the previous matrix; new genomes are added as
+    columns after the old ones and new centroids as rows after the old ones,
+    or with sort_rows, in sorted order with the old ones. corner is the
+    label of the ID column in the header (e.g. "ID" in dup_matrix.txt)"""
+    def read_matrix(matrix):
+        rows = OrderedDict()
+        with open(matrix) as infile:
+            genomes = infile.readline().split()
+            if corner:
+                genomes = genomes[1:]
+            for line in infile:
+                fields = line.split()
+                if len(fields)>0:
+                    rows[fields[0]] = dict(zip(genomes, fields[1:]))
+        return genomes, rows
+    old_genomes, old_rows = read_matrix(old_matrix)
+    new_genomes, new_rows = read_matrix(new_matrix)
+    genomes = old_genomes+[x for x in new_genomes if x not in old_genomes]
+    centroids = list(old_rows)+[x for x in new_rows if x not in old_rows]
+    if sort_rows:
+        centroids = sorted(centroids)
+    with open(outfile, "w") as output:
+        output.write(corner+"\t"+"\t".join(genomes)+"\n")
+        for centroid in centroids:
+            row = old_rows.get(centroid, {})
+            values = [row.get(x, new_rows.get(centroid, {}).get(x, missing)) for x in genomes]
+            output.write("%s\t%s\n" % (centroid, "\t".join(values)))
+    return len(genomes), len(centroids)
+
+def write_duplicate_ids(dup_matrix, outfile):
+    """write the clusters with more than one copy in any genome of
+    dup_matrix, in the order of its rows. Returns them"""
+    duplicate_IDs = []
+    with open(dup_matrix) as infile:
+        infile.readline()
+        for line in infile:
+            fields = line.split()
+            if len(fields)>1 and max([int(x) for x in fields[1:]])>1:
+                duplicate_IDs.append(fields[0])
+    duplicate_file = open(outfile, "w")
+    duplicate_file.write("\n".join(duplicate_IDs))
+    duplicate_file.close()
+    return duplicate_IDs
 
 def _perform_workflow_blat_genome(data):
     tn = data[0]
@@ -910,64 +2189,79 @@ def _perform_workflow_blat_genome(data):
     database = data[2]
     if ".fasta.new" in f:
         try:
-            subprocess.check_call("blat -out=blast8 -minIdentity=75 %s %s %s_blast.out > /dev/null 2>&1" % (f,database,f), shell=True)
-        except:
+            yield from _checked(["blat", "-out=blast8", "-minIdentity=75", f, database, "%s_blast.out" % f])
+        except Exception:
             print("genomes %s cannot be used" % f)
+            return f
 
-def blat_against_each_genome_dev(database,processors):
+def blat_against_each_genome_dev(database,processors,split_size=0,mem_budget=0,queries=None):
     """BLAT all genes against each genome"""
     curr_dir=os.getcwd()
     files = []
     for file in os.listdir(curr_dir):
         if file.endswith(".fasta.new"):
-            files.append(file)
+            files.append(os.path.join(curr_dir, file))
     files_and_temp_names = []
-    for idx,f in enumerate(files):
-        files_and_temp_names.append([str(idx), os.path.join(curr_dir, f), database])
-    mp_shell(_perform_workflow_blat_genome,files_and_temp_names,processors)
+    for idx,f in enumerate(expand_large_genomes(files, split_size)):
+        query = _genome_query(f, database, queries)
+        if query is None:
+            open("%s_blast.out" % f, "w").close()
+            continue
+        files_and_temp_names.append([str(idx), f, query])
+    failed = run_tool_jobs(_perform_workflow_blat_genome,files_and_temp_names,processors,mem_budget,get_job_sizes(files_and_temp_names,database))
+    skip_failed_genomes(failed, "_blast.out")
+    merge_genome_batches("_blast.out")
+    remove_genome_batches()
 
 def _perform_workflow_tblastn(data):
     tn = data[0]
     f = data[1]
     my_seg = data[2]
     peptides = data[3]
-    if f.endswith(".fasta.new"):
+    db = f
+    if ".fasta.new" in f:
         try:
-            subprocess.check_call("makeblastdb -in %s -dbtype nucl > /dev/null 2>&1" % f, shell=True)
-        except:
+            db = yield from _genome_database_job(f, "nucl")
+        except Exception:
             print("problem found in formatting genome %s" % f)
-    if ".fasta.new" in f:
+            return f
         try:
-            devnull = open('/dev/null', 'w')
             cmd = ["tblastn",
                    "-query", peptides,
-                   "-db", f,
+                   "-db", db,
                    "-seg", my_seg,
                    "-comp_based_stats", "F",
                    "-num_threads", "1",
                    "-evalue", "0.1",
                    "-outfmt", "6",
                    "-out", "%s_blast.out" % f]
-            subprocess.call(cmd, stdout=devnull, stderr=devnull)
-            devnull.close()
-        except:
+            yield from _checked(cmd)
+        except Exception:
             print("genomes %s cannot be used" % f)
+            return f
 
-def blast_against_each_genome_tblastn_dev(processors, peptides, filter):
+def blast_against_each_genome_tblastn_dev(processors, peptides, filter, split_size=0, mem_budget=0, queries=None):
     """BLAST all peptides against each genome"""
     curr_dir=os.getcwd()
     files = []
     for file in os.listdir(curr_dir):
         if file.endswith(".fasta.new"):
-            files.append(file)
+            files.append(os.path.join(curr_dir, file))
     if "T" in filter:
         my_seg = "yes"
     else:
         my_seg = "no"
     files_and_temp_names = []
-    for idx, f in enumerate(files):
-        files_and_temp_names.append([str(idx), os.path.join(curr_dir, f), my_seg, peptides])
-    mp_shell(_perform_workflow_tblastn, files_and_temp_names, processors)
+    for idx, f in enumerate(expand_large_genomes(files, split_size)):
+        query = _genome_query(f, peptides, queries)
+        if query is None:
+            open("%s_blast.out" % f, "w").close()
+            continue
+        files_and_temp_names.append([str(idx), f, my_seg, query])
+    failed = run_tool_jobs(_perform_workflow_tblastn, files_and_temp_names, processors, mem_budget, get_job_sizes(files_and_temp_names, peptides))
+    skip_failed_genomes(failed, "_blast.out")
+    merge_genome_batches("_blast.out")
+    remove_genome_batches()
 
 def _perform_workflow_diamond(data):
     tn = data[0]
@@ -975,10 +2269,10 @@ def _perform_workflow_diamond(data):
     peptides = data[2]
     name = f.replace(".new_genes.pep",".new")
     try:
-        subprocess.check_call("diamond makedb --in %s -d %s > /dev/null 2>&1" % (f,name), shell=True)
-    except:
+        yield from _checked(["diamond", "makedb", "--in", f, "-d", name])
+    except Exception:
         print("problem found in formatting annotation %s" % f)
-    devnull = open('/dev/null', 'w')
+        return name
     cmd = ["diamond",
            "blastp",
            "-p", "1",
@@ -986,21 +2280,27 @@ def _perform_workflow_diamond(data):
            "-f", "6",
            "-q", peptides,
            "-o", "%s_blast.out" % name]
-    subprocess.call(cmd, stdout=devnull, stderr=devnull)
-    devnull.close()
+    try:
+        yield from _checked(cmd)
+    except Exception:
+        print("annotation %s cannot be used" % f)
+        return name
 
-def diamond_against_each_annotation(peptides,processors):
+def diamond_against_each_annotation(peptides,processors,split_size=0,mem_budget=0):
     curr_dir=os.getcwd()
     files_and_temp_names = []
     annotation_files = []
     for files in os.listdir(curr_dir):
         if "new_genes.pep" in files:
-            annotation_files.append(files)
-    for idx, f in enumerate(annotation_files):
-        files_and_temp_names.append([str(idx), os.path.join(curr_dir, f), peptides])
-    mp_shell(_perform_workflow_diamond, files_and_temp_names, processors)
-
-def blastp_against_each_annotation(peptides,processors,filter):
+            annotation_files.append(os.path.join(curr_dir, files))
+    for idx, f in enumerate(expand_large_genomes(annotation_files, split_size)):
+        files_and_temp_names.append([str(idx), f, peptides])
+    failed = run_tool_jobs(_perform_workflow_diamond, files_and_temp_names, processors, mem_budget, get_job_sizes(files_and_temp_names, peptides))
+    skip_failed_genomes(failed, "_blast.out")
+    merge_genome_batches("_blast.out")
+    remove_genome_batches()
+
+def blastp_against_each_annotation(peptides,processors,filter,split_size=0,mem_budget=0,queries=None):
     curr_dir=os.getcwd()
     files_and_temp_names = []
     annotation_files = []
@@ -1010,12 +2310,19 @@ def blastp_against_each_annotation(peptides,processors,filter):
         my_seg = "no"
     for files in os.listdir(curr_dir):
         if "new_genes.pep" in files:
-            annotation_files.append(files)
+            annotation_files.append(os.path.join(curr_dir, files))
         elif ".pep.new" in files:
-            annotation_files.append(files)
-    for idx, f in enumerate(annotation_files):
-        files_and_temp_names.append([str(idx), os.path.join(curr_dir, f), my_seg, peptides])
-    mp_shell(_perform_workflow_blastp, files_and_temp_names, processors)
+            annotation_files.append(os.path.join(curr_dir, files))
+    for idx, f in enumerate(expand_large_genomes(annotation_files, split_size)):
+        query = _genome_query(f, peptides, queries)
+        if query is None:
+            open("%s_blast.out" % f.replace(".new_genes.pep",".new"), "w").close()
+            continue
+        files_and_temp_names.append([str(idx), f, my_seg, query])
+    failed = run_tool_jobs(_perform_workflow_blastp, files_and_temp_names, processors, mem_budget, get_job_sizes(files_and_temp_names, peptides))
+    skip_failed_genomes(failed, "_blast.out")
+    merge_genome_batches("_blast.out")
+    remove_genome_batches()
 
 def _perform_workflow_blastp(data):
     tn = data[0]
@@ -1024,22 +2331,72 @@ def _perform_workflow_blastp(data):
     peptides = data[3]
     """Makes the name consistent with other analyses"""
     name = f.replace(".new_genes.pep",".new")
+    db = f
     try:
-        subprocess.check_call("makeblastdb -in %s -dbtype prot > /dev/null 2>&1" % f, shell=True)
-    except:
+        db = yield from _genome_database_job(f, "prot")
+    except Exception:
         print("problem found in formatting annotation %s" % f)
-    devnull = open('/dev/null', 'w')
+        return name
     cmd = ["blastp",
            "-query", peptides,
-           "-db", f,
+           "-db", db,
            "-seg", my_seg,
            "-comp_based_stats", "F",
            "-num_threads", "1",
            "-evalue", "0.1",
            "-outfmt", "6",
            "-out", "%s_blast.out" % name]
-    subprocess.call(cmd, stdout=devnull, stderr=devnull)
-    devnull.close()
+    try:
+        yield from _checked(cmd)
+    except Exception:
+        print("annotation %s cannot be used" % f)
+        return name
+
+def blastp_orfs_against_consensus(peptides,processors,filter,split_size=0,mem_budget=0):
+    """Inverted search: the ORFs of each genome are the query and the
+    consensus peptides are the database, so a single database is built
+    instead of one per genome"""
+    curr_dir=os.getcwd()
+    files_and_temp_names = []
+    annotation_files = []
+    if "T" in filter:
+        my_seg = "yes"
+    else:
+        my_seg = "no"
+    for files in os.listdir(curr_dir):
+        if "new_genes.pep" in files:
+            annotation_files.append(os.path.join(curr_dir, files))
+        elif ".pep.new" in files:
+            annotation_files.append(os.path.join(curr_dir, files))
+    for idx, f in enumerate(expand_large_genomes(annotation_files, split_size)):
+        files_and_temp_names.append([str(idx), f, my_seg, peptides])
+    failed = run_tool_jobs(_perform_workflow_blastp_orf, files_and_temp_names, processors, mem_budget, get_job_sizes(files_and_temp_names, peptides))
+    skip_failed_genomes(failed, "_blast.out")
+    merge_genome_batches("_blast.out")
+    remove_genome_batches()
+
+def _perform_workflow_blastp_orf(data):
+    tn = data[0]
+    f = data[1]
+    my_seg = data[2]
+    peptides = data[3]
+    name = f.replace(".new_genes.pep",".new")
+    """subject and query columns are swapped, so that the consensus gene is
+    in the first column and hits are reduced per consensus gene"""
+    cmd = ["blastp",
+           "-query", f,
+           "-db", peptides,
+           "-seg", my_seg,
+           "-comp_based_stats", "F",
+           "-num_threads", "1",
+           "-evalue", "0.1",
+           "-outfmt", "6 sseqid qseqid pident length mismatch gapopen sstart send qstart qend evalue bitscore",
+           "-out", "%s_blast.out" % name]
+    try:
+        yield from _checked(cmd)
+    except Exception:
+        print("annotation %s cannot be used" % f)
+        return name
 
 def _perform_workflow_blastn(data):
     tn = data[0]
@@ -1047,29 +2404,29 @@ def _perform_workflow_blastn(data):
     my_seg = data[2]
     peptides = data[3]
     algorithm = data[4]
+    db = f
     if ".fasta.new" in f:
         try:
-            subprocess.check_call("makeblastdb -in %s -dbtype nucl > /dev/null 2>&1" % f, shell=True)
-        except:
+            db = yield from _genome_database_job(f, "nucl")
+        except Exception:
             print("problem found in formatting genome %s" % f)
-    if ".fasta.new" in f:
-        devnull = open('/dev/null', 'w')
+            return f
         try:
             cmd = ["blastn",
                    "-task", algorithm,
                    "-query", peptides,
-                   "-db", f,
+                   "-db", db,
                    "-dust", str(my_seg),
                    "-num_threads", "1",
                    "-evalue", "0.1",
                    "-outfmt", "6",
                    "-out", "%s_blast.out" % f]
-            subprocess.call(cmd, stdout=devnull, stderr=devnull)
-            devnull.close()
-        except:
+            yield from _checked(cmd)
+        except Exception:
             print("The genome file %s was not processed" % f)
+            return f
 
-def blast_against_each_genome_blastn_dev(processors,algorithm,filter,peptides):
+def blast_against_each_genome_blastn_dev(processors,algorithm,filter,peptides,split_size=0,mem_budget=0,queries=None):
     """BLAST all peptides against each genome"""
     if "F" in filter:
         my_seg = "yes"
@@ -1079,176 +2436,277 @@ def blast_against_each_genome_blastn_dev(processors,algorithm,filter,peptides):
     files = []
     for file in os.listdir(curr_dir):
         if file.endswith(".fasta.new"):
-            files.append(file)
+            files.append(os.path.join(curr_dir,file))
     files_and_temp_names = []
-    for idx, f in enumerate(files):
-        files_and_temp_names.append([str(idx), os.path.join(curr_dir,f), my_seg, peptides, algorithm])
-    mp_shell(_perform_workflow_blastn, files_and_temp_names, processors)
-
-def _perform_workflow_fdd(q, my_dict_o, data):
-    tn = data[0]
-    f = data[1]
-    ref_scores = data[2]
-    length = data[3]
-    max_plog = data[4]
-    min_hlog = data[5]
-    clusters = data[6]
-    processors = data[7]
-    if "_blast.out" in f:
-        genome_specific_dict = {}
-        name = get_seq_name(f)
-        reduced_name = name.replace(".fasta.new_blast.out","")
-        genome_specific_dict["ID"] = reduced_name
-        outfile = open("%s.counts.txt" % reduced_name, "w")
-        try:
-            with open(f) as infile:
-                for line in infile:
-                    fields = line.split()
-                    if fields[0] not in ref_scores:
-                        pass
-                    elif float(fields[2]) >= int(min_hlog) and (float(fields[11]) / float(ref_scores.get(fields[0]))) >= float(length):
-                        try:
-                            my_dict_o[fields[0]].append(fields[11])
-                            genome_specific_dict[fields[0]].append(fields[11])
-                        except KeyError:
-                            my_dict_o[fields[0]] = [fields[11]]
-                            genome_specific_dict[fields[0]] = [fields[11]]
-                    else:
-                        continue
-        except:
-            raise TypeError("problem parsing %s" % f)
-
-        new_dict = {}
-        for k,v in genome_specific_dict.items():
-            if k == "ID":
-                pass
-            else:
-                if k in clusters:
-                    try:
-                        new_dict.update({k:len(v)})
-                    except:
-                        new_dict.update({k:"0"})
-        """This makes sure that every cluster is included"""
-        od = collections.OrderedDict(sorted(new_dict.items()))
-        ids = collections.OrderedDict({"ID":reduced_name})
-        both = collections.OrderedDict(list(ids.items())+list(new_dict.items()))
-        outfile.write(list(both.values())[0]+"\n")
-        """This makes sure that the output is in order"""
-        for cluster in clusters:
-            if cluster in both:
-                outfile.write(str(both.get(cluster))+"\n")
-            else:
-                outfile.write(str("0")+"\n")
-        outfile.close()
-        return genome_specific_dict
+    for idx, f in enumerate(expand_large_genomes(files, split_size)):
+        query = _genome_query(f, peptides, queries)
+        if query is None:
+            open("%s_blast.out" % f, "w").close()
+            continue
+        files_and_temp_names.append([str(idx), f, my_seg, query, algorithm])
+    failed = run_tool_jobs(_perform_workflow_blastn, files_and_temp_names, processors, mem_budget, get_job_sizes(files_and_temp_names, peptides))
+    skip_failed_genomes(failed, "_blast.out")
+    merge_genome_batches("_blast.out")
+    remove_genome_batches()
+
+def _perform_workflow_fdd(data):
+    """copy number of each cluster in one genome, counting the hits with an
+    identity of at least min_hlog and a BSR of at least length. The counts
+    are returned as an array in the order of the clusters"""
+    tn, f, length, min_hlog = data
+    index = _worker_state["index"]
+    refs = _worker_state["refs"]
+    counts = array("i", [0])*len(refs)
+    length = float(length)
+    min_hlog = int(min_hlog)
+    try:
+        with open(f) as infile:
+            for line in infile:
+                fields = line.split()
+                i = index.get(fields[0])
+                if i is None or refs[i] == 0:
+                    continue
+                if float(fields[2]) >= min_hlog and float(fields[11])/refs[i] >= length:
+                    counts[i] += 1
+    except:
+        raise TypeError("problem parsing %s" % f)
+    return get_seq_name(f).replace(".fasta.new_blast.out",""), counts
 
 def find_dups_dev(ref_scores, length, max_plog, min_hlog, clusters, processors):
-    from multiprocessing import Manager, Pool
-    m = Manager()
-    q = m.Queue()
-    my_dict_o = m.dict()
-    p = Pool(processors)
+    """count the copies of each cluster in every genome in parallel. The
+    copy numbers are written to dup_matrix.txt and the clusters with more
+    than one copy in any genome to duplicate_ids.txt"""
     curr_dir=os.getcwd()
-    dup_dict = {}
-    duplicate_file = open("duplicate_ids.txt", "w")
-    genome_specific_list_of_lists = []
-    files = os.listdir(curr_dir)
+    share_gene_index(clusters, ref_scores)
+    index = _worker_state["index"]
+    refs = _worker_state["refs"]
     files_and_temp_names = []
-    for idx, f in enumerate(files):
-        files_and_temp_names.append([str(idx), os.path.join(curr_dir, f), ref_scores, length, max_plog, min_hlog, clusters, processors])
-    # Multiprocessing here (mp_shell for Ctrl+F)
-    """How to test this function???"""
-    for process in files_and_temp_names:
-        p.apply(_perform_workflow_fdd, args=(q,my_dict_o,process))
-    # Get rid of any duplicate values in queue
-    unique = set()
-    while q.empty() == False:
-        unique.add(q.get())
-    """This generates the list of all possible CDSs"""
-    with open("dup_refs.txt", "a") as ref_file:
-        ref_file.write("ID"+"\n")
-        ref_file.write("\n".join(clusters)+"\n")
-    ref_file.close()
-    try:
-        generate_dup_matrix()
-        os.system("paste dup_refs.txt dup_values > dup_matrix.txt")
-    except:
-        print("problem generating duplicate matrix")
-    """new way to report duplicates"""
-    duplicate_IDs = []
-    for line in open("dup_matrix.txt"):
-        fields = line.split()
-        if fields[0] == "ID":
-            pass
-        else:
-            for field in fields[1:]:
-                if float(field)>1:
-                    if fields[0] in duplicate_IDs:
-                        pass
-                    else:
-                        duplicate_IDs.append(fields[0])
+    for idx, f in enumerate(sorted(glob.glob(os.path.join(curr_dir, "*_blast.out")))):
+        files_and_temp_names.append([str(idx), f, length, min_hlog])
+    results = mp_shell(_perform_workflow_fdd, files_and_temp_names, processors)
+    """the highest copy number of each cluster across the genomes"""
+    maxima = array("i", [0])*len(refs)
+    for name, counts in results:
+        maxima = array("i", map(max, maxima, counts))
+    outfile = open("dup_matrix.txt", "w")
+    outfile.write("\t".join(["ID"]+[name for name, counts in results])+"\n")
+    for cluster in clusters:
+        i = index[cluster]
+        outfile.write("\t".join([cluster]+[str(counts[i]) for name, counts in results])+"\n")
+    outfile.close()
+    duplicate_IDs = [cluster for cluster in clusters if maxima[index[cluster]]>1]
+    duplicate_file = open("duplicate_ids.txt", "w")
     duplicate_file.write("\n".join(duplicate_IDs))
     duplicate_file.close()
     return duplicate_IDs
 
-def _perform_workflow_nl(data):
-     tn,f = data[0]
-     clusters = data[1]
-     names = data[2]
-     table_list = data[3]
-     name,values=make_table_test(f, "F", clusters)
-     names.append(name)
-     table_list.append(values)
-
-def new_loop_dev(to_iterate, processors, clusters):
-    from multiprocessing import Manager
-
-    manager = Manager()
-    names = manager.list()
-    table_list = manager.list()
-
-    files_and_temp_names_nl = []
-    for file in to_iterate:
-        files_and_temp_names_nl.append([file, clusters, names, table_list])
+"""Values of the best hit in each .filtered.unique line that can be
+written out as matrices, in the order they're kept in the matrix file"""
+HIT_METRICS = ["bitscore", "identity", "length", "hits"]
 
-    mp_shell(_perform_workflow_nl, files_and_temp_names_nl, processors)
-
-    names = list(names)
-    table_list = list(table_list)
-
-    return names,table_list
-
-def make_table_test(infile, test, clusters):
-    """make the BSR matrix table"""
-    values = []
-    names = []
-    outdata = []
-    name = get_seq_name(infile)
-    reduced=[]
-    """remove the junk at the end of the file"""
-    reduced.append(name.replace('.fasta.new_blast.out.filtered.unique',''))
-    names.append(reduced)
-    my_dict={}
-    with open(infile) as my_file:
-        """make a dictionary of all clusters and values"""
+def _perform_workflow_nl(data):
+    """write the best hit values of one genome into its part of the matrix
+    file: a column of each metric, one after another. Columns are
+    contiguous, so each genome is a single write. Only the genome name
+    is sent back"""
+    column, f, values_file, num_rows, num_metrics = data
+    index = _worker_state["index"]
+    scores = array("d", [0.0])*(num_rows*num_metrics)
+    with open(f) as my_file:
         try:
             for line in my_file:
                 fields=line.split()
-                my_dict.update({fields[0]:fields[1]})
+                i = index.get(fields[0])
+                if i is not None:
+                    for metric in range(num_metrics):
+                        scores[num_rows*metric+i] = float(fields[metric+1])
         except:
             raise TypeError("abnormal number of fields")
-    """add in values, including any potentially missing ones"""
-    for x in clusters:
-        if x not in my_dict:
-            my_dict.update({x:0})
-    for x in reduced:
-        values.append(x)
-    """sort keys to get the same order between samples"""
-    od = collections.OrderedDict(sorted(my_dict.items()))
-    values += od.values()
-    if "T" in test:
-        return sorted(outdata)
-    return names, values
+    with open(values_file, "r+b") as shared:
+        shared.seek(8*num_rows*num_metrics*column)
+        shared.write(scores.tobytes())
+    return get_seq_name(f).replace('.fasta.new_blast.out.filtered.unique','')
+
+def _write_matrix_blocks(shared, metric, num_metrics, rows, names, outfile, block_rows, format_row, corner=""):
+    """write one metric of the matrix file out a block of rows at a time"""
+    num_rows = len(rows)
+    num_genomes = len(names)
+    with open(outfile, "w") as output:
+        output.write(corner+"\t"+"\t".join(names)+"\n")
+        for first in range(0, num_rows, block_rows):
+            size = min(block_rows, num_rows-first)
+            """the block, one column after another"""
+            block = array("d")
+            if shared is not None:
+                for column in range(num_genomes):
+                    shared.seek(8*(num_rows*(num_metrics*column+metric)+first))
+                    block.fromfile(shared, size)
+            for i in range(size):
+                output.write(rows[first+i]+"\t"+"\t".join(format_row(first+i, block[i::size]))+"\n")
+
+def build_bsr_matrix(table_files, processors, clusters, ref_scores, outfile, block_mb=256, metric_files=None):
+    """BSR matrix of the sorted clusters x genomes. The row of each cluster
+    is looked up once and shared with the workers, which write the bit
+    scores of each genome into its column of a matrix file on disk. The
+    matrix is then divided by the self-scores and written out a block of
+    rows at a time, so no more than block_mb (MB) of it is held in memory.
+    Clusters without a self-score and genes without a hit are 0.
+    metric_files can name an output for the identity, aligned length and
+    hits of the best hit, which are written in the same layout. Returns
+    the genome names, in column order"""
+    share_gene_index(clusters, ref_scores)
+    rows = _worker_state["rows"]
+    refs = _worker_state["refs"]
+    table_files = sorted(table_files)
+    num_genomes = len(table_files)
+    num_rows = len(rows)
+    missing = [rows[i] for i in range(num_rows) if refs[i] == 0]
+    if num_genomes>0 and len(missing)>0:
+        logPrint("The following genes had no hits in datasets or are too short, values changed to 0, check names and output:%s" % "\n".join(missing))
+    if metric_files is None:
+        metric_files = {}
+    num_metrics = 1
+    for metric in metric_files:
+        num_metrics = max(num_metrics, HIT_METRICS.index(metric)+1)
+    if num_genomes == 0:
+        names = []
+    else:
+        values_file = "%s/bsr_values.bin" % os.path.dirname(os.path.abspath(table_files[0]))
+        with open(values_file, "wb") as shared:
+            shared.truncate(max(8*num_rows*num_metrics*num_genomes, 8))
+        names = mp_shell(_perform_workflow_nl, [(column, f, values_file, num_rows, num_metrics) for column, f in enumerate(table_files)], processors)
+    def bsr_row(i, scores):
+        return map("%.4f".__mod__, bsr_values(scores, refs[i]))
+    outputs = [(0, outfile, bsr_row)]
+    for metric, metric_file in sorted(metric_files.items()):
+        if metric == "identity":
+            outputs.append((HIT_METRICS.index(metric), metric_file, lambda i, values: map("%.3f".__mod__, values)))
+        else:
+            outputs.append((HIT_METRICS.index(metric), metric_file, lambda i, values: map("%d".__mod__, values)))
+    block_rows = max(int(float(block_mb)*1048576/(8*max(num_genomes, 1))), 1)
+    if num_genomes>0:
+        shared = open(values_file, "rb")
+    else:
+        shared = None
+    try:
+        for metric, metric_file, format_row in outputs:
+            _write_matrix_blocks(shared, metric, num_metrics, rows, names, metric_file, block_rows, format_row)
+    finally:
+        if shared is not None:
+            shared.close()
+            os.remove(values_file)
+    return names
+
+"""The hit store keeps every hit of every genome, so the matrices can be
+rebuilt with other duplicate settings without aligning again. After a
+header with the genes (sorted) and their self-scores, and the row of each
+gene in consensus order (the order of the duplicate matrix), each genome has a line with
+its name and the size of each array, followed by the arrays (gene index,
+bit score, percent identity, aligned length), little-endian and zlib
+compressed"""
+HIT_STORE_MAGIC = "#LS-BSR hit store"
+
+def _hit_record(name, stored):
+    blobs = [zlib.compress(_little_endian(values).tobytes(), 6) for values in stored]
+    header = "\t".join([name, str(len(stored[0]))]+[str(len(blob)) for blob in blobs])+"\n"
+    return header.encode()+b"".join(blobs)
+
+def write_hit_store(hit_files, outfile):
+    """put the hits kept for each genome by parse_blast_report_dev into one
+    store, with the genes and self-scores shared with the workers. The
+    genomes are in the order of the matrix. Returns the number of hits"""
+    rows = _worker_state["rows"]
+    refs = _worker_state["refs"]
+    index = _worker_state["index"]
+    total = 0
+    with open(outfile, "wb") as output:
+        output.write(("%s\n" % HIT_STORE_MAGIC).encode())
+        output.write(("\t".join(rows)+"\n").encode())
+        output.write(("\t".join([repr(ref) for ref in refs])+"\n").encode())
+        output.write(("\t".join([str(index[cluster]) for cluster in _worker_state["clusters"]])+"\n").encode())
+        for f in sorted(hit_files):
+            with open(f, "rb") as infile:
+                total += int(infile.readline().split(b"\t")[1])
+                infile.seek(0)
+                shutil.copyfileobj(infile, output, 1048576)
+            os.remove(f)
+    return total
+
+def _stored_genomes(store, offset):
+    typecodes = ["I", "d", "f", "I"]
+    with open(store, "rb") as infile:
+        infile.seek(offset)
+        for line in infile:
+            fields = line.decode().rstrip("\n").split("\t")
+            stored = []
+            for typecode, size in zip(typecodes, fields[2:]):
+                values = array(typecode)
+                values.frombytes(zlib.decompress(infile.read(int(size))))
+                stored.append(_little_endian(values))
+            yield tuple([fields[0]]+stored)
+
+def read_hit_store(store):
+    """the genes and self-scores of a hit store, the gene index of each
+    cluster in consensus order, and its genomes as (name, gene indexes,
+    bit scores, identities, aligned lengths)"""
+    with open(store, "rb") as infile:
+        if infile.readline().decode().rstrip("\n") != HIT_STORE_MAGIC:
+            raise TypeError("%s is not a hit store" % store)
+        genes = _header_names(infile.readline())
+        refs = [float(ref) for ref in _header_names(infile.readline())]
+        consensus = [int(i) for i in _header_names(infile.readline())]
+        offset = infile.tell()
+    return genes, refs, consensus, _stored_genomes(store, offset)
+
+def rebuild_from_hit_store(store, length, min_hlog, f_plog, prefix, block_mb=256):
+    """rebuild the BSR matrix, the duplicate matrix and IDs, and (with
+    f_plog) the matrix without paralogs from a hit store, with the same
+    rules as a run. Each genome is reduced in turn into a column on disk,
+    and the matrices are written out a block of rows at a time. Returns
+    the duplicate IDs"""
+    genes, refs, consensus, genomes = read_hit_store(store)
+    num_rows = len(genes)
+    """the duplicate matrix and IDs are in consensus order, as in a run"""
+    clusters = [genes[i] for i in consensus]
+    position = array("i", [0])*num_rows
+    for row, i in enumerate(consensus):
+        position[i] = row
+    length = float(length)
+    min_hlog = int(min_hlog)
+    names = []
+    maxima = array("i", [0])*num_rows
+    values_file = "%s_rebuild_values.bin" % prefix
+    with open(values_file, "wb") as shared:
+        for name, indexes, bitscores, identities, lengths in genomes:
+            """the best bit score of each gene, then the copy number of each cluster"""
+            column = array("d", [0.0])*(2*num_rows)
+            for i, bitscore, identity in zip(indexes, bitscores, identities):
+                if bitscore > column[i]:
+                    column[i] = bitscore
+                if refs[i] > 0 and identity >= min_hlog and bitscore/refs[i] >= length:
+                    column[num_rows+position[i]] += 1
+            for i in range(num_rows):
+                maxima[i] = max(maxima[i], int(column[num_rows+i]))
+            shared.write(column.tobytes())
+            names.append(name)
+    def bsr_row(i, scores):
+        if refs[i] > 0:
+            return map("%.4f".__mod__, [score/refs[i] for score in scores])
+        return ["0.0000"]*len(names)
+    block_rows = max(int(float(block_mb)*1048576/(8*max(len(names), 1))), 1)
+    with open(values_file, "rb") as shared:
+        _write_matrix_blocks(shared, 0, 2, genes, names, "%s_bsr_matrix.txt" % prefix, block_rows, bsr_row)
+        _write_matrix_blocks(shared, 1, 2, clusters, names, "%s_dup_matrix.txt" % prefix, block_rows,
+                             lambda i, values: map("%d".__mod__, values), "ID")
+    os.remove(values_file)
+    duplicate_IDs = [cluster for row, cluster in enumerate(clusters) if maxima[row]>1]
+    duplicate_file = open("%s_duplicate_ids.txt" % prefix, "w")
+    duplicate_file.write("\n".join(duplicate_IDs))
+    duplicate_file.close()
+    if "T" in f_plog:
+        filter_paralogs("%s_bsr_matrix.txt" % prefix, "%s_duplicate_ids.txt" % prefix)
+        os.rename("bsr_matrix_values_filtered.txt", "%s_paralogs_filtered_bsr_matrix_values.txt" % prefix)
+    return duplicate_IDs
 
 def inverse_coding_regions(infile,ID):
     # Key = name of genome
@@ -1299,8 +2757,9 @@ def inverse_coding_regions(infile,ID):
     outfile.close()
 
 def parse_ranges_file(genome,ranges_file,name,test):
-    """Make tuple of ranges file"""
-    ranges_tuple = ()
+    """Make tuple of ranges file. The pipeline no longer writes .ranges
+    files, intergenics come from write_intergenic_regions"""
+    ranges = {}
     sequence = []
     if "/" in name:
         name_fields = name.split("/")
@@ -1312,37 +2771,31 @@ def parse_ranges_file(genome,ranges_file,name,test):
         for line in infile:
             newline = line.strip()
             fields = newline.split()
-            ranges_tuple=((fields[0],fields[1],fields[2]),)+ranges_tuple
-    with open(genome) as genome_file:
-        for record in SeqIO.parse(genome_file,"fasta"):
-            for range_tuple in ranges_tuple:
-                if record.id == range_tuple[0]:
-                    start = int(range_tuple[1])-1
-                    end = int(range_tuple[2])
-                    if len(str(record.seq[int(start):int(end)]))>50:
-                        """This ignores regions shorter than 50 nucleotides, I think that these
-                        should be renamed based on start and end of each range"""
-                        outfile.write(">%s_%s_%s" % (range_tuple[0],start,end) +"\n")
-                        outfile.write(str(record.seq[start:end])+"\n")
-                        if "true" in test:
-                            sequence.append(str(record.seq[start:end]))
+            ranges.setdefault(fields[0], []).append((int(fields[1])-1, int(fields[2])))
+    for name, seq in read_fasta(genome):
+        for start, end in reversed(ranges.get(name, [])):
+            region = seq[start:end].decode()
+            if len(region)>50:
+                """This ignores regions shorter than 50 nucleotides, I think that these
+                should be renamed based on start and end of each range"""
+                outfile.write(">%s_%s_%s" % (name,start,end) +"\n")
+                outfile.write(region+"\n")
+                if "true" in test:
+                    sequence.append(region)
     outfile.close()
     return sequence
 
 def find_data_type(in_fasta):
-    nt = []
     aa = []
-    with open(in_fasta) as my_fasta:
-        try:
-            for record in SeqIO.parse(my_fasta, "fasta"):
-                """None of these characters are IUPACs"""
-                if "F" in record.seq or "L" in record.seq or "I" in record.seq or "P" in record.seq or "Q" in record.seq or "E" in record.seq:
-                    aa.append("1")
-                else:
-                    pass
-        except:
-            print("file cannot be parsed, is it in FASTA format?")
-            sys.exit()
+    try:
+        for name, seq in read_fasta(in_fasta):
+            """None of these characters are IUPACs"""
+            if b"F" in seq or b"L" in seq or b"I" in seq or b"P" in seq or b"Q" in seq or b"E" in seq:
+                aa.append("1")
+                break
+    except:
+        print("file cannot be parsed, is it in FASTA format?")
+        sys.exit()
     if len(aa)==0:
         data_type = "nt"
     elif len(aa)>0:
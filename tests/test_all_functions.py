@@ -5,6 +5,8 @@ from ls_bsr.util import *
 import os
 import tempfile
 import shutil
+import gzip
+import hashlib
 
 curr_dir=os.getcwd()
 
@@ -762,6 +764,947 @@ class Test25(unittest.TestCase):
         os.system("rm test.intergenics.seqs")
         shutil.rmtree(tdir)
 
+class Test26(unittest.TestCase):
+    def test_split_large_genome_basic_function(self):
+        """tests that contigs are batched once the size threshold is passed"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        fpath = os.path.join(tdir,"genome.fasta.new")
+        fp = open(fpath, "w")
+        fp.write(">contig1\nATGAAACTTGGCAGG\n")
+        fp.write(">contig2\nATGCCCAGAGGGCAT\n")
+        fp.write(">contig3\nATGAAGAAATCAATA\n")
+        fp.close()
+        self.assertEqual(split_large_genome(fpath, 40), [fpath+".batch_1", fpath+".batch_2"])
+        self.assertEqual(open(fpath+".batch_1").read(), ">contig1\nATGAAACTTGGCAGG\n>contig2\nATGCCCAGAGGGCAT\n")
+        shutil.rmtree(tdir)
+    def test_split_large_genome_small_genome(self):
+        """tests that genomes under the threshold, or with the threshold
+        turned off, are not split"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        fpath = os.path.join(tdir,"genome.fasta.new")
+        fp = open(fpath, "w")
+        fp.write(">contig1\nATGAAACTTGGCAGG\n")
+        fp.write(">contig2\nATGCCCAGAGGGCAT\n")
+        fp.close()
+        self.assertEqual(split_large_genome(fpath, 1000), [fpath])
+        self.assertEqual(split_large_genome(fpath, 0), [fpath])
+        shutil.rmtree(tdir)
+    def test_merge_genome_batches_basic_function(self):
+        """tests that batch outputs are merged back into one genome output"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        os.chdir(tdir)
+        for idx, line in [(2, "gene2\n"), (1, "gene1\n")]:
+            fp = open("genome.fasta.new.batch_%s_blast.out" % idx, "w")
+            fp.write(line)
+            fp.close()
+        self.assertEqual(merge_genome_batches("_blast.out"), [os.path.join(tdir, "genome.fasta.new_blast.out")])
+        self.assertEqual(open("genome.fasta.new_blast.out").read(), "gene1\ngene2\n")
+        self.assertEqual(os.listdir(tdir), ["genome.fasta.new_blast.out"])
+        os.chdir(curr_dir)
+        shutil.rmtree(tdir)
+
+class Test27(unittest.TestCase):
+    def test_run_measured_basic_function(self):
+        """tests that the return code is passed back and the peak is recorded"""
+        self.assertEqual(run_measured(["true"]), 0)
+        self.assertEqual(run_measured("exit 3", shell=True), 3)
+        self.assertRaises(subprocess.CalledProcessError, run_measured, "exit 3", shell=True, check=True)
+    def test_estimate_job_memory_learns(self):
+        """tests that the estimate follows what was measured"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        os.chdir(tdir)
+        self.assertEqual(estimate_job_memory("test_tool", 1048576*10), 200)
+        record_job_memory("test_tool", "/path/to/genome.fasta.new", 1048576*10, 200, 1024*300)
+        self.assertEqual(estimate_job_memory("test_tool", 1048576*10), 300)
+        self.assertEqual(open(MEMORY_LOG).read(), "test_tool\tgenome.fasta.new\t10.00\t200.0\t300.0\n")
+        del MEMORY_RATIOS["test_tool"]
+        os.chdir(curr_dir)
+        shutil.rmtree(tdir)
+
+class Test28(unittest.TestCase):
+    def test_translate_seq_basic_function(self):
+        """tests translation up to the first stop, with trimming"""
+        self.assertEqual(translate_seq("ATGAAACTTTAAGGC"), "MKL")
+        self.assertEqual(translate_seq("atgaaactt"), "MKL")
+        self.assertEqual(translate_seq("ATGAAACTTGG"), "MKL")
+    def test_translate_seq_ambiguous_codons(self):
+        """ambiguous codons are resolved the same way as BioPython"""
+        self.assertEqual(translate_seq("ATGGCNNNN"), "MAX")
+    def test_translate_seq_odd_characters(self):
+        self.assertRaises(TypeError, translate_seq, "123456")
+    def test_fasta_chunk_offsets_basic_function(self):
+        """tests that each chunk starts on a header"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        fpath = os.path.join(tdir,"testfile")
+        fp = open(fpath, "w")
+        fp.write(">gene1\nATGAAACTT\n>gene2\nATGAAACTT\n>gene3\nATGAAACTT\n")
+        fp.close()
+        self.assertEqual(fasta_chunk_offsets(fpath, 3), [(0, 17), (17, 34), (34, 51)])
+        self.assertEqual(fasta_chunk_offsets(fpath, 1), [(0, 51)])
+        shutil.rmtree(tdir)
+    def test_translate_genes_chunks_in_order(self):
+        """tests that translating in parallel chunks keeps the original order"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        fpath = os.path.join(tdir,"testfile")
+        fp = open(fpath, "w")
+        for i in range(30000):
+            fp.write(">gene%s\nATGAAACTTGGCAGGTATTCA\n" % i)
+        fp.close()
+        opath = os.path.join(tdir,"out.pep")
+        self.assertEqual(translate_genes(fpath, opath, 0, 4), "MKLGRYS")
+        lines = open(opath).readlines()
+        self.assertEqual(len(lines), 60000)
+        self.assertEqual(lines[-2], ">gene29999\n")
+        shutil.rmtree(tdir)
+
+class Test29(unittest.TestCase):
+    def test_read_fasta_basic_function(self):
+        """tests wrapped sequences, descriptions and text before the first header"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        fpath = os.path.join(tdir,"testfile")
+        fp = open(fpath, "w")
+        fp.write("junk\n>gene1 a description\nATGAAA\nCTT\n>gene2\nATGAAACTT\n")
+        fp.close()
+        self.assertEqual(list(read_fasta(fpath)), [("gene1", b"ATGAAACTT"), ("gene2", b"ATGAAACTT")])
+        self.assertEqual(list(read_fasta(fpath, 5, 37)), [("gene1", b"ATGAAACTT")])
+        shutil.rmtree(tdir)
+    def test_read_fasta_empty_file(self):
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        fpath = os.path.join(tdir,"testfile")
+        open(fpath, "w").close()
+        self.assertEqual(list(read_fasta(fpath)), [])
+        shutil.rmtree(tdir)
+    def test_write_fasta_basic_function(self):
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        fpath = os.path.join(tdir,"testfile")
+        self.assertEqual(write_fasta(fpath, [("gene1", b"ATG"), ("gene2", "MKL")]), 2)
+        self.assertEqual(open(fpath).read(), ">gene1\nATG\n>gene2\nMKL\n")
+        shutil.rmtree(tdir)
+
+class Test30(unittest.TestCase):
+    def test_preflight_inputs_basic_function(self):
+        """tests the stats, duplicate headers, and empty files"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        fpath = os.path.join(tdir,"genome.fasta")
+        fp = open(fpath, "w")
+        fp.write(">contig1\nATGNNA\n>contig2\nATGC\n>contig1\nAT\n")
+        fp.close()
+        ppath = os.path.join(tdir,"genes.pep")
+        fp = open(ppath, "w")
+        fp.write(">gene1\nMKLFE\n")
+        fp.close()
+        epath = os.path.join(tdir,"empty.fasta")
+        open(epath, "w").close()
+        report = os.path.join(tdir,"report.txt")
+        stats, empty = preflight_inputs([fpath, ppath, epath], 1, report)
+        self.assertEqual(empty, ["empty.fasta"])
+        self.assertEqual(stats["genome.fasta"]["records"], 3)
+        self.assertEqual(stats["genome.fasta"]["length"], 12)
+        self.assertEqual(stats["genome.fasta"]["n_count"], 2)
+        self.assertEqual(stats["genome.fasta"]["duplicates"], ["contig1"])
+        self.assertEqual(stats["genes.pep"]["type"], "aa")
+        lines = open(report).readlines()
+        self.assertEqual(lines[1], "genome.fasta\tnt\t42\t3\t12\t16.67\tcontig1\n")
+        self.assertEqual(get_job_sizes([["0", os.path.join(tdir,"genome.fasta.new")]]), [12])
+        shutil.rmtree(tdir)
+    def test_preflight_inputs_genbank(self):
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        fpath = os.path.join(tdir,"genome.gbk")
+        fp = open(fpath, "w")
+        fp.write("LOCUS       contig1  12 bp    DNA\nORIGIN\n        1 atgcnnatgc at\n//\n")
+        fp.close()
+        stats, empty = preflight_inputs([fpath], 1, os.path.join(tdir,"report.txt"))
+        self.assertEqual(stats["genome.gbk"]["type"], "gbk")
+        self.assertEqual(stats["genome.gbk"]["length"], 12)
+        self.assertEqual(stats["genome.gbk"]["n_count"], 2)
+        shutil.rmtree(tdir)
+    def test_preflight_inputs_genbank_no_origin(self):
+        """a record without a sequence is skipped, not counted as an empty genome"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        fpath = os.path.join(tdir,"annotation.gbk")
+        fp = open(fpath, "w")
+        fp.write("LOCUS       contig1  12 bp    DNA\nCONTIG      join(ABC.1:1..12)\n//\n")
+        fp.close()
+        stats, empty = preflight_inputs([fpath], 1, os.path.join(tdir,"report.txt"))
+        self.assertEqual(empty, [])
+        self.assertEqual(stats["annotation.gbk"]["no_sequence"], ["contig1"])
+        shutil.rmtree(tdir)
+
+class Test31(unittest.TestCase):
+    def test_find_duplicate_genomes_basic_function(self):
+        """genomes with the same contigs under other headers are duplicates"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        for name, data in [("a.fasta", ">c1\nATGC\n>c2\nGGGG\n"), ("b.fasta", ">x\nGGGG\n>y\natgc\n"),
+                           ("c.fasta", ">c1\nATGC\n")]:
+            fp = open(os.path.join(tdir,name), "w")
+            fp.write(data)
+            fp.close()
+        stats, empty = preflight_inputs([os.path.join(tdir,x) for x in ["c.fasta","b.fasta","a.fasta"]], 1,
+                                        os.path.join(tdir,"report.txt"))
+        report = os.path.join(tdir,"dups.txt")
+        self.assertEqual(dict(find_duplicate_genomes(stats, report)), {"b.fasta":"a.fasta"})
+        self.assertEqual(open(report).readlines()[1], "b.fasta\ta.fasta\n")
+        shutil.rmtree(tdir)
+    def test_copy_duplicate_hits_basic_function(self):
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        fp = open(os.path.join(tdir,"a.fasta.new_blast.out"), "w")
+        fp.write("gene1\tcontig1\t100\n")
+        fp.close()
+        copy_duplicate_hits({"b.fasta":"a.fasta"}, tdir)
+        self.assertEqual(open(os.path.join(tdir,"b.fasta.new_blast.out")).read(), "gene1\tcontig1\t100\n")
+        shutil.rmtree(tdir)
+
+class Test32(unittest.TestCase):
+    def test_read_fasta_compressed(self):
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        fpath = os.path.join(tdir,"genome.fasta.gz")
+        fp = gzip.open(fpath, "wt")
+        fp.write(">contig1\nATGC\nATGC\n>contig2\nGGGG\n")
+        fp.close()
+        self.assertEqual(list(read_fasta(fpath)), [("contig1", b"ATGCATGC"), ("contig2", b"GGGG")])
+        self.assertEqual(open_input(fpath).readline(), ">contig1\n")
+        shutil.rmtree(tdir)
+    def test_preflight_inputs_decompress(self):
+        """tests that a compressed genome is written once to the temp directory"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        fpath = os.path.join(tdir,"genome.fasta.gz")
+        fp = gzip.open(fpath, "wt")
+        fp.write(">contig1\nATGCATGC\n")
+        fp.close()
+        outdir = os.path.join(tdir,"out")
+        os.mkdir(outdir)
+        stats, empty = preflight_inputs([fpath], 1, os.path.join(tdir,"report.txt"), outdir)
+        self.assertEqual(stats["genome.fasta"]["length"], 8)
+        self.assertEqual(open(os.path.join(outdir,"genome.fasta.new")).read(), ">contig1\nATGCATGC\n")
+        shutil.rmtree(tdir)
+    def test_compressed_genome_decompressed_once(self):
+        """the checks, gene prediction input, splitting and searches all read
+        the copy written by the preflight check"""
+        import ls_bsr.util
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        fpath = os.path.join(tdir,"metagenome.fasta.gz")
+        fp = gzip.open(fpath, "wt")
+        fp.write(">contig1\nATGCATGC\n>contig2\nATGCATGC\n>contig3\nGG\n")
+        fp.close()
+        outdir = os.path.join(tdir,"out")
+        os.mkdir(outdir)
+        genome = os.path.join(outdir,"metagenome.fasta.new")
+        opened = []
+        gzip_open = gzip.open
+        def counted_open(*args, **kwargs):
+            opened.append(args[0])
+            return gzip_open(*args, **kwargs)
+        gzip.open = counted_open
+        try:
+            stats = ls_bsr.util._perform_workflow_preflight(["0", fpath, outdir])
+            self.assertEqual(list(read_fasta(genome)), [("contig1", b"ATGCATGC"), ("contig2", b"ATGCATGC"), ("contig3", b"GG")])
+            batches = split_large_genome(genome, 10)
+            cmd, shell = next(ls_bsr.util._perform_workflow_blat_genome(["0", batches[0], "genes.fasta"]))
+        finally:
+            gzip.open = gzip_open
+        self.assertEqual(opened, [fpath])
+        self.assertEqual(stats["length"], 18)
+        self.assertEqual(len(batches), 3)
+        self.assertEqual(cmd[3], batches[0])
+        shutil.rmtree(tdir)
+
+class Test33(unittest.TestCase):
+    def test_process_genbank_files_basic_function(self):
+        """tests that locus tags, peptides, and the genome come from one parse"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        fp = open(os.path.join(tdir,"genome.gbk"), "w")
+        fp.write("""LOCUS       contig1                   18 bp    DNA     linear   BCT 01-JAN-2000
+FEATURES             Location/Qualifiers
+     CDS             1..12
+                     /locus_tag="GENE_1"
+                     /product="test protein"
+ORIGIN
+        1 atgaaacttt aaggcatg
+//
+""")
+        fp.close()
+        os.chdir(tdir)
+        self.assertEqual(process_genbank_files(tdir, 1, True, True, True), ["genome.gbk"])
+        self.assertEqual(open("genome.locus_tags.fasta").read(), ">GENE_1|test_protein\nATGAAACTTTAA\n")
+        self.assertEqual(open("genome.fasta.new_genes.pep").read(), ">GENE_1|test_protein\nMKL\n")
+        self.assertEqual(open("genome.fasta.new").read(), ">contig1\nATGAAACTTTAAGGCATG\n")
+        os.chdir(curr_dir)
+        shutil.rmtree(tdir)
+    def test_process_genbank_files_no_origin(self):
+        """a record without a sequence gives no genome, and its peptides
+        are taken from the CDS translations"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        fp = open(os.path.join(tdir,"annotation.gbk"), "w")
+        fp.write("""LOCUS       contig1                   18 bp    DNA     linear   BCT 01-JAN-2000
+FEATURES             Location/Qualifiers
+     CDS             1..12
+                     /locus_tag="GENE_1"
+                     /product="test protein"
+                     /translation="MKL"
+CONTIG      join(ABC.1:1..18)
+//
+""")
+        fp.close()
+        os.chdir(tdir)
+        self.assertEqual(process_genbank_files(tdir, 1, True, True, True), ["annotation.gbk"])
+        self.assertEqual(open("annotation.locus_tags.fasta").read(), "")
+        self.assertEqual(open("annotation.fasta.new_genes.pep").read(), ">GENE_1|test_protein\nMKL\n")
+        self.assertFalse(os.path.exists("annotation.fasta.new"))
+        os.chdir(curr_dir)
+        shutil.rmtree(tdir)
+
+class Test34(unittest.TestCase):
+    def test_coding_gaps_basic_function(self):
+        """overlapping and nested ranges don't create gaps"""
+        self.assertEqual(coding_gaps([(100,200),(1,50),(150,180),(190,300),(400,500)]), [(51,99),(301,399)])
+    def test_coding_gaps_nested_ranges(self):
+        """a gene nested in a longer one leaves no gap inside the longer one,
+        where inverse_coding_regions only looks at the range before"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        os.chdir(tdir)
+        fp = open("genome.prodigal", "w")
+        fp.write("contig1\tProdigal_v2.6.3\tCDS\t1\t300\t1\t+\t0\tID=1_1\n")
+        fp.write("contig1\tProdigal_v2.6.3\tCDS\t50\t100\t1\t+\t0\tID=1_2\n")
+        fp.write("contig1\tProdigal_v2.6.3\tCDS\t150\t200\t1\t+\t0\tID=1_3\n")
+        fp.write("contig1\tProdigal_v2.6.3\tCDS\t400\t500\t1\t+\t0\tID=1_4\n")
+        fp.close()
+        inverse_coding_regions("genome.prodigal", "old")
+        self.assertEqual(open("old.ranges").read(), "contig1\t101\t149\ncontig1\t201\t399\n")
+        self.assertEqual(coding_gaps(parse_gff_ranges("genome.prodigal")["contig1"]), [(301,399)])
+        os.chdir(curr_dir)
+        shutil.rmtree(tdir)
+    def test_predict_genes_gff(self):
+        """tests CDS on both strands and intergenics from a GFF3 file"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        fp = open(os.path.join(tdir,"genome.fasta"), "w")
+        fp.write(">contig1\nATGAAACTTTAA"+"C"*60+"TTAAAGTTTCAT\n")
+        fp.close()
+        fp = open(os.path.join(tdir,"genome.gff"), "w")
+        fp.write("##gff-version 3\ncontig1\ttest\tgene\t1\t12\t.\t+\t0\tID=gene1\n")
+        fp.write("contig1\ttest\tCDS\t1\t12\t.\t+\t0\tID=cds1;locus_tag=A_1\n")
+        fp.write("contig1\ttest\tCDS\t73\t84\t.\t-\t0\tID=cds2;locus_tag=A_2\n")
+        fp.close()
+        annotations = find_genome_annotations(tdir)
+        self.assertEqual(annotations, {"genome.fasta":os.path.join(tdir,"genome.gff")})
+        fastadir = os.path.join(tdir,"out")
+        os.mkdir(fastadir)
+        shutil.copy(os.path.join(tdir,"genome.fasta"), os.path.join(fastadir,"genome.fasta.new"))
+        predict_genes(fastadir, 1, "T", 0, 0, annotations)
+        self.assertEqual(open("genome.fasta.new_genes.seqs").read(), ">cds1\nATGAAACTTTAA\n>cds2\nATGAAACTTTAA\n")
+        self.assertEqual(open("genome.fasta.new_genes.pep").read(), ">cds1\nMKL\n>cds2\nMKL\n")
+        self.assertEqual(open("genome.intergenics.seqs").read(), ">contig1_12_72\n"+"C"*60+"\n")
+        os.chdir(curr_dir)
+        shutil.rmtree(tdir)
+
+class Test35(unittest.TestCase):
+    def test_count_fasta_records_basic_function(self):
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        fpath = os.path.join(tdir,"testfile")
+        fp = open(fpath, "w")
+        fp.write(">gene1\nMKL\n>gene2\nMKL\n")
+        fp.close()
+        self.assertEqual(count_fasta_records(fpath), 2)
+        shutil.rmtree(tdir)
+    def test_report_prodigal_training_timings(self):
+        """without a comparison, the timings of the run are reported and Prodigal isn't run again"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        fpath = os.path.join(tdir,"A.fasta.new")
+        fp = open("%s_genes.pep" % fpath, "w")
+        fp.write(">gene1\nMKL\n>gene2\nMKL\n")
+        fp.close()
+        report_prodigal_training([fpath], [1.5], os.path.join(tdir,"report.txt"), 0)
+        self.assertEqual(open(os.path.join(tdir,"report.txt")).read(),
+                         "genome\tshared_seconds\tshared_genes\tself_seconds\tself_genes\nA.fasta.new\t1.50\t2\tNA\tNA\n")
+        shutil.rmtree(tdir)
+
+class Test36(unittest.TestCase):
+    def test_write_intergenic_regions_basic_function(self):
+        """tests that the one pass gives the same regions as the .ranges file"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        gpath = os.path.join(tdir,"genome.fasta")
+        fp = open(gpath, "w")
+        fp.write(">contig1\n"+"A"*60+"C"*100+"G"*60+"T"*100+"\n>contig2\n"+"C"*200+"\n")
+        fp.close()
+        gff = os.path.join(tdir,"genome.prodigal")
+        fp = open(gff, "w")
+        fp.write("# Sequence Data\ncontig1\tProdigal_v2.6.3\tCDS\t61\t160\t1\t+\t0\tID=1_1\n")
+        fp.write("contig1\tProdigal_v2.6.3\tCDS\t221\t320\t1\t-\t0\tID=1_2\n")
+        fp.write("contig2\tProdigal_v2.6.3\tCDS\t100\t200\t1\t+\t0\tID=2_1\n")
+        fp.close()
+        self.assertEqual(parse_gff_ranges(gff), {"contig1":[(61,160),(221,320)], "contig2":[(100,200)]})
+        outfile = os.path.join(tdir,"new.intergenics.seqs")
+        write_intergenic_regions(read_fasta(gpath), parse_gff_ranges(gff), outfile)
+        os.chdir(tdir)
+        inverse_coding_regions(gff, "old")
+        parse_ranges_file(gpath, "old.ranges", "old", "false")
+        self.assertEqual(sorted(read_fasta(outfile)), sorted(read_fasta("old.intergenics.seqs")))
+        self.assertEqual(len(list(read_fasta(outfile))), 3)
+        os.chdir(curr_dir)
+        shutil.rmtree(tdir)
+
+class Test37(unittest.TestCase):
+    def test_collapse_identical_seqs_basic_function(self):
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        fpath = os.path.join(tdir,"testfile")
+        fp = open(fpath, "w")
+        fp.write(">gene1\nATGAAA\n>gene2\nATGCCC\n>gene3\natgaaa\n>gene4\nATGAAA\n")
+        fp.close()
+        opath = os.path.join(tdir,"unique")
+        mpath = os.path.join(tdir,"membership")
+        self.assertEqual(dict(collapse_identical_seqs(fpath, opath, mpath)), {"gene1":["gene3","gene4"]})
+        self.assertEqual(open(opath).read(), ">gene1\nATGAAA\n>gene2\nATGCCC\n")
+        self.assertEqual(open(mpath).read(), "gene1\tgene3,gene4\n")
+        shutil.rmtree(tdir)
+    def test_collapse_identical_seqs_shared_ids(self):
+        """different sequences with the same ID get a numbered ID"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        fpath = os.path.join(tdir,"testfile")
+        fp = open(fpath, "w")
+        fp.write(">contig_1\nATGAAA\n>contig_1\nATGCCC\n")
+        fp.close()
+        collapse_identical_seqs(fpath, os.path.join(tdir,"unique"), os.path.join(tdir,"membership"))
+        self.assertEqual(open(os.path.join(tdir,"unique")).read(), ">contig_1\nATGAAA\n>contig_1_2\nATGCCC\n")
+        shutil.rmtree(tdir)
+    def test_fan_out_hits_basic_function(self):
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        fpath = os.path.join(tdir,"testfile")
+        fp = open(fpath, "w")
+        fp.write("gene1\tcontig1\t100.00\t6\n")
+        fp.write("gene2\tcontig1\t90.00\t6\n")
+        fp.close()
+        fan_out_hits(fpath, {"gene1":["gene3"]})
+        self.assertEqual(open(fpath).read(), "gene1\tcontig1\t100.00\t6\ngene3\tcontig1\t100.00\t6\ngene2\tcontig1\t90.00\t6\n")
+        shutil.rmtree(tdir)
+
+class Test38(unittest.TestCase):
+    def test_parse_cluster_membership_vsearch(self):
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        fpath = os.path.join(tdir,"results.uc")
+        fp = open(fpath, "w")
+        fp.write("S\t0\t12\t*\t*\t*\t*\t*\tgene1\t*\n")
+        fp.write("H\t0\t12\t95.5\t+\t0\t0\t12M\tgene2\tgene1\n")
+        fp.write("C\t0\t2\t*\t*\t*\t*\t*\tgene1\t*\n")
+        fp.close()
+        self.assertEqual(dict(parse_cluster_membership(fpath, "vsearch")), {"gene1":[("gene1",100.0),("gene2",95.5)]})
+        shutil.rmtree(tdir)
+    def test_parse_cluster_membership_cdhit(self):
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        fpath = os.path.join(tdir,"consensus.fasta.clstr")
+        fp = open(fpath, "w")
+        fp.write(">Cluster 0\n0\t12nt, >gene1... *\n1\t12nt, >gene2... at +/95.50%\n>Cluster 1\n0\t12aa, >gene3... at 90.00%\n1\t12aa, >gene4... *\n")
+        fp.close()
+        self.assertEqual(dict(parse_cluster_membership(fpath, "cd-hit")), {"gene1":[("gene1",100.0),("gene2",95.5)],
+                                                                          "gene4":[("gene3",90.0),("gene4",100.0)]})
+        shutil.rmtree(tdir)
+    def test_membership_matrices_basic_function(self):
+        """tests that members are traced back to genomes through their sequence"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        for name, data in [("A.fasta.new_genes.seqs", ">contig_1\nATGAAA\n"), ("B.fasta.new_genes.seqs", ">contig_1\nATGAAC\n"),
+                           ("C.fasta.new_genes.seqs", ">contig_1\nATGAAA\n"), ("unique.out", ">contig_1\nATGAAA\n>contig_1_2\nATGAAC\n")]:
+            fp = open(os.path.join(tdir,name), "w")
+            fp.write(data)
+            fp.close()
+        genome_hashes = genome_gene_hashes(tdir, False, 1)
+        table = cluster_membership_table({"contig_1":[("contig_1",100.0),("contig_1_2",None)]}, os.path.join(tdir,"unique.out"),
+                                         genome_hashes, os.path.join(tdir,"membership.txt"))
+        self.assertEqual(table["contig_1"], {"A":("contig_1",100.0), "B":("contig_1_2",None), "C":("contig_1",100.0)})
+        membership_matrices(table, ["A","B","C","D","E"], 0.9, os.path.join(tdir,"test"), {"E":"A"})
+        self.assertEqual(open(os.path.join(tdir,"test_presence_matrix.txt")).readlines()[1], "contig_1\t1\t1\t1\t0\t1\n")
+        self.assertEqual(open(os.path.join(tdir,"test_approx_bsr_matrix.txt")).readlines()[1],
+                         "contig_1\t1.0000\t0.9000\t1.0000\t0.0000\t1.0000\n")
+        shutil.rmtree(tdir)
+
+class Test39(unittest.TestCase):
+    def test_write_selective_queries_basic_function(self):
+        """genes are only searched for in genomes without a cluster member"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        for name, data in [("A.fasta.new", ">contig\nATGAAA\n"), ("B.fasta.new", ">contig\nATGAAC\n"),
+                           ("consensus.fasta", ">gene1\nATGAAA\n>gene2\nATGCCC\n"),
+                           ("unique.out", ">gene1\nATGAAA\n>gene1_2\nATGAAC\n>gene2\nATGCCC\n")]:
+            fp = open(os.path.join(tdir,name), "w")
+            fp.write(data)
+            fp.close()
+        membership = {"gene1":{"A":("gene1",100.0), "B":("gene1_2",83.3)}, "gene2":{"A":("gene2",100.0)}}
+        selective = write_selective_queries(membership, os.path.join(tdir,"consensus.fasta"), os.path.join(tdir,"unique.out"), tdir)
+        self.assertEqual(sorted(selective.keys()), ["A","B"])
+        self.assertEqual(os.path.getsize(selective["A"][0]), 0)
+        self.assertEqual(open(selective["A"][1]).read(), ">gene1\nATGAAA\n>gene2\nATGCCC\n")
+        self.assertEqual(open(selective["B"][0]).read(), ">gene2\nATGCCC\n")
+        self.assertEqual(open(selective["B"][1]).read(), ">gene1\nATGAAA\n")
+        self.assertEqual(open(selective["B"][2]).read(), ">gene1_2\nATGAAC\n")
+        shutil.rmtree(tdir)
+    def test_selective_search_skips_resolved_genomes(self):
+        """genomes with a member for every gene get an empty result instead of a search"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        curr_dir=os.getcwd()
+        os.chdir(tdir)
+        fp = open("A.fasta.new", "w")
+        fp.write(">contig\nATGAAA\n")
+        fp.close()
+        open("A.selective_queries", "w").close()
+        blat_against_each_genome_dev("consensus.fasta", 1, 0, 0, {"A":("A.selective_queries","","")})
+        self.assertEqual(os.path.getsize(os.path.join(tdir,"A.fasta.new_blast.out")), 0)
+        os.chdir(curr_dir)
+        shutil.rmtree(tdir)
+    def test_selective_search_tolerance(self):
+        """values from member alignments are within 0.0001 of a full search when
+        the member is the best hit, and only ever lower when it isn't"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        curr_dir=os.getcwd()
+        unresolved = "Cluster1\tcontig1\t90.0\t60\t0\t0\t500\t560\t1\t60\t1e-20\t55.3\n"
+        searches = {"exact":{"A":"Cluster0\tcontig1\t99.0\t100\t0\t0\t1\t300\t1\t100\t1e-40\t90.1\n"
+                                 "Cluster0\tcontig2\t60.0\t100\t0\t0\t1\t300\t1\t100\t1e-10\t40.0\n"+unresolved,
+                             "B":"Cluster0\tcontig1\t99.0\t100\t0\t0\t1\t300\t1\t100\t1e-30\t60.2\n"
+                                 "Cluster0\tcontig2\t95.0\t100\t0\t0\t1\t300\t1\t100\t1e-35\t80.4\n"},
+                    "approx":{"A":unresolved+"Cluster0\tA_00007\t99.0\t100\t0\t0\t1\t300\t1\t100\t1e-45\t90.1\n",
+                              "B":"Cluster0\tB_00003\t99.0\t100\t0\t0\t1\t300\t1\t100\t1e-33\t60.2\n"}}
+        values = {}
+        for search, outputs in searches.items():
+            os.mkdir(os.path.join(tdir,search))
+            os.chdir(os.path.join(tdir,search))
+            for genome, data in outputs.items():
+                fp = open("%s.fasta.new_blast.out" % genome, "w")
+                fp.write(data)
+                fp.close()
+            parse_blast_report_dev("false", 1)
+            build_bsr_matrix(glob.glob("*.filtered.unique"), 1, ["Cluster0","Cluster1"], {"Cluster0":"90.1","Cluster1":"60.0"}, "matrix.txt")
+            values[search] = [[float(x) for x in line.split()[1:]] for line in open("matrix.txt").readlines()[1:]]
+            os.chdir(curr_dir)
+        self.assertLessEqual(abs(values["approx"][0][0]-values["exact"][0][0]), 0.0001)
+        self.assertLess(values["approx"][0][1], values["exact"][0][1])
+        self.assertEqual(values["approx"][1], values["exact"][1])
+        shutil.rmtree(tdir)
+    def test_selective_search_choice(self):
+        """selective search is turned off when duplicates are counted"""
+        import io
+        import ls_bsr.util
+        ls_bsr.util.OUTSTREAM = io.StringIO()
+        try:
+            self.assertEqual(selective_search_choice("T", "F", "F"), "T")
+            self.assertEqual(ls_bsr.util.OUTSTREAM.getvalue(), "")
+            self.assertEqual(selective_search_choice("T", "T", "F"), "F")
+            self.assertEqual(selective_search_choice("T", "F", "T"), "F")
+            self.assertIn("selective search isn't used with duplicate detection", ls_bsr.util.OUTSTREAM.getvalue())
+            self.assertEqual(selective_search_choice("F", "T", "T"), "F")
+        finally:
+            ls_bsr.util.OUTSTREAM = sys.stdout
+
+class Test40(unittest.TestCase):
+    def test_split_novel_genes_basic_function(self):
+        """genes below the identity or coverage threshold are novel"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        fpath = os.path.join(tdir,"genes.out")
+        fp = open(fpath, "w")
+        fp.write(">gene1\nATGAAAAAAAAATGA\n>gene2\nATGCCCCCCCCCTGA\n>gene3\nATGTTTTTTTTTTGA\n")
+        fp.close()
+        hpath = os.path.join(tdir,"hits.out")
+        fp = open(hpath, "w")
+        fp.write("gene1\tcentroid_1\t100.00\t15\t0\t0\t1\t15\t1\t15\t1e-5\t28.2\n")
+        fp.write("gene2\tcentroid_2\t80.00\t15\t3\t0\t1\t15\t1\t15\t1e-3\t20.1\n")
+        fp.write("gene3\tcentroid_3\t100.00\t6\t0\t0\t1\t6\t1\t6\t1e-1\t12.1\n")
+        fp.close()
+        matched = split_novel_genes(fpath, hpath, 0.9, 0.9, os.path.join(tdir,"novel.out"))
+        self.assertEqual(matched, {"gene1":"centroid_1"})
+        self.assertEqual(open(os.path.join(tdir,"novel.out")).read(), ">gene2\nATGCCCCCCCCCTGA\n>gene3\nATGTTTTTTTTTTGA\n")
+        shutil.rmtree(tdir)
+    def test_append_novel_centroids_basic_function(self):
+        """existing IDs are kept and new IDs that collide are numbered"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        for name, data in [("previous.fasta", ">centroid_1\nATGAAA\n>centroid_2\nATGCCC\n"),
+                           ("consensus.fasta", ">centroid_2\nATGTTT\n>centroid_3\nATGGGG\n")]:
+            fp = open(os.path.join(tdir,name), "w")
+            fp.write(data)
+            fp.close()
+        novel = append_novel_centroids(os.path.join(tdir,"previous.fasta"), os.path.join(tdir,"consensus.fasta"), os.path.join(tdir,"novel.fasta"))
+        self.assertEqual(novel, ["centroid_2_2","centroid_3"])
+        self.assertEqual(get_cluster_ids(os.path.join(tdir,"consensus.fasta")), ["centroid_1","centroid_2","centroid_2_2","centroid_3"])
+        self.assertEqual(open(os.path.join(tdir,"novel.fasta")).read(), ">centroid_2_2\nATGTTT\n>centroid_3\nATGGGG\n")
+        shutil.rmtree(tdir)
+    def test_merge_update_matrix_basic_function(self):
+        """old values are kept, new genomes and centroids are appended"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        for name, data in [("old.txt", "\tA\tB\ncentroid_1\t1.0000\t0.5000\ncentroid_2\t0.0000\t1.0000\n"),
+                           ("new.txt", "\tA\tC\tB\ncentroid_1\t0.0000\t0.9000\t0.0000\ncentroid_2\t0.0000\t0.0000\t0.0000\ncentroid_3\t0.8000\t1.0000\t0.0000\n")]:
+            fp = open(os.path.join(tdir,name), "w")
+            fp.write(data)
+            fp.close()
+        self.assertEqual(read_matrix_genomes(os.path.join(tdir,"old.txt")), ["A","B"])
+        self.assertEqual(merge_update_matrix(os.path.join(tdir,"old.txt"), os.path.join(tdir,"new.txt"), os.path.join(tdir,"new.txt")), (3, 3))
+        self.assertEqual(open(os.path.join(tdir,"new.txt")).read(), "\tA\tB\tC\ncentroid_1\t1.0000\t0.5000\t0.9000\n"
+                         "centroid_2\t0.0000\t1.0000\t0.0000\ncentroid_3\t0.8000\t0.0000\t1.0000\n")
+        shutil.rmtree(tdir)
+
+class Test41(unittest.TestCase):
+    def test_merge_update_matrix_sorted_rows(self):
+        """new genes are merged into the previous rows in sorted order"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        for name, data in [("old.txt", "\tA\tB\ngene_1\t1.0000\t0.5000\ngene_3\t0.0000\t1.0000\n"),
+                           ("new.txt", "\tA\tB\ngene_2\t0.9000\t1.0000\n")]:
+            fp = open(os.path.join(tdir,name), "w")
+            fp.write(data)
+            fp.close()
+        self.assertEqual(read_matrix_centroids(os.path.join(tdir,"old.txt")), ["gene_1","gene_3"])
+        merge_update_matrix(os.path.join(tdir,"old.txt"), os.path.join(tdir,"new.txt"), os.path.join(tdir,"merged.txt"), True)
+        self.assertEqual(read_matrix_centroids(os.path.join(tdir,"merged.txt")), ["gene_1","gene_2","gene_3"])
+        self.assertEqual(open(os.path.join(tdir,"merged.txt")).readlines()[2], "gene_2\t0.9000\t1.0000\n")
+        shutil.rmtree(tdir)
+    def test_merge_update_dup_matrix(self):
+        """copy numbers of the previous run are kept and duplicates found from all of them"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        for name, data in [("old.txt", "ID\tA\ngene_1\t1\ngene_3\t2\n"), ("new.txt", "ID\tA\tB\ngene_2\t1\t3\ngene_1\t0\t1\n")]:
+            fp = open(os.path.join(tdir,name), "w")
+            fp.write(data)
+            fp.close()
+        merge_update_matrix(os.path.join(tdir,"old.txt"), os.path.join(tdir,"new.txt"), os.path.join(tdir,"merged.txt"), True, "ID", "0")
+        self.assertEqual(open(os.path.join(tdir,"merged.txt")).read(), "ID\tA\tB\ngene_1\t1\t1\ngene_2\t1\t3\ngene_3\t2\t0\n")
+        self.assertEqual(write_duplicate_ids(os.path.join(tdir,"merged.txt"), os.path.join(tdir,"ids.txt")), ["gene_2","gene_3"])
+        self.assertEqual(open(os.path.join(tdir,"ids.txt")).read(), "gene_2\ngene_3")
+        shutil.rmtree(tdir)
+    def test_genome_database_reuses_cache(self):
+        """a cached database of the same sequence is used instead of formatting again"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        fpath = os.path.join(tdir,"A.fasta.new")
+        fp = open(fpath, "w")
+        fp.write(">contig\nATGAAA\n")
+        fp.close()
+        db = os.path.join(tdir, "A.fasta.new_%s" % hashlib.sha1(b">contig\nATGAAA\n").hexdigest())
+        open("%s.done" % db, "w").close()
+        BLAST_DB_CACHE[0] = tdir
+        try:
+            self.assertEqual(run_tool_jobs(_database_job, [["0", fpath]], 1), [db])
+        finally:
+            BLAST_DB_CACHE[0] = None
+        shutil.rmtree(tdir)
+
+class Test42(unittest.TestCase):
+    def test_find_dups_dev_basic_function(self):
+        """hits above the identity and BSR thresholds are counted per genome"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        curr_dir=os.getcwd()
+        os.chdir(tdir)
+        fp = open("A.fasta.new_blast.out", "w")
+        fp.write("gene1\tcontig_1\t100.00\t10\t0\t0\t1\t10\t1\t10\t1e-5\t100\n")
+        fp.write("gene1\tcontig_2\t90.00\t10\t1\t0\t1\t10\t1\t10\t1e-5\t80\n")
+        fp.write("gene2\tcontig_1\t100.00\t10\t0\t0\t1\t10\t1\t10\t1e-5\t50\n")
+        fp.close()
+        fp = open("B.fasta.new_blast.out", "w")
+        fp.write("gene1\tcontig_1\t100.00\t10\t0\t0\t1\t10\t1\t10\t1e-5\t100\n")
+        fp.write("gene1\tcontig_3\t60.00\t10\t4\t0\t1\t10\t1\t10\t1e-5\t90\n")
+        fp.write("gene2\tcontig_1\t100.00\t10\t0\t0\t1\t10\t1\t10\t1e-5\t50\n")
+        fp.close()
+        self.assertEqual(find_dups_dev({"gene1":"100","gene2":"50"}, 0.7, 0.85, 75, ["gene1","gene2","gene3"], 1), ["gene1"])
+        self.assertEqual(open("dup_matrix.txt").read(), "ID\tA\tB\ngene1\t2\t1\ngene2\t1\t1\ngene3\t0\t0\n")
+        self.assertEqual(open("duplicate_ids.txt").read(), "gene1")
+        os.chdir(curr_dir)
+        shutil.rmtree(tdir)
+
+class Test43(unittest.TestCase):
+    def test_build_bsr_matrix_basic_function(self):
+        """rows are sorted, missing hits and self-scores are 0"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        for name, data in [("B.fasta.new_blast.out.filtered.unique", "Cluster1\t20.25\nCluster0\t30.2\n"),
+                           ("A.fasta.new_blast.out.filtered.unique", "Cluster2\t30.3\nCluster3\t10\nother\t5\n")]:
+            fp = open(os.path.join(tdir,name), "w")
+            fp.write(data)
+            fp.close()
+        import io
+        import ls_bsr.util
+        ls_bsr.util.OUTSTREAM = io.StringIO()
+        try:
+            names = build_bsr_matrix(glob.glob(os.path.join(tdir,"*.filtered.unique")), 1, ["Cluster2","Cluster0","Cluster1","Cluster3"],
+                                     {"Cluster2":"60.6","Cluster0":"30.2","Cluster1":"40.5"}, os.path.join(tdir,"matrix.txt"))
+            self.assertIn("values changed to 0, check names and output:Cluster3", ls_bsr.util.OUTSTREAM.getvalue())
+        finally:
+            ls_bsr.util.OUTSTREAM = sys.stdout
+        self.assertEqual(names, ["A","B"])
+        self.assertEqual(open(os.path.join(tdir,"matrix.txt")).read(), "\tA\tB\nCluster0\t0.0000\t1.0000\n"
+                         "Cluster1\t0.0000\t0.5000\nCluster2\t0.5000\t0.0000\nCluster3\t0.0000\t0.0000\n")
+        shutil.rmtree(tdir)
+    def test_build_bsr_matrix_row_blocks(self):
+        """the matrix is the same when it's written out one row at a time"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        for name, data in [("B.fasta.new_blast.out.filtered.unique", "Cluster1\t20.25\nCluster0\t30.2\n"),
+                           ("A.fasta.new_blast.out.filtered.unique", "Cluster2\t30.3\nCluster3\t10\n"),
+                           ("C.fasta.new_blast.out.filtered.unique", "Cluster0\t15.1\n")]:
+            fp = open(os.path.join(tdir,name), "w")
+            fp.write(data)
+            fp.close()
+        names = build_bsr_matrix(glob.glob(os.path.join(tdir,"*.filtered.unique")), 1, ["Cluster2","Cluster0","Cluster1","Cluster3"],
+                                 {"Cluster2":"60.6","Cluster0":"30.2","Cluster1":"40.5"}, os.path.join(tdir,"matrix.txt"), 0.000001)
+        self.assertEqual(names, ["A","B","C"])
+        self.assertEqual(open(os.path.join(tdir,"matrix.txt")).read(), "\tA\tB\tC\nCluster0\t0.0000\t1.0000\t0.5000\n"
+                         "Cluster1\t0.0000\t0.5000\t0.0000\nCluster2\t0.5000\t0.0000\t0.0000\nCluster3\t0.0000\t0.0000\t0.0000\n")
+        self.assertFalse(os.path.exists(os.path.join(tdir,"bsr_values.bin")))
+        shutil.rmtree(tdir)
+
+class Test46(unittest.TestCase):
+    def test_write_sparse_matrix_basic_function(self):
+        """values below the floor are left out, and the rest read back as they were"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        fpath = os.path.join(tdir,"sample_matrix.txt")
+        fp = open(fpath, "w")
+        fp.write("\tE2348_69_all\tH10407_all\tO157_H7_sakai_all\n")
+        fp.write("IpaH3\t1.0000\t0.8000\t1.0000\n")
+        fp.write("LT\t0.0000\t0.1200\t0.0000\n")
+        fp.write("stx2a\t0.0700\t0.0000\t0.9812\n")
+        fp.close()
+        spath = os.path.join(tdir,"sample_matrix.csr")
+        self.assertEqual(write_sparse_matrix(fpath, spath, 0.1), 5)
+        genomes, floor, rows = read_bsr_matrix(spath)
+        self.assertEqual(genomes, ["E2348_69_all","H10407_all","O157_H7_sakai_all"])
+        self.assertEqual(floor, 0.1)
+        self.assertEqual([(gene, list(columns), values) for gene, columns, values in rows],
+                         [("IpaH3", [0,1,2], [1.0,0.8,1.0]), ("LT", [1], [0.12]), ("stx2a", [2], [0.9812])])
+        self.assertEqual(sorted(os.listdir(tdir)), ["sample_matrix.csr","sample_matrix.txt"])
+        shutil.rmtree(tdir)
+    def test_stats_from_sparse_matrix(self):
+        """the stats are the same from the sparse matrix"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        os.chdir(tdir)
+        fp = open("sample_matrix.txt", "w")
+        fp.write("        E2348_69_all    H10407_all      O157_H7_sakai_all       SSON_046_all\n")
+        fp.write("IpaH3   0.80    1.00    1.00    1.00\n")
+        fp.write("LT      0.00    1.00    0.79    0.00\n")
+        fp.write("ST1     0.00    1.00    0.12    0.12\n")
+        fp.write("bfpB    1.00    0.00    0.00    0.00\n")
+        fp.write("stx2a   0.07    0.08    0.98    0.07\n")
+        fp.close()
+        write_sparse_matrix("sample_matrix.txt", "sample_matrix.csr", 0.4)
+        self.assertEqual(get_core_gene_stats("sample_matrix.csr", 0.8, 0.4, 0), get_core_gene_stats("sample_matrix.txt", 0.8, 0.4, 0))
+        self.assertEqual(get_frequencies("sample_matrix.csr", 0.8), {1:4,4:1})
+        random.seed(1)
+        from_sparse = process_pangenome("sample_matrix.csr", "0.8", "0.4", 5, "all", "test")
+        random.seed(1)
+        self.assertEqual(from_sparse, process_pangenome("sample_matrix.txt", "0.8", "0.4", 5, "all", "test"))
+        self.assertRaises(ValueError, get_frequencies, "sample_matrix.csr", 0.2)
+        os.chdir(curr_dir)
+        shutil.rmtree(tdir)
+
+def _worker_value(key):
+    import ls_bsr.util
+    return ls_bsr.util._worker_state.get(key)
+
+def _worker_cwd(x):
+    return os.path.realpath(os.getcwd())
+
+class Test44(unittest.TestCase):
+    def test_worker_pool_is_reused(self):
+        """the pool is kept between stages until the shared state changes"""
+        pool = get_worker_pool(1)
+        self.assertTrue(get_worker_pool(1) is pool)
+        share_worker_state(value=5)
+        self.assertFalse(get_worker_pool(1) is pool)
+        self.assertEqual(mp_shell(_worker_value, ["value"], 1), [5])
+        share_worker_state()
+    def test_worker_pool_follows_directory(self):
+        """jobs run in the directory they were submitted from"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        curr_dir=os.getcwd()
+        get_worker_pool(1)
+        os.chdir(tdir)
+        self.assertEqual(mp_shell(_worker_cwd, [1], 1), [os.path.realpath(tdir)])
+        os.chdir(curr_dir)
+        shutil.rmtree(tdir)
+
+def _database_job(data):
+    import ls_bsr.util
+    db = yield from ls_bsr.util._genome_database_job(data[1], "nucl")
+    return db
+
+def _tool_job(data):
+    tn, cmd = data
+    returncode = yield (cmd, True)
+    return returncode
+
+def _tool_job_steps(data):
+    import ls_bsr.util
+    tn, value = data
+    yield from ls_bsr.util._checked(["true"])
+    doubled = yield lambda: value*2
+    return doubled
+
+class Test45(unittest.TestCase):
+    def test_run_tool_jobs_basic_function(self):
+        """tests that commands and python steps run, and results come back in order"""
+        self.assertEqual(run_tool_jobs(_tool_job, [["0", "exit 0"], ["1", "exit 3"]], 2), [0, 3])
+        self.assertEqual(run_tool_jobs(_tool_job_steps, [["0", 1], ["1", 2]], 2), [2, 4])
+        self.assertEqual(run_tool_jobs(_tool_job, [], 2), [])
+    def test_failed_search_is_left_out(self):
+        """a genome whose search fails has no output, not a partial one"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        os.chdir(tdir)
+        fp = open("A.fasta.new", "w")
+        fp.write(">contig\nATGAAA\n")
+        fp.close()
+        fp = open("A.fasta.new.batch_2_blast.out", "w")
+        fp.write("partial\n")
+        fp.close()
+        import ls_bsr.util
+        self.assertEqual(run_tool_jobs(ls_bsr.util._perform_workflow_tblastn,
+                                       [["0", os.path.join(tdir, "A.fasta.new.batch_1"), "no", "missing.pep"]], 1),
+                         [os.path.join(tdir, "A.fasta.new.batch_1")])
+        self.assertEqual(skip_failed_genomes([None, os.path.join(tdir, "A.fasta.new.batch_1")], "_blast.out"),
+                         [os.path.join(tdir, "A.fasta.new")])
+        self.assertEqual(os.listdir(tdir), ["A.fasta.new"])
+        os.chdir(curr_dir)
+        shutil.rmtree(tdir)
+    def test_failed_protein_search_is_left_out(self):
+        """a failed blastp or diamond search drops the annotation, not its partial output"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        os.chdir(tdir)
+        for search in (lambda: blastp_against_each_annotation("missing.pep", 1, "F"),
+                       lambda: diamond_against_each_annotation("missing.pep", 1)):
+            fp = open("failedprot.fasta.new_genes.pep", "w")
+            fp.write(">gene\nMKK\n")
+            fp.close()
+            fp = open("failedprot.fasta.new_blast.out", "w")
+            fp.write("partial\n")
+            fp.close()
+            search()
+            self.assertFalse(os.path.exists("failedprot.fasta.new_blast.out"))
+        os.chdir(curr_dir)
+        shutil.rmtree(tdir)
+    def test_run_tool_jobs_retries(self):
+        """tests that a failed command is run again, up to the limit"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        os.chdir(tdir)
+        TOOL_LIMITS["retries"] = 2
+        self.assertEqual(run_tool_jobs(_tool_job, [["0", "echo x >> tries; exit 1"]], 1), [1])
+        TOOL_LIMITS["retries"] = 0
+        self.assertEqual(open("tries").read(), "x\nx\nx\n")
+        os.chdir(curr_dir)
+        shutil.rmtree(tdir)
+    def test_run_tool_jobs_timeout(self):
+        """tests that a command running past the timeout is killed"""
+        TOOL_LIMITS["timeout"] = 0.2
+        start = time.time()
+        self.assertNotEqual(run_tool_jobs(_tool_job, [["0", "sleep 5"]], 1), [0])
+        TOOL_LIMITS["timeout"] = 0
+        self.assertTrue(time.time()-start < 4)
+    def test_run_tool_jobs_memory_budget(self):
+        """tests that the peak memory of each job is logged"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        os.chdir(tdir)
+        self.assertEqual(run_tool_jobs(_tool_job, [["0", "exit 0"], ["1", "exit 0"]], 2, 150, [1048576, 1048576]), [0, 0])
+        self.assertEqual(len(open(MEMORY_LOG).readlines()), 2)
+        del MEMORY_RATIOS["_tool_job"]
+        os.chdir(curr_dir)
+        shutil.rmtree(tdir)
+
+class Test47(unittest.TestCase):
+    def test_parse_blast_report_keeps_best_hit(self):
+        """the identity and length of the best hit are kept with the number of hits"""
+        import ls_bsr.util
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        os.chdir(tdir)
+        fp = open("A.fasta.new_blast.out", "w")
+        fp.write("Cluster0\tcontig1\t90.00\t100\t0\t0\t1\t100\t1\t100\t1e-20\t80.5\n")
+        fp.write("Cluster0\tcontig2\t99.50\t120\t0\t0\t1\t120\t1\t120\t1e-30\t120.0\n")
+        fp.write("Cluster1\tcontig1\t75.25\t60\t0\t0\t1\t60\t1\t60\t1e-5\t30.1\n")
+        fp.close()
+        self.assertEqual(ls_bsr.util._perform_workflow_pbr([os.path.join(tdir,"A.fasta.new_blast.out"), "true", False, False]),
+                         ["Cluster0", "120.0", "Cluster1", "30.1"])
+        self.assertEqual(open("A.fasta.new_blast.out.filtered.unique").read(), "Cluster0\t120.0\nCluster1\t30.1\n")
+        ls_bsr.util._perform_workflow_pbr([os.path.join(tdir,"A.fasta.new_blast.out"), "false", False, True])
+        self.assertEqual(open("A.fasta.new_blast.out.filtered.unique").read(),
+                         "Cluster0\t120.0\t99.50\t120\t2\nCluster1\t30.1\t75.25\t60\t1\n")
+        os.chdir(curr_dir)
+        shutil.rmtree(tdir)
+    def test_build_bsr_matrix_hit_matrices(self):
+        """the other matrices have the layout of the BSR matrix"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        for name, data in [("B.fasta.new_blast.out.filtered.unique", "Cluster1\t20.25\t88.5\t50\t1\nCluster0\t30.2\t100.00\t60\t3\n"),
+                           ("A.fasta.new_blast.out.filtered.unique", "Cluster2\t30.3\t95.125\t70\t2\n")]:
+            fp = open(os.path.join(tdir,name), "w")
+            fp.write(data)
+            fp.close()
+        metric_files = dict([(metric, os.path.join(tdir,"%s.txt" % metric)) for metric in ["identity","length","hits"]])
+        names = build_bsr_matrix(glob.glob(os.path.join(tdir,"*.filtered.unique")), 1, ["Cluster2","Cluster0","Cluster1"],
+                                 {"Cluster2":"60.6","Cluster0":"30.2","Cluster1":"40.5"}, os.path.join(tdir,"matrix.txt"), 256, metric_files)
+        self.assertEqual(names, ["A","B"])
+        self.assertEqual(open(os.path.join(tdir,"matrix.txt")).read(), "\tA\tB\nCluster0\t0.0000\t1.0000\n"
+                         "Cluster1\t0.0000\t0.5000\nCluster2\t0.5000\t0.0000\n")
+        self.assertEqual(open(metric_files["identity"]).read(), "\tA\tB\nCluster0\t0.000\t100.000\n"
+                         "Cluster1\t0.000\t88.500\nCluster2\t95.125\t0.000\n")
+        self.assertEqual(open(metric_files["length"]).read(), "\tA\tB\nCluster0\t0\t60\nCluster1\t0\t50\nCluster2\t70\t0\n")
+        self.assertEqual(open(metric_files["hits"]).read(), "\tA\tB\nCluster0\t0\t3\nCluster1\t0\t1\nCluster2\t2\t0\n")
+        shutil.rmtree(tdir)
+
+class Test48(unittest.TestCase):
+    def test_rebuild_from_hit_store(self):
+        """the rebuilt matrices match those of the run"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        os.chdir(tdir)
+        for name, data in [("A.fasta.new_blast.out", "Cluster0\tc1\t99.0\t100\t0\t0\t1\t100\t1\t100\t1e-30\t90.0\n"
+                                                     "Cluster0\tc2\t80.0\t100\t0\t0\t1\t100\t1\t100\t1e-30\t70.0\n"
+                                                     "Cluster1\tc1\t60.0\t50\t0\t0\t1\t50\t1\t50\t1e-5\t20.5\n"),
+                           ("B.fasta.new_blast.out", "Cluster1\tc3\t100.0\t60\t0\t0\t1\t60\t1\t60\t1e-20\t41.0\n"
+                                                     "Cluster1\tc4\t89.0\t60\t0\t0\t1\t60\t1\t60\t1e-20\t40.0\n"
+                                                     "other\tc3\t100.0\t60\t0\t0\t1\t60\t1\t60\t1e-20\t41.0\n")]:
+            fp = open(name, "w")
+            fp.write(data)
+            fp.close()
+        clusters = ["Cluster1","Cluster0","Cluster2"]
+        ref_scores = {"Cluster0":"90.0","Cluster1":"41.0"}
+        find_dups_dev(ref_scores, 0.7, 0.85, 75, clusters, 1)
+        share_gene_index(clusters, ref_scores)
+        parse_blast_report_dev("false", 1, True)
+        self.assertEqual(write_hit_store(glob.glob(os.path.join(tdir, "*_blast.out.hits")), "test_hit_store.bin"), 5)
+        build_bsr_matrix(glob.glob(os.path.join(tdir, "*.filtered.unique")), 1, clusters, ref_scores, "bsr_matrix_values.txt")
+        self.assertEqual(rebuild_from_hit_store("test_hit_store.bin", 0.7, 75, "T", "rebuilt"), ["Cluster1","Cluster0"])
+        self.assertEqual(open("rebuilt_bsr_matrix.txt").read(), open("bsr_matrix_values.txt").read())
+        self.assertEqual(open("rebuilt_dup_matrix.txt").read(), open("dup_matrix.txt").read())
+        self.assertEqual(open("dup_matrix.txt").read(), "ID\tA\tB\nCluster1\t0\t2\nCluster0\t2\t0\nCluster2\t0\t0\n")
+        self.assertEqual(open("rebuilt_duplicate_ids.txt").read(), open("duplicate_ids.txt").read())
+        self.assertEqual(open("rebuilt_paralogs_filtered_bsr_matrix_values.txt").read(),
+                         "\tA\tB\nCluster2\t0.0000\t0.0000\n")
+        rebuild_from_hit_store("test_hit_store.bin", 0.7, 90, "F", "strict")
+        self.assertEqual(open("strict_duplicate_ids.txt").read(), "")
+        self.assertFalse(os.path.exists("strict_paralogs_filtered_bsr_matrix_values.txt"))
+        os.chdir(curr_dir)
+        shutil.rmtree(tdir)
+
+class Test49(unittest.TestCase):
+    def test_blastp_orf_report_to_matrix(self):
+        """consensus genes are in the first column of a blastp-orf report, so
+        hits are reduced per consensus gene and scored against its self-score"""
+        import ls_bsr.util
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        os.chdir(tdir)
+        orfs = os.path.join(tdir, "A.fasta.new_genes.pep")
+        cmd, shell = next(ls_bsr.util._perform_workflow_blastp_orf(["0", orfs, "no", "consensus.pep"]))
+        self.assertEqual(cmd[cmd.index("-query")+1], orfs)
+        self.assertEqual(cmd[cmd.index("-db")+1], "consensus.pep")
+        self.assertEqual(cmd[cmd.index("-outfmt")+1], "6 sseqid qseqid pident length mismatch gapopen sstart send qstart qend evalue bitscore")
+        self.assertEqual(cmd[cmd.index("-out")+1], os.path.join(tdir, "A.fasta.new_blast.out"))
+        fp = open(os.path.join(tdir, "A.fasta.new_blast.out"), "w")
+        fp.write("Cluster0\torf_1\t100.00\t80\t0\t0\t1\t80\t1\t80\t1e-40\t160.0\n")
+        fp.write("Cluster0\torf_2\t70.00\t80\t0\t0\t1\t80\t1\t80\t1e-20\t80.0\n")
+        fp.write("Cluster1\torf_2\t90.00\t40\t0\t0\t1\t40\t1\t40\t1e-10\t30.0\n")
+        fp.close()
+        parse_blast_report_dev("false", 1)
+        build_bsr_matrix(glob.glob(os.path.join(tdir, "*.filtered.unique")), 1, ["Cluster0","Cluster1","Cluster2"],
+                         {"Cluster0":"160.0","Cluster1":"60.0","Cluster2":"50.0"}, "matrix.txt")
+        self.assertEqual(open("matrix.txt").read(), "\tA\nCluster0\t1.0000\nCluster1\t0.5000\nCluster2\t0.0000\n")
+        os.chdir(curr_dir)
+        shutil.rmtree(tdir)
+
+class Test50(unittest.TestCase):
+    def test_run_clustering_estimate_and_failure(self):
+        """the estimate comes from the model of the tool, and a failed run raises"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        os.chdir(tdir)
+        fp = open("genes.fasta", "wb")
+        fp.write(b">gene\n"+b"A"*1048576+b"\n")
+        fp.close()
+        estimate = estimate_job_memory("mmseqs", os.path.getsize("genes.fasta"))
+        run_clustering("mmseqs", ["true"], "genes.fasta", 100)
+        self.assertEqual(open(MEMORY_LOG).read().split("\t")[3], "%.1f" % estimate)
+        self.assertRaises(subprocess.CalledProcessError, run_clustering, "mmseqs", ["false"], "genes.fasta", 100)
+        MEMORY_RATIOS.pop("mmseqs", None)
+        os.chdir(curr_dir)
+        shutil.rmtree(tdir)
+
 if __name__ == "__main__":
     unittest.main()
     main()
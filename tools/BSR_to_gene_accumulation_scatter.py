@@ -35,7 +35,7 @@ if __name__ == "__main__":
     usage="usage: %prog [options]"
     parser = OptionParser(usage=usage)
     parser.add_option("-b", "--bsr_matrix", dest="matrix",
-                      help="path to BSR matrix [REQUIRED]",
+                      help="path to BSR matrix, text or sparse (.csr) [REQUIRED]",
                       action="callback", callback=test_file, type="string")
     parser.add_option("-u", "--upper_bound", dest="upper",
                       help="upper bound to be called conserved, defaults to 0.8",
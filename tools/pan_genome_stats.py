@@ -24,7 +24,7 @@ if __name__ == "__main__":
     usage="usage: %prog [options]"
     parser = OptionParser(usage=usage)
     parser.add_option("-b", "--bsr_matrix", dest="matrix",
-                      help="/path/to/bsr_matrix [REQUIRED]",
+                      help="/path/to/bsr_matrix, text or sparse (.csr) [REQUIRED]",
                       action="callback", callback=test_file, type="string")
     parser.add_option("-u", "--upper", dest="upper",
                       help="upper threshold for ORF presence, defaults to 0.8",
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+"""rebuild the BSR matrix, duplicate matrix and
+paralog filtered matrix from the hit store of a run,
+without aligning again"""
+
+from __future__ import print_function
+from optparse import OptionParser
+from ls_bsr.util import rebuild_from_hit_store
+import sys
+
+def test_file(option, opt_str, value, parser):
+    try:
+        with open(value): setattr(parser.values, option.dest, value)
+    except IOError:
+        print('%s file cannot be opened' % option)
+        sys.exit()
+
+def test_fplog(option, opt_str, value, parser):
+    if "F" in value:
+        setattr(parser.values, option.dest, value)
+    elif "T" in value:
+        setattr(parser.values, option.dest, value)
+    else:
+        print("select from T or F for f_plog setting")
+        sys.exit()
+
+def main(store, length, min_hlog, f_plog, prefix):
+    duplicate_IDs = rebuild_from_hit_store(store, length, min_hlog, f_plog, prefix)
+    print("# of genes with a duplicate = %s" % len(duplicate_IDs))
+
+if __name__ == "__main__":
+    usage="usage: %prog [options]"
+    parser = OptionParser(usage=usage)
+    parser.add_option("-s", "--hit_store", dest="store",
+                      help="/path/to/hit_store, from a run with --hit_store T [REQUIRED]",
+                      action="callback", callback=test_file, type="string")
+    parser.add_option("-l", "--length", dest="length",
+                      help="minimum BSR value to be called a duplicate, defaults to 0.7",
+                      action="store", default="0.7", type="float")
+    parser.add_option("-n", "--min_hlog", dest="min_hlog",
+                      help="minimum BLAST ID to be called a homolog, defaults to 75",
+                      action="store", default="75", type="int")
+    parser.add_option("-t", "--f_plog", dest="f_plog",
+                      help="filter ORFs with a paralog from BSR matrix? Default is F, values can be T or F",
+                      action="callback", callback=test_fplog, default="F", type="string")
+    parser.add_option("-x", "--prefix", dest="prefix",
+                      help="prefix for the output files [REQUIRED]",
+                      action="store", type="string")
+    options, args = parser.parse_args()
+
+    mandatories = ["store","prefix"]
+    for m in mandatories:
+        if not options.__dict__[m]:
+            print("\nMust provide %s.\n" %m)
+            parser.print_help()
+            exit(-1)
+
+    main(options.store, options.length, options.min_hlog, options.f_plog, options.prefix)